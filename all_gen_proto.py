@@ -0,0 +1,287 @@
+import os
+import sys
+import signal
+import pathlib
+import threading
+import configparser
+import multiprocessing
+import multiprocessing.process
+import multiprocessing.connection
+from typing import IO, Any, Callable, Dict, List, Tuple
+
+import proto_docs
+import proto_walk
+import proto_graph
+import script_trace
+import proto_manifest
+import proto_descriptor
+import go_gen_proto
+import py_gen_proto
+
+"""
+generates the go, python and docs outputs of a proto tree concurrently from a single
+read of the config and a single walk of the tree
+"""
+
+CONFIG_PATH: pathlib.Path = pathlib.Path("./setup.cfg").absolute()
+PROTO_INCLUDE_ROOTS: List[str] = ["."]
+GRAPH_CACHE_PATH: pathlib.Path = proto_manifest.CACHE_DIR / "all_gen_proto.graph.json"
+
+GO_TARGET = "go"
+PY_TARGET = "py"
+DOCS_TARGET = "docs"
+TARGETS: List[str] = [GO_TARGET, PY_TARGET, DOCS_TARGET]
+
+
+def load_cfg() -> configparser.ConfigParser:
+    """
+    loads library config file
+    :return: loaded `ConfigParser` object
+    """
+    config = configparser.ConfigParser()
+    config.read(str(CONFIG_PATH))
+    return config
+
+
+def configured_targets(config: configparser.ConfigParser) -> List[str]:
+    """Return the targets setup.cfg has the options for, in a stable order."""
+    targets: List[str] = list()
+    if config.has_option("proto", "root_go_package"):
+        targets.append(GO_TARGET)
+    if config.has_option("proto", "python_output_path"):
+        targets.append(PY_TARGET)
+    if config.has_section("docs.proto"):
+        targets.append(DOCS_TARGET)
+    return targets
+
+
+def main() -> None:
+    config = load_cfg()
+    force = "--force" in sys.argv
+
+    targets = configured_targets(config)
+    requested = [arg for arg in sys.argv[1:] if arg in TARGETS]
+    if requested:
+        targets = [t for t in targets if t in requested]
+    if not targets:
+        sys.stdout.write("no proto targets to generate\n")
+        return
+
+    jobs = build_jobs(config, targets, force)
+    sys.exit(run_targets(jobs))
+
+
+@script_trace.traced("build_jobs")
+def build_jobs(
+    config: configparser.ConfigParser, targets: List[str], force: bool
+) -> Dict[str, Callable[[], int]]:
+    """
+    Walk the proto tree once for every target and return a callable per target which
+    generates its outputs from its share of the walk.
+    """
+    roots: List[pathlib.Path] = list()
+    excludes: List[List[str]] = list()
+
+    go_options = go_gen_proto.load_cfg(config) if GO_TARGET in targets else None
+    py_options = py_gen_proto.load_cfg(config) if PY_TARGET in targets else None
+    for options in (go_options, py_options):
+        if options is not None:
+            roots.append(options.proto_root_dir)
+            excludes.append(options.exclude)
+    if DOCS_TARGET in targets:
+        roots.extend(
+            pathlib.Path(p) for p in proto_docs.load_paths(config) if os.path.isdir(p)
+        )
+        excludes.append(proto_docs.load_excludes(config))
+
+    # Only walk past the excludes every target shares, each target then picks its
+    # own files out of the walk.
+    shared_excludes = [e for e in excludes[0] if all(e in x for x in excludes[1:])]
+    walked = proto_walk.walk_files(roots, ".proto", shared_excludes)
+
+    jobs: Dict[str, Callable[[], int]] = dict()
+    set_files: List[str] = list()
+    if go_options is not None:
+        go_files = go_gen_proto.find_proto_files(go_options, walked)
+        jobs[GO_TARGET] = lambda: run_generator(
+            go_gen_proto.generate, go_options, go_files, force
+        )
+        set_files.extend(go_files)
+    if py_options is not None:
+        py_files = py_gen_proto.find_proto_files(py_options, walked)
+        jobs[PY_TARGET] = lambda: run_generator(
+            py_gen_proto.generate, py_options, py_files, force
+        )
+    if DOCS_TARGET in targets:
+        docs_files = proto_docs.find_proto_files(config, walked)
+        jobs[DOCS_TARGET] = lambda: proto_docs.generate_proto_html(
+            config, docs_files, force
+        )
+        set_files.extend(docs_files)
+
+    # Parse what changed among the go and docs protos once up front; each then finds
+    # the protos it rebuilds covered by this cached descriptor set instead of building
+    # its own. Python always parses the sources itself.
+    if (
+        GO_TARGET in jobs
+        and DOCS_TARGET in jobs
+        and config.getboolean("proto", "descriptor_cache", fallback=True)
+    ):
+        file_hashes = proto_manifest.hash_files(dict.fromkeys(set_files))
+        graph = proto_graph.load_graph(
+            file_hashes, PROTO_INCLUDE_ROOTS, GRAPH_CACHE_PATH
+        )
+        changed = proto_descriptor.changed_since_parsed(file_hashes, graph)
+        if changed:
+            proto_descriptor.ensure_descriptor_set(file_hashes, graph, changed)
+
+    return jobs
+
+
+def run_generator(
+    generate: Callable[[Any, List[str], bool], None],
+    options: Any,
+    files: List[str],
+    force: bool,
+) -> int:
+    """Run a code generator, which exits by itself when it fails."""
+    generate(options, files, force)
+    return 0
+
+
+def run_targets(jobs: Dict[str, Callable[[], int]]) -> int:
+    """
+    Run every job in its own forked process, streaming its output prefixed with the
+    target name. The first job to fail stops the others, and its exit status is
+    returned. Where there is no fork the jobs run one after another in this process.
+    """
+    if "fork" not in multiprocessing.get_all_start_methods():
+        return run_targets_serially(jobs)
+
+    context = multiprocessing.get_context("fork")
+    output_lock = threading.Lock()
+
+    # Every job is forked before any reader thread starts, so no child can inherit
+    # a lock one of them holds.
+    processes: Dict[str, multiprocessing.process.BaseProcess] = dict()
+    pipes: List[Tuple[int, IO[str], str]] = list()
+    for name, job in jobs.items():
+        stdout_read, stdout_write = os.pipe()
+        stderr_read, stderr_write = os.pipe()
+        process = context.Process(
+            target=run_child,
+            args=(name, job, stdout_write, stderr_write),
+            name=name,
+        )
+        process.start()
+        os.close(stdout_write)
+        os.close(stderr_write)
+        processes[name] = process
+        pipes.append((stdout_read, sys.stdout, name))
+        pipes.append((stderr_read, sys.stderr, name))
+
+    readers: List[threading.Thread] = list()
+    for read_fd, stream, name in pipes:
+        reader = threading.Thread(
+            target=stream_prefixed, args=(read_fd, stream, name, output_lock)
+        )
+        reader.start()
+        readers.append(reader)
+
+    returncode = 0
+    pending = dict(processes)
+    while pending:
+        finished = multiprocessing.connection.wait(
+            [p.sentinel for p in pending.values()]
+        )
+        for name, done in list(pending.items()):
+            if done.sentinel not in finished:
+                continue
+            done.join()
+            del pending[name]
+            if done.exitcode != 0 and returncode == 0:
+                # A job killed by a signal has a negative exit code.
+                returncode = max(done.exitcode or 1, 1)
+                cancel(list(pending.values()))
+
+    for reader in readers:
+        reader.join()
+
+    return returncode
+
+
+def run_targets_serially(jobs: Dict[str, Callable[[], int]]) -> int:
+    """Run the jobs one at a time, stopping at the first to fail."""
+    for name, job in jobs.items():
+        sys.stdout.write(f"[{name}]\n")
+        sys.stdout.flush()
+        returncode = run_job(name, job)
+        if returncode != 0:
+            return returncode
+    return 0
+
+
+def run_job(name: str, job: Callable[[], int]) -> int:
+    """Run a job, turning the exit of a generator which fails into its status."""
+    try:
+        with script_trace.span(name, category="target"):
+            return job()
+    except SystemExit as error:
+        code = error.code
+        return code if isinstance(code, int) else 0 if code is None else 1
+    finally:
+        sys.stdout.flush()
+        sys.stderr.flush()
+
+
+def run_child(
+    name: str, job: Callable[[], int], stdout_fd: int, stderr_fd: int
+) -> None:
+    """
+    Run a job in a forked process of its own group, so it can be stopped along with
+    every protoc it started, with its output sent down the given pipes.
+    """
+    if hasattr(os, "setpgid"):
+        os.setpgid(0, 0)
+    sys.stdout.flush()
+    sys.stderr.flush()
+    os.dup2(stdout_fd, 1)
+    os.dup2(stderr_fd, 2)
+    os.close(stdout_fd)
+    os.close(stderr_fd)
+
+    script_trace.after_fork(name)
+    returncode = run_job(name, job)
+    script_trace.flush_fork()
+    os._exit(returncode)
+
+
+def cancel(processes: List[multiprocessing.process.BaseProcess]) -> None:
+    """Stop still running jobs along with any processes they started."""
+    for process in processes:
+        if process.pid is None:
+            continue
+        if not hasattr(os, "killpg"):
+            process.terminate()
+            continue
+        try:
+            os.killpg(process.pid, signal.SIGTERM)
+        except (ProcessLookupError, PermissionError):
+            process.terminate()
+
+
+def stream_prefixed(
+    read_fd: int, stream: IO[str], name: str, lock: threading.Lock
+) -> None:
+    """Copy a job's output to `stream` line by line with its target as a prefix."""
+    with os.fdopen(read_fd, "r", errors="replace") as pipe:
+        for line in pipe:
+            if not line.endswith("\n"):
+                line += "\n"
+            with lock:
+                stream.write(f"[{name}] {line}")
+                stream.flush()
+
+
+if __name__ == "__main__":
+    main()
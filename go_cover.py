@@ -0,0 +1,191 @@
+import re
+import array
+import pathlib
+import posixpath
+import dataclasses
+from typing import IO, Dict, Iterable, Iterator, Optional, Tuple
+
+"""
+reads go coverage profiles in a single streaming pass, giving the same statement
+coverage `go tool cover` reports without running the go toolchain again
+"""
+
+SET_MODE = "set"
+COUNT_MODE = "count"
+ATOMIC_MODE = "atomic"
+MODES = (SET_MODE, COUNT_MODE, ATOMIC_MODE)
+
+MODE_PREFIX = "mode: "
+BLOCK_REGEX = re.compile(r"^(.+):(\d+)\.(\d+),(\d+)\.(\d+) (\d+) (\d+)$")
+"""A profile line: file:startLine.startCol,endLine.endCol numStmt count"""
+
+POSITION_BITS = 32
+"""Bits given to each line and column when a block's position is packed into a key."""
+
+
+@dataclasses.dataclass
+class Coverage:
+    """Dataclass used to hold the statement coverage of a file, package or profile."""
+
+    statements: int = 0
+    """Number of statements in the profiled blocks."""
+    covered: int = 0
+    """Number of those statements that ran at least once."""
+
+    def add(self, other: "Coverage") -> None:
+        self.statements += other.statements
+        self.covered += other.covered
+
+    def percent(self) -> float:
+        # go tool cover reports 0% rather than failing on an empty profile.
+        return 100.0 * self.covered / (self.statements or 1)
+
+    def format(self) -> str:
+        """Format the percentage the way `go tool cover` does."""
+        return f"{self.percent():.1f}%"
+
+
+class FileBlocks:
+    """
+    The blocks of one source file, held in flat arrays rather than an object per
+    block. A block seen again, as happens when several test binaries cover the same
+    package, is merged into the first copy the way `go tool cover` merges them.
+    """
+
+    def __init__(self) -> None:
+        self.index: Dict[int, int] = dict()
+        self.positions = array.array("Q")
+        """startLine, startCol, endLine, endCol of every block, four per block."""
+        self.statements = array.array("L")
+        self.counts = array.array("Q")
+
+    def add(
+        self,
+        position: Tuple[int, int, int, int],
+        statements: int,
+        count: int,
+        mode: str,
+    ) -> None:
+        start_line, start_col, end_line, end_col = position
+        key = (
+            (((start_line << POSITION_BITS) | start_col) << POSITION_BITS | end_line)
+            << POSITION_BITS
+        ) | end_col
+        block = self.index.get(key)
+        if block is None:
+            self.index[key] = len(self.statements)
+            self.positions.extend(position)
+            self.statements.append(statements)
+            self.counts.append(count)
+        elif mode == SET_MODE:
+            self.counts[block] = self.counts[block] or count
+        else:
+            self.counts[block] += count
+
+    def blocks(self) -> Iterator[Tuple[int, int, int, int, int, int]]:
+        """Yield (startLine, startCol, endLine, endCol, statements, count) per block."""
+        for block, statements in enumerate(self.statements):
+            start_line, start_col, end_line, end_col = self.positions[
+                block * 4 : block * 4 + 4
+            ]
+            count = self.counts[block]
+            yield start_line, start_col, end_line, end_col, statements, count
+
+    def coverage(self) -> Coverage:
+        result = Coverage()
+        for statements, count in zip(self.statements, self.counts):
+            result.statements += statements
+            if count > 0:
+                result.covered += statements
+        return result
+
+
+class Profile:
+    """A parsed coverage profile, its blocks grouped by source file."""
+
+    def __init__(self, mode: Optional[str] = None) -> None:
+        self.mode = mode
+        self.files: Dict[str, FileBlocks] = dict()
+
+    def set_mode(self, mode: str) -> None:
+        if mode not in MODES:
+            raise ValueError(f"unknown coverage mode: {mode}")
+        if self.mode is not None and self.mode != mode:
+            raise ValueError(f"cannot mix coverage modes {self.mode} and {mode}")
+        self.mode = mode
+
+    def add_line(self, line: str) -> None:
+        """Add one line of a profile, which may be a repeated mode line."""
+        line = line.rstrip("\r\n")
+        if not line:
+            return
+        if line.startswith(MODE_PREFIX):
+            self.set_mode(line[len(MODE_PREFIX) :].strip())
+            return
+        if self.mode is None:
+            raise ValueError("coverage profile does not start with a mode line")
+
+        match = BLOCK_REGEX.match(line)
+        if match is None:
+            raise ValueError(f"bad coverage profile line: {line!r}")
+        file_name, *numbers = match.groups()
+        start_line, start_col, end_line, end_col, statements, count = map(int, numbers)
+        blocks = self.files.get(file_name)
+        if blocks is None:
+            blocks = self.files[file_name] = FileBlocks()
+        blocks.add(
+            (start_line, start_col, end_line, end_col), statements, count, self.mode
+        )
+
+    def by_file(self) -> Dict[str, Coverage]:
+        return {name: self.files[name].coverage() for name in sorted(self.files)}
+
+    def by_package(self) -> Dict[str, Coverage]:
+        packages: Dict[str, Coverage] = dict()
+        for name, coverage in self.by_file().items():
+            packages.setdefault(posixpath.dirname(name), Coverage()).add(coverage)
+        return packages
+
+    def total(self) -> Coverage:
+        result = Coverage()
+        for blocks in self.files.values():
+            result.add(blocks.coverage())
+        return result
+
+
+def parse_profile(
+    profile_path: pathlib.Path, profile: Optional[Profile] = None
+) -> Profile:
+    """
+    Parse a coverage profile line by line, merging it into `profile` when given, so
+    several profiles can be combined in a single pass over each.
+    """
+    if profile is None:
+        profile = Profile()
+    with profile_path.open() as profile_file:
+        for line in profile_file:
+            profile.add_line(line)
+    return profile
+
+
+def merge_profiles(profile_paths: Iterable[pathlib.Path]) -> Profile:
+    """
+    Combine profiles, e.g. one per test shard, summing the hits of blocks they share
+    in count and atomic mode and or-ing them in set mode.
+    """
+    profile = Profile()
+    for profile_path in profile_paths:
+        parse_profile(profile_path, profile)
+    return profile
+
+
+def write_profile(profile: Profile, destination: IO[str]) -> None:
+    """Write `profile` back out in the format go writes coverage profiles in."""
+    destination.write(f"{MODE_PREFIX}{profile.mode or ATOMIC_MODE}\n")
+    for file_name, blocks in profile.files.items():
+        for block in blocks.blocks():
+            start_line, start_col, end_line, end_col, statements, count = block
+            destination.write(
+                f"{file_name}:{start_line}.{start_col},{end_line}.{end_col} "
+                f"{statements} {count}\n"
+            )
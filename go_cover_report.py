@@ -0,0 +1,216 @@
+import os
+import sys
+import html
+import json
+import hashlib
+import pathlib
+import posixpath
+from typing import Dict, List, Optional, Tuple
+
+import go_cover
+import go_packages
+
+"""
+writes an html coverage report from a parsed profile: a small index of the packages
+and files, and a page per source file which the index links to, so the browser only
+ever loads one file at a time. File pages are only written again when the file or its
+coverage changed.
+"""
+
+FILES_DIR = "files"
+"""Folder next to the index holding the page of every source file."""
+STATE_FILE = "report.json"
+"""Records what every file page was rendered from, to skip the unchanged ones."""
+
+STYLE = """<style>
+body { font-family: sans-serif; }
+table { border-collapse: collapse; }
+td, th { padding: 2px 8px; text-align: left; }
+td.number { text-align: right; }
+pre { font-size: 13px; line-height: 1.3; }
+.line { color: #999; user-select: none; }
+.hit { background: #c8f0c8; }
+.miss { background: #f8c8c8; }
+</style>"""
+
+Segment = Tuple[int, int, int]
+"""(startCol, endCol, count) of a block on one line, columns 1-based, end exclusive,
+an end of 0 runs to the end of the line."""
+
+
+def source_path(
+    file_name: str, index: go_packages.PackageIndex
+) -> Optional[pathlib.Path]:
+    """Find the source of a profiled file, if it belongs to the main module."""
+    package = index.packages.get(posixpath.dirname(file_name))
+    if package is None:
+        return None
+    return pathlib.Path(package.dir) / posixpath.basename(file_name)
+
+
+def page_name(file_name: str) -> str:
+    return f"{FILES_DIR}/{file_name}.html"
+
+
+def line_segments(blocks: go_cover.FileBlocks) -> Dict[int, List[Segment]]:
+    """Split every block into the part of each line it covers."""
+    segments: Dict[int, List[Segment]] = dict()
+    for start_line, start_col, end_line, end_col, _, count in blocks.blocks():
+        for line in range(start_line, end_line + 1):
+            start = start_col if line == start_line else 1
+            end = end_col if line == end_line else 0
+            segments.setdefault(line, list()).append((start, end, count))
+    for spans in segments.values():
+        spans.sort()
+    return segments
+
+
+def render_line(text: bytes, segments: List[Segment]) -> str:
+    parts: List[str] = list()
+    position = 0
+    for start, end, count in segments:
+        start_index = max(start - 1, position)
+        end_index = len(text) if end == 0 else min(end - 1, len(text))
+        if end_index <= start_index:
+            continue
+        parts.append(html.escape(text[position:start_index].decode("utf-8", "replace")))
+        css_class = "hit" if count > 0 else "miss"
+        snippet = html.escape(text[start_index:end_index].decode("utf-8", "replace"))
+        parts.append(f'<span class="{css_class}" title="{count}">{snippet}</span>')
+        position = end_index
+    parts.append(html.escape(text[position:].decode("utf-8", "replace")))
+    return "".join(parts)
+
+
+def render_file(
+    file_name: str, source: bytes, blocks: go_cover.FileBlocks, depth: int
+) -> str:
+    segments = line_segments(blocks)
+    lines = source.split(b"\n")
+    width = len(str(len(lines)))
+    rendered = [
+        f'<span class="line">{number:>{width}}</span>  '
+        + render_line(text.rstrip(b"\r"), segments.get(number, []))
+        for number, text in enumerate(lines, start=1)
+    ]
+    back = "../" * depth + "index.html"
+    return (
+        '<!DOCTYPE html>\n<html>\n<head>\n<meta charset="utf-8">\n'
+        f"<title>{html.escape(file_name)}</title>\n{STYLE}\n</head>\n<body>\n"
+        f'<p><a href="{back}">index</a></p>\n'
+        f"<h1>{html.escape(file_name)} {blocks.coverage().format()}</h1>\n"
+        "<pre>" + "\n".join(rendered) + "</pre>\n</body>\n</html>\n"
+    )
+
+
+def page_key(source: bytes, blocks: go_cover.FileBlocks) -> str:
+    digest = hashlib.sha256(source)
+    for block in blocks.blocks():
+        digest.update(repr(block).encode())
+    return digest.hexdigest()
+
+
+def load_state(report_dir: pathlib.Path) -> Dict[str, str]:
+    try:
+        return dict(json.loads((report_dir / STATE_FILE).read_text(encoding="utf-8")))
+    except (OSError, ValueError, TypeError):
+        return dict()
+
+
+def coverage_row(name: str, coverage: go_cover.Coverage, link: str = "") -> str:
+    label = html.escape(name)
+    if link:
+        label = f'<a href="{html.escape(link)}">{label}</a>'
+    return (
+        f"<tr><td>{label}</td><td class='number'>{coverage.format()}</td>"
+        f"<td class='number'>{coverage.covered}/{coverage.statements}</td></tr>\n"
+    )
+
+
+def write_index(
+    profile: go_cover.Profile, linked: Dict[str, str], index_path: pathlib.Path
+) -> None:
+    table_head = "<table>\n<tr><th>{}</th><th>coverage</th><th>statements</th></tr>\n"
+    parts = [
+        '<!DOCTYPE html>\n<html>\n<head>\n<meta charset="utf-8">\n'
+        f"<title>Coverage Report</title>\n{STYLE}\n</head>\n<body>\n"
+        f"<h1>Coverage {profile.total().format()}</h1>\n"
+        f"<p>mode: {html.escape(profile.mode or '')}</p>\n",
+        "<h2>Packages</h2>\n",
+        table_head.format("package"),
+    ]
+    parts.extend(
+        coverage_row(package, coverage)
+        for package, coverage in profile.by_package().items()
+    )
+    parts.extend(["</table>\n<h2>Files</h2>\n", table_head.format("file")])
+    parts.extend(
+        coverage_row(file_name, coverage, linked.get(file_name, ""))
+        for file_name, coverage in profile.by_file().items()
+    )
+    parts.append("</table>\n</body>\n</html>\n")
+    index_path.write_text("".join(parts), encoding="utf-8")
+
+
+def write_coverage_report(
+    profile: go_cover.Profile,
+    index: go_packages.PackageIndex,
+    index_path: pathlib.Path,
+) -> Tuple[int, int]:
+    """
+    Write the report's index to `index_path` and a page per source file next to it.
+    Returns how many file pages were written and how many were already current.
+    """
+    report_dir = index_path.parent
+    report_dir.mkdir(parents=True, exist_ok=True)
+    previous = load_state(report_dir)
+    state: Dict[str, str] = dict()
+    linked: Dict[str, str] = dict()
+    written = unchanged = 0
+
+    for file_name, blocks in profile.files.items():
+        path = source_path(file_name, index)
+        if path is None or not path.is_file():
+            continue
+        try:
+            source = path.read_bytes()
+        except OSError as error:
+            # Listed without a page, the rest of the report is still worth having.
+            sys.stderr.write(f"no coverage page for {file_name}: {error}\n")
+            continue
+        page = page_name(file_name)
+        page_path = report_dir / page
+        key = page_key(source, blocks)
+        state[file_name] = key
+        linked[file_name] = page
+
+        if previous.get(file_name) == key and page_path.is_file():
+            unchanged += 1
+            continue
+        page_path.parent.mkdir(parents=True, exist_ok=True)
+        page_path.write_text(
+            render_file(file_name, source, blocks, depth=page.count("/")),
+            encoding="utf-8",
+        )
+        written += 1
+
+    # Drop the pages of files no longer in the profile, and the folders they leave
+    # empty.
+    files_dir = report_dir / FILES_DIR
+    for file_name in set(previous) - set(state):
+        stale_path = report_dir / page_name(file_name)
+        if stale_path.is_file():
+            stale_path.unlink()
+        directory = stale_path.parent
+        while directory != files_dir and files_dir in directory.parents:
+            try:
+                directory.rmdir()
+            except OSError:
+                break
+            directory = directory.parent
+
+    write_index(profile, linked, index_path)
+    temp_path = report_dir / f"{STATE_FILE}.tmp"
+    temp_path.write_text(json.dumps(state), encoding="utf-8")
+    os.replace(str(temp_path), str(report_dir / STATE_FILE))
+    return written, unchanged
@@ -1,13 +1,48 @@
 import pathlib
-import os
+import re
 import sys
+import json
+import time
+import posixpath
 import subprocess
 import configparser
 import dataclasses
-from typing import List
-
+from concurrent import futures
+from typing import Callable, Dict, List, Match, Optional, Tuple
+
+import proto_run
+import proto_walk
+import proto_watch
+import proto_graph
+import proto_stage
+import script_trace
+import proto_manifest
+import proto_descriptor
 
 CONFIG_PATH: pathlib.Path = pathlib.Path("./setup.cfg").absolute()
+PROTO_INCLUDE_ROOTS: List[str] = ["."]
+"""The `-I` roots protoc resolves imports against."""
+DEFAULT_EXCLUDES: List[str] = proto_walk.DEFAULT_EXCLUDES + ["*google*"]
+"""Exclude globs used when setup.cfg has none, leaving out vendored google protos."""
+MANIFEST_PATH: pathlib.Path = proto_manifest.CACHE_DIR / "go_gen_proto.json"
+TAG_SUMMARY_PATH: pathlib.Path = proto_manifest.CACHE_DIR / "go_gen_proto.tags.json"
+
+NATIVE_TAG_ENGINE = "native"
+EXTERNAL_TAG_ENGINE = "protoc-go-inject-tag"
+COMPARE_TAG_ENGINE = "compare"
+"""Runs the external tool and fails wherever the native engine would differ."""
+XXX_SKIP_TAGS: List[str] = ["bson"]
+"""Tags set to "-" on XXX_ fields, like protoc-go-inject-tag's -XXX_skip flag."""
+
+# These mirror the expressions protoc-go-inject-tag uses so the native engine
+# recognises exactly the same comments and tag items.
+TAG_COMMENT_REGEX = re.compile(rb"^//.*?@(?i:gotags?|inject_tags?):\s*(.*)$")
+TAG_ITEM_REGEX = re.compile(rb'[\w_]+:"[^"]+"')
+TAG_EXPR_REGEX = re.compile(rb"`.+`\Z")
+"""The tool's "`.+`$", where $ only matches at the very end, as in Go."""
+TEMPLATE_REGEX = re.compile(rb"\$(?:\$|\{(\w+)\}|(\w+))")
+STRUCT_START_REGEX = re.compile(rb"^type\s+\w+\s+struct\s*\{\s*$")
+STRUCT_FIELD_REGEX = re.compile(rb"^(\s+)(\w+)(\s+[^`]*?)`([^`]*)`(.*)$")
 
 
 @dataclasses.dataclass
@@ -18,19 +53,48 @@ class Options:
     """Root path to our protobuf folder."""
     go_module_root: pathlib.Path
     """Root module to use for protoc-gen-go '--go_opt=module=' flag."""
+    jobs: int = dataclasses.field(metadata={"fingerprint": False})
+    """Number of protoc processes to run at once."""
+    descriptor_cache: bool
+    """Whether to generate from the shared cached descriptor set."""
+    exclude: List[str] = dataclasses.field(metadata={"fingerprint": False})
+    """Globs of the files and directories to leave out of proto discovery."""
+    tag_engine: str
+    """The engine used to inject tags: 'protoc-go-inject-tag', 'native' or 'compare'."""
+
+
+@dataclasses.dataclass
+class TagResult:
+    """Dataclass used to hold the outcome of injecting tags into one file."""
+
+    source_code_path: pathlib.Path
+    """The generated file tags were injected into."""
+    seconds: float
+    """Wall time the injection took."""
+    returncode: int
+    """Exit status of the injection."""
+    output: str
+    """Anything the injection reported."""
 
 
-def load_cfg() -> Options:
+@script_trace.traced("load_cfg")
+def load_cfg(config: Optional[configparser.ConfigParser] = None) -> Options:
     """
     loads library config file
+    :param config: already loaded config to read the options from, if any
     :return: loaded `Options` object
     """
-    config = configparser.ConfigParser()
-    config.read(str(CONFIG_PATH))
+    if config is None:
+        config = configparser.ConfigParser()
+        config.read(str(CONFIG_PATH))
 
     options = Options(
         proto_root_dir=pathlib.Path(config["proto"]["root_source_path"]),
         go_module_root=pathlib.Path(config["proto"]["root_go_package"]),
+        jobs=proto_run.load_jobs(config),
+        descriptor_cache=config.getboolean("proto", "descriptor_cache", fallback=True),
+        exclude=proto_walk.load_excludes(config, "proto", DEFAULT_EXCLUDES),
+        tag_engine=config.get("proto", "go_tag_engine", fallback=NATIVE_TAG_ENGINE),
     )
 
     return options
@@ -39,78 +103,465 @@ def load_cfg() -> Options:
 def main() -> None:
     """Run the script."""
     options = load_cfg()
-    generate_golang_source(options)
-    add_bson_tags()
-
-
-def generate_golang_source(options: Options) -> None:
-    """Generate the protocol buffers."""
     proto_files = find_proto_files(options)
-    run_protoc_command(proto_files, options)
-
+    force = "--force" in sys.argv
+    if "--watch" not in sys.argv:
+        generate(options, proto_files, force)
+        return
+
+    proto_watch.run_rebuild(lambda: generate(options, proto_files, force))
+    proto_watch.watch_files(
+        [options.proto_root_dir],
+        ".proto",
+        options.exclude,
+        proto_files,
+        lambda files: generate(options, files),
+    )
 
-def find_proto_files(options: Options) -> List[str]:
-    """Glob all the proto files in the root proto folder and return as list."""
-    proto_file_list: List[str] = list()
 
-    for proto_path in options.proto_root_dir.rglob("./**/*.proto"):
-        if "google" in str(proto_path):
-            continue
+@script_trace.traced("generate")
+def generate(options: Options, proto_files: List[str], force: bool = False) -> None:
+    """Regenerate whatever changed among `proto_files` and inject its bson tags."""
+    plan = plan_generation(options, proto_files, force)
+    if not plan.rebuild_files and not proto_manifest.stale_outputs(plan):
+        sys.stdout.write("go protos are up to date\n")
+        return
+
+    # Generate and tag into a staging directory, then only move the files whose
+    # contents changed into the source tree so go's build cache stays warm.
+    stage_dir = proto_stage.make_stage("go")
+    if plan.rebuild_files:
+        descriptor_set = None
+        if options.descriptor_cache:
+            descriptor_set = proto_descriptor.ensure_descriptor_set(
+                plan.manifest.file_hashes, plan.graph, plan.rebuild_files
+            )
+
+        generate_golang_source(
+            plan.rebuild_files, plan.graph, options, descriptor_set, stage_dir
+        )
+        generated_files = [
+            stage_dir / path for path in proto_stage.staged_files(stage_dir, ".pb.go")
+        ]
+        add_bson_tags(generated_files, options)
+        proto_manifest.record_outputs(
+            plan,
+            find_generated_files(plan.rebuild_files, plan.graph, options, stage_dir),
+        )
+
+    stale = proto_manifest.stale_outputs(plan)
+    result = proto_stage.sync_stage(stage_dir, pathlib.Path("."), stale)
+    sys.stdout.write(f"go outputs: {result.summary()}\n")
+    proto_manifest.commit_build(plan)
+
+
+@script_trace.traced("plan")
+def plan_generation(
+    options: Options, proto_files: List[str], force: bool = False
+) -> proto_manifest.BuildPlan:
+    """Work out which protos changed since the last successful generation."""
+    tool_versions = [
+        proto_manifest.tool_version(["protoc", "--version"]),
+        proto_manifest.tool_version(["protoc-gen-go", "--version"]),
+    ]
+    if options.tag_engine != NATIVE_TAG_ENGINE:
+        tool_versions.append(proto_manifest.executable_stamp(EXTERNAL_TAG_ENGINE))
+    fingerprint = proto_manifest.make_fingerprint(options, tool_versions, __file__)
+    return proto_manifest.plan_build(
+        MANIFEST_PATH, proto_files, fingerprint, PROTO_INCLUDE_ROOTS, force
+    )
 
-        path_str = str(proto_path)
-        path_str = path_str.replace(str(os.getcwd()), ".")
-        proto_file_list.append(path_str)
 
-    return proto_file_list
+@script_trace.traced("protoc")
+def generate_golang_source(
+    proto_files: List[str],
+    graph: proto_graph.ProtoGraph,
+    options: Options,
+    descriptor_set: Optional[pathlib.Path] = None,
+    output_dir: pathlib.Path = pathlib.Path("."),
+) -> None:
+    """
+    Generate the protocol buffers into `output_dir`, from `descriptor_set` instead of
+    parsing the protos again when one is given.
+    """
+    run_protoc_command(proto_files, graph, options, descriptor_set, output_dir)
 
 
-def run_protoc_command(proto_files: List[str], options: Options) -> None:
-    """Run the protoc command and stream the output to std out."""
-    command = build_protoc_command(proto_files, options)
+def find_proto_files(options: Options, walked: Optional[List[str]] = None) -> List[str]:
+    """
+    Walk the root proto folder for proto files and return them as a list, or pick
+    them out of the results of a broader walk if one is given.
+    """
+    if walked is not None:
+        return proto_walk.select_files(walked, options.proto_root_dir, options.exclude)
+    return proto_walk.walk_files([options.proto_root_dir], ".proto", options.exclude)
+
+
+def run_protoc_command(
+    proto_files: List[str],
+    graph: proto_graph.ProtoGraph,
+    options: Options,
+    descriptor_set: Optional[pathlib.Path] = None,
+    output_dir: pathlib.Path = pathlib.Path("."),
+) -> None:
+    """
+    Run the protoc command over independent shards of the proto files, at most
+    `options.jobs` at a time, and exit with the first failing status.
+    """
+    shards = proto_run.shard_files(proto_files, graph, options.jobs)
+    if descriptor_set is not None:
+        shards = [proto_descriptor.descriptor_names(s, graph) for s in shards]
+    commands = [
+        build_protoc_command(s, options, descriptor_set, output_dir) for s in shards
+    ]
 
-    proc = subprocess.Popen(command)
-    _, _ = proc.communicate()
-    if proc.returncode != 0:
-        sys.exit(proc.returncode)
+    returncode = proto_run.run_commands(commands, options.jobs)
+    if returncode != 0:
+        sys.exit(returncode)
 
 
-def build_protoc_command(protoc_files: List[str], options: Options) -> List[str]:
+def build_protoc_command(
+    protoc_files: List[str],
+    options: Options,
+    descriptor_set: Optional[pathlib.Path] = None,
+    output_dir: pathlib.Path = pathlib.Path("."),
+) -> List[str]:
     """Put together the protoc command to buid."""
 
     command = [
         "protoc",
         "--experimental_allow_proto3_optional",
-        "--go_out=plugins=grpc:.",
+        f"--go_out=plugins=grpc:{output_dir}",
         f"--go_opt=module={options.go_module_root}",
     ]
+    if descriptor_set is not None:
+        command.append(f"--descriptor_set_in={descriptor_set}")
     command.extend(protoc_files)
     return command
 
 
-def add_bson_tags() -> None:
-    """Add bson tags through protoc-go-inject-tag."""
-    directory = pathlib.Path(os.getcwd())
-    for source_code_file_path in directory.rglob("./**/*.pb.go"):
-        run_tag_command(source_code_file_path)
+def go_output_path(
+    proto_file: str, graph: proto_graph.ProtoGraph, options: Options
+) -> pathlib.Path:
+    """Work out where protoc-gen-go writes the source generated from a proto file."""
+    key = proto_graph.normalize_path(proto_file)
+    import_name = graph.import_name(key)
+    file_name = posixpath.basename(import_name)
+    if file_name.endswith(".proto"):
+        file_name = file_name[: -len(".proto")]
+
+    go_import = graph.nodes[key].go_package.split(";")[0]
+    module_root = options.go_module_root.as_posix()
+    if not go_import:
+        directory = posixpath.dirname(import_name)
+    elif go_import == module_root:
+        directory = ""
+    elif go_import.startswith(module_root + "/"):
+        directory = go_import[len(module_root) + 1 :]
+    else:
+        directory = go_import
+
+    return pathlib.Path(directory or ".") / f"{file_name}.pb.go"
+
+
+def find_generated_files(
+    proto_files: List[str],
+    graph: proto_graph.ProtoGraph,
+    options: Options,
+    stage_dir: pathlib.Path,
+) -> Dict[str, List[str]]:
+    """
+    Return the files staged for each of `proto_files`, keyed by normalized path and
+    relative to the module root, so they can be removed once the proto is gone.
+    """
+    outputs: Dict[str, List[str]] = dict()
+    for proto_file in proto_files:
+        pb_path = go_output_path(proto_file, graph, options).as_posix()
+        grpc_path = pb_path[: -len(".pb.go")] + "_grpc.pb.go"
+        outputs[proto_graph.normalize_path(proto_file)] = [
+            path for path in (pb_path, grpc_path) if (stage_dir / path).is_file()
+        ]
+
+    return outputs
+
+
+@script_trace.traced("add_bson_tags")
+def add_bson_tags(source_code_paths: List[pathlib.Path], options: Options) -> None:
+    """
+    Add bson tags to the generated files, at most `options.jobs` at a time, then
+    report timings and exit with the first failing status.
+    """
+    if options.tag_engine == EXTERNAL_TAG_ENGINE:
+        inject: Callable[[pathlib.Path], TagResult] = run_tag_command
+    elif options.tag_engine == NATIVE_TAG_ENGINE:
+        inject = inject_tags_natively
+    elif options.tag_engine == COMPARE_TAG_ENGINE:
+        inject = compare_tag_engines
+    else:
+        raise ValueError(f"unknown go_tag_engine: {options.tag_engine}")
+
+    with futures.ThreadPoolExecutor(max_workers=max(options.jobs, 1)) as executor:
+        results = list(executor.map(inject, source_code_paths))
+
+    write_tag_summary(results)
+
+    failures = [result for result in results if result.returncode != 0]
+    for failure in failures:
+        sys.stderr.write(f"{failure.source_code_path}: {failure.output}\n")
+    if failures:
+        sys.exit(failures[0].returncode)
+
+
+def write_tag_summary(results: List[TagResult]) -> None:
+    """Write the per-file timings to disk and a one line summary to stdout."""
+    summary = [
+        {
+            "path": result.source_code_path.as_posix(),
+            "seconds": round(result.seconds, 6),
+            "returncode": result.returncode,
+            "output": result.output,
+        }
+        for result in sorted(results, key=lambda r: r.seconds, reverse=True)
+    ]
+    TAG_SUMMARY_PATH.parent.mkdir(parents=True, exist_ok=True)
+    TAG_SUMMARY_PATH.write_text(json.dumps(summary, indent=2))
+
+    failed = sum(1 for result in results if result.returncode != 0)
+    total = sum(result.seconds for result in results)
+    line = f"injected tags into {len(results)} files in {total:.3f}s, {failed} failed"
+    if summary:
+        line += f", slowest {summary[0]['path']} ({summary[0]['seconds']:.3f}s)"
+    sys.stdout.write(line + "\n")
 
 
 def build_tag_command(source_code_file_path: pathlib.Path) -> List[str]:
     """Build the protoc-go-inject-tag command."""
     return [
-        "protoc-go-inject-tag",
+        EXTERNAL_TAG_ENGINE,
         f"-input={source_code_file_path}",
-        "-XXX_skip=bson",
+        f"-XXX_skip={','.join(XXX_SKIP_TAGS)}",
     ]
 
 
-def run_tag_command(source_code_path: pathlib.Path) -> None:
-    """Run the protoc-go-inject-tag  command and stream the output to stdout."""
+def run_tag_command(source_code_path: pathlib.Path) -> TagResult:
+    """Run the protoc-go-inject-tag command and capture its output."""
     command = build_tag_command(source_code_path)
-    proc = subprocess.Popen(command)
+    started = time.perf_counter()
+    proc = script_trace.Popen(
+        command,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.STDOUT,
+        universal_newlines=True,
+    )
 
-    _, _ = proc.communicate()
-    if proc.returncode != 0:
-        sys.exit(proc.returncode)
+    output, _ = proc.communicate()
+    return TagResult(
+        source_code_path=source_code_path,
+        seconds=time.perf_counter() - started,
+        returncode=proc.returncode,
+        output=output.strip(),
+    )
+
+
+def inject_tags_natively(source_code_path: pathlib.Path) -> TagResult:
+    """
+    Inject tags into a generated file in-process, producing the same bytes as
+    protoc-go-inject-tag, and only write the file back if its contents changed.
+    """
+    started = time.perf_counter()
+    try:
+        source = source_code_path.read_bytes()
+        injected = inject_tags_in_source(source)
+        if injected != source:
+            source_code_path.write_bytes(injected)
+            output = "rewritten"
+        else:
+            output = "unchanged"
+        returncode = 0
+    except OSError as error:
+        output = str(error)
+        returncode = 1
+
+    return TagResult(
+        source_code_path=source_code_path,
+        seconds=time.perf_counter() - started,
+        returncode=returncode,
+        output=output,
+    )
+
+
+def compare_tag_engines(source_code_path: pathlib.Path) -> TagResult:
+    """
+    Inject tags with protoc-go-inject-tag, keeping its output, and fail if the native
+    engine would have written different bytes.
+    """
+    try:
+        native = inject_tags_in_source(source_code_path.read_bytes())
+    except OSError as error:
+        return TagResult(source_code_path, 0.0, 1, str(error))
+
+    result = run_tag_command(source_code_path)
+    if result.returncode == 0 and source_code_path.read_bytes() != native:
+        result.returncode = 1
+        result.output = f"native output differs from {EXTERNAL_TAG_ENGINE}"
+    return result
+
+
+def inject_tags_in_source(source: bytes) -> bytes:
+    """
+    Apply `// @inject_tag:` comments and the XXX_ skip tags to the struct fields of a
+    generated Go source file, byte for byte the way protoc-go-inject-tag does.
+
+    The tool records an edit per tag comment, each made from the field's original tag
+    and span, and applies them from the end of the file. A field with a single edit
+    simply gets its tag replaced. A field with several has them applied last first,
+    each one re-reading the field's original length from the rewritten file, which
+    is reproduced here rather than improved on so both engines agree.
+    """
+    fields = find_tag_fields(source)
+
+    # Built back to front, the last chunk is always the front of what follows.
+    chunks: List[bytes] = list()
+    position = len(source)
+    for start, end, current_tag, inject_tags in reversed(fields):
+        chunks.append(source[end:position])
+        position = start
+
+        expr = source[start:end]
+        following = b""
+        window = end - start
+        for inject_tag in reversed(inject_tags):
+            while len(expr) + len(following) < window and chunks:
+                following += chunks.pop()
+            joined = expr + following
+            expr = inject_tag_expr(joined[:window], current_tag, inject_tag)
+            following = joined[window:]
+        chunks.append(following)
+        chunks.append(expr)
+
+    chunks.append(source[:position])
+    return b"".join(reversed(chunks))
+
+
+def find_tag_fields(source: bytes) -> List[Tuple[int, int, bytes, List[bytes]]]:
+    """
+    Return (start, end, current tag, tags to inject) for every struct field with tags
+    to inject, in file order. A field's span runs from its name to the end of its tag
+    and its tags come from the XXX_ skip, its doc comment and its trailing comment.
+    """
+    fields: List[Tuple[int, int, bytes, List[bytes]]] = list()
+    in_struct = False
+    doc_tags: List[bytes] = list()
+    offset = 0
+    for line in source.splitlines(keepends=True):
+        line_offset = offset
+        offset += len(line)
+        text = line.rstrip(b"\r\n")
+        if not in_struct:
+            in_struct = STRUCT_START_REGEX.match(text) is not None
+            doc_tags = list()
+            continue
+
+        if text.startswith(b"}"):
+            in_struct = False
+            continue
+
+        stripped = text.strip()
+        if stripped.startswith(b"//"):
+            comment_tag = tag_from_comment(stripped)
+            if comment_tag:
+                doc_tags.append(comment_tag)
+            continue
+
+        inject_tags = doc_tags
+        doc_tags = list()
+
+        field_match = STRUCT_FIELD_REGEX.match(text)
+        if field_match is None:
+            continue
+
+        indent, name, _, current_tag, rest = field_match.groups()
+        if name.startswith(b"XXX") and XXX_SKIP_TAGS:
+            skip_tag = " ".join(f'{t}:"-"' for t in XXX_SKIP_TAGS).encode()
+            inject_tags = [skip_tag] + inject_tags
+
+        trailing_tag = tag_from_comment(rest.strip())
+        if trailing_tag:
+            inject_tags.append(trailing_tag)
+
+        if inject_tags:
+            start = line_offset + len(indent)
+            end = line_offset + field_match.start(5)
+            fields.append((start, end, current_tag, inject_tags))
+
+    return fields
+
+
+def tag_from_comment(comment: bytes) -> Optional[bytes]:
+    """Return the tags a `// @inject_tag:` comment asks for, if it is one."""
+    comment_match = TAG_COMMENT_REGEX.match(comment)
+    if comment_match is None or not comment_match.group(1):
+        return None
+    return comment_match.group(1)
+
+
+def inject_tag_expr(expr: bytes, current_tag: bytes, inject_tag: bytes) -> bytes:
+    """
+    Replace the backquoted tag ending `expr` with `current_tag` overridden by
+    `inject_tag`, leaving `expr` as it is when it does not end in one.
+    """
+    tag_items = override_tag_items(
+        parse_tag_items(current_tag), parse_tag_items(inject_tag)
+    )
+    tag = b"`" + b" ".join(key + b":" + value for key, value in tag_items) + b"`"
+    tag_match = TAG_EXPR_REGEX.search(expr)
+    if tag_match is None:
+        return expr
+    return expr[: tag_match.start()] + expand_template(tag, tag_match.group(0))
+
+
+def expand_template(template: bytes, match: bytes) -> bytes:
+    """
+    Expand `$` references in a replacement the way Go's regexp does, where `$0` is the
+    whole match, `$$` a dollar sign and any other name refers to nothing.
+    """
+
+    def replace(reference: Match[bytes]) -> bytes:
+        if reference.group(0) == b"$$":
+            return b"$"
+        name = reference.group(1) or reference.group(2)
+        return match if name.isdigit() and int(name) == 0 else b""
+
+    return TEMPLATE_REGEX.sub(replace, template)
+
+
+def parse_tag_items(tag: bytes) -> List[Tuple[bytes, bytes]]:
+    """Split a struct tag into (key, quoted value) pairs."""
+    items: List[Tuple[bytes, bytes]] = list()
+    for item in TAG_ITEM_REGEX.findall(tag):
+        key, value = item.split(b":", 1)
+        items.append((key, value))
+    return items
+
+
+def override_tag_items(
+    current: List[Tuple[bytes, bytes]], injected: List[Tuple[bytes, bytes]]
+) -> List[Tuple[bytes, bytes]]:
+    """
+    Replace items of `current` with the injected item with the same key, keeping
+    their position, and append any injected items that are left over.
+    """
+    remaining = list(injected)
+    items: List[Tuple[bytes, bytes]] = list()
+    for key, value in current:
+        for position, (injected_key, _) in enumerate(remaining):
+            if injected_key == key:
+                items.append(remaining.pop(position))
+                break
+        else:
+            items.append((key, value))
+
+    return items + remaining
 
 
 if __name__ == "__main__":
@@ -3,13 +3,14 @@ import pathlib
 import os
 import shutil
 import re
-import subprocess
 from itertools import count
 from glob import iglob
 from dataclasses import dataclass
 from configparser import ConfigParser
 from typing import Optional
 
+import script_trace
+
 """
 changes name of module in file path file path directory and all relevant config settings
 """
@@ -50,6 +51,7 @@ def load_cfg(config_path: pathlib.Path) -> ConfigParser:
     return config
 
 
+@script_trace.traced("load_target_name")
 def load_target_name(script_info: ScriptInfo) -> None:
     """
     loads target name from system arguments into script info, raises errors_api if value
@@ -71,6 +73,7 @@ def load_target_name(script_info: ScriptInfo) -> None:
         raise ValueError("new name must be passed with name=[name] param")
 
 
+@script_trace.traced("make_new_directory")
 def make_new_directory(script_info: ScriptInfo) -> None:
 
     # load current and new paths
@@ -152,7 +155,7 @@ def rename_packages(
     package_regex = re.compile(r"(package) \S+", flags=re.IGNORECASE)
 
     os.remove(str(go_mod_path))
-    process = subprocess.Popen(["go", "mod", "init", f"{git_org}/{target_name}-go"])
+    process = script_trace.Popen(["go", "mod", "init", f"{git_org}/{target_name}-go"])
     if process.wait(timeout=5) != 0:
         raise RuntimeError("could not init gomod")
 
@@ -184,6 +187,7 @@ def rename_packages(
         raise FileNotFoundError("no packages found in library")
 
 
+@script_trace.traced("alter_new")
 def alter_new(script_info: ScriptInfo) -> None:
     """
     renames lib and writes 1 or 0 to stdout for whether .egg needs to be
@@ -1,8 +1,21 @@
-import re
+import os
 import sys
+import time
 import pathlib
+import posixpath
+import threading
+import sqlite3
+import contextlib
 import subprocess
 from configparser import ConfigParser
+from typing import IO, Callable, Dict, List, Optional, Tuple
+
+import go_cover
+import go_packages
+import go_cover_report
+import go_test_history
+import script_trace
+import go_test_report
 
 CONFIG_PATH: pathlib.Path = pathlib.Path(__file__).parent.parent.parent / "setup.cfg"
 
@@ -11,9 +24,25 @@ STD_ERR_LOG = pathlib.Path("./zdevelop/tests/_reports/test_stderr.txt")
 FULL_LOG = pathlib.Path("./zdevelop/tests/_reports/test_full.txt")
 COVERAGE_LOG = pathlib.Path("./zdevelop/tests/_reports/coverage.out")
 TEST_REPORT = pathlib.Path("./zdevelop/tests/_reports/test_results.html")
+TEST_INDEX = pathlib.Path("./zdevelop/tests/_reports/test_index.jsonl")
+"""One json record per test with its status, duration and output offsets."""
 COVERAGE_REPORT = pathlib.Path("./zdevelop/tests/_reports/coverage/index.html")
+SHARD_DIR = pathlib.Path("./zdevelop/tests/_reports/shards")
+"""Where each shard writes its coverage profile, and where --merge reads them from."""
+
+SHARD_ENV = "GO_TEST_SHARD"
+SHARD_FLAG = "--shard="
+"""Run one shard of the packages, given as INDEX/COUNT with INDEX from 1 to COUNT."""
+MERGE_FLAG = "--merge"
+"""Merge the shard profiles in SHARD_DIR and check the coverage they add up to."""
+AFFECTED_FLAG = "--affected"
+"""Only test packages affected by changes since a base ref, --affected=REF names it."""
+DEFAULT_AFFECTED_BASE = "origin/main"
+SHOW_FLAG = "--show="
+"""Print the output of a test, or of a package, from the last run's log and exit."""
 
-COVERAGE_REGEX = re.compile(r"total:\s+\(statements\)\s+(\d+\.\d)%")
+LINE_CHUNK_CHARS = 64 * 1024
+POLL_SECONDS = 0.2
 
 
 def load_cfg() -> ConfigParser:
@@ -26,40 +55,403 @@ def load_cfg() -> ConfigParser:
     return config
 
 
-def run_test() -> None:
-    config = load_cfg()
-    coverage_required = config.getfloat("testing", "coverage_required") * 100
+def stream_lines(
+    source: IO[str],
+    handle: Callable[[str], None],
+    lock: threading.Lock,
+    chunk_chars: int = LINE_CHUNK_CHARS,
+) -> None:
+    """Hand each line of `source` to `handle`, one reader at a time."""
+    # Read in bounded chunks so even a single enormous line is never held whole.
+    for line in iter(lambda: source.readline(chunk_chars), ""):
+        with lock:
+            handle(line)
+    source.close()
+
+
+def write_lines(streams: List[IO[str]]) -> Callable[[str], None]:
+    def write(line: str) -> None:
+        for stream in streams:
+            stream.write(line)
+        streams[0].flush()
+
+    return write
+
+
+def run_streamed(commands: List[List[str]]) -> int:
+    """
+    Run `go test -json` commands concurrently and tee their output line by line to
+    the console and to the stdout, stderr and full logs as it arrives, so the full
+    log keeps the order in which the streams were written and nothing is held in
+    memory. The json events are decoded into the test index and report as tests
+    finish, the logs and console get the plain test output. The first command to
+    fail stops the others, as -failfast would, and its status is returned.
+    """
+    lock = threading.Lock()
+    with contextlib.ExitStack() as stack:
+        stderr_log = stack.enter_context(STD_ERR_LOG.open("w"))
+        full_log = stack.enter_context(FULL_LOG.open("w"))
+        sink = stack.enter_context(
+            go_test_report.TestEventSink(
+                STD_OUT_LOG, TEST_INDEX, TEST_REPORT, [sys.stdout, full_log]
+            )
+        )
+        write_stderr = write_lines([sys.stderr, stderr_log, full_log])
+
+        procs: List[subprocess.Popen] = list()  # type: ignore[type-arg]
+        readers: List[threading.Thread] = list()
+        for command in commands:
+            proc = script_trace.Popen(
+                command,
+                stdout=subprocess.PIPE,
+                stderr=subprocess.PIPE,
+                universal_newlines=True,
+                bufsize=1,
+            )
+            procs.append(proc)
+            readers.extend(
+                [
+                    # go test splits long output over several events, so each
+                    # event arrives whole within the bounded read.
+                    threading.Thread(
+                        target=stream_lines, args=(proc.stdout, sink.handle_line, lock)
+                    ),
+                    threading.Thread(
+                        target=stream_lines, args=(proc.stderr, write_stderr, lock)
+                    ),
+                ]
+            )
+        for reader in readers:
+            reader.start()
+
+        returncode = wait_all(procs)
+        for reader in readers:
+            reader.join()
+
+    return returncode
+
+
+def wait_all(procs: List[subprocess.Popen]) -> int:  # type: ignore[type-arg]
+    """Wait for every process, terminating the rest once one of them fails."""
+    returncode = 0
+    running = list(procs)
+    while running:
+        for proc in list(running):
+            status = proc.poll()
+            if status is None:
+                continue
+            running.remove(proc)
+            if status != 0 and returncode == 0:
+                returncode = status
+                for other in running:
+                    other.terminate()
+        if running:
+            time.sleep(POLL_SECONDS)
+    return returncode
+
+
+def load_shard() -> Optional[Tuple[int, int]]:
+    """Return the (index, count) of the CI shard to run, if this run is one."""
+    value = os.environ.get(SHARD_ENV, "")
+    for arg in sys.argv[1:]:
+        if arg.startswith(SHARD_FLAG):
+            value = arg[len(SHARD_FLAG) :]
+    if not value:
+        return None
+
+    index_str, _, count_str = value.partition("/")
+    try:
+        index, count = int(index_str), int(count_str)
+    except ValueError:
+        index = count = 0
+    if not 1 <= index <= count:
+        sys.stderr.write(
+            f"bad shard {value!r}: expected INDEX/COUNT with INDEX from 1 to COUNT\n"
+        )
+        sys.exit(1)
+    return index, count
+
+
+def load_affected_base(config: ConfigParser) -> Optional[str]:
+    """Return the ref to diff against when only affected packages are tested."""
+    base = config.get("testing", "affected_base", fallback=DEFAULT_AFFECTED_BASE)
+    enabled = config.getboolean("testing", "affected", fallback=False)
+    for arg in sys.argv[1:]:
+        if arg == AFFECTED_FLAG:
+            enabled = True
+        elif arg.startswith(f"{AFFECTED_FLAG}="):
+            enabled = True
+            base = arg[len(AFFECTED_FLAG) + 1 :]
+    return base if enabled else None
+
+
+def select_cover_packages(
+    config: ConfigParser, package_index: go_packages.PackageIndex
+) -> List[str]:
+    """Return the packages setup.cfg asks to cover, leaving out the excluded ones."""
     test_package = config.get("testing", "test_package", fallback="./...")
     exclude_string = config.get("testing", "exclude", fallback="")
     exclude_list = [e for e in exclude_string.split("\n") if e]
+    sys.stdout.write(f"excluding: {', '.join(exclude_list) or 'none'}\n")
+    packages = go_packages.select_packages(package_index, test_package, exclude_list)
+    if not packages:
+        # Excludes matching everything must not quietly turn the coverage gate off.
+        sys.stdout.write("the excludes leave no package to cover, covering ./...\n")
+        packages = go_packages.select_packages(package_index, "./...", [])
+    return packages
+
+
+def covered_profile(profile: go_cover.Profile, packages: List[str]) -> go_cover.Profile:
+    """Return the part of `profile` which covers `packages`."""
+    wanted = set(packages)
+    covered = go_cover.Profile(profile.mode)
+    covered.files = {
+        name: blocks
+        for name, blocks in profile.files.items()
+        if posixpath.dirname(name) in wanted
+    }
+    return covered
+
+
+def select_affected(
+    index: go_packages.PackageIndex, base_ref: str
+) -> Optional[List[str]]:
+    """
+    Return the packages the changes since `base_ref` affect, or `None` when all of
+    them have to be tested.
+    """
+    try:
+        changed = go_packages.changed_files(base_ref)
+    except (RuntimeError, OSError) as error:
+        # Shallow CI clones often lack the base ref.
+        sys.stdout.write(
+            f"cannot diff against {base_ref} ({error}), testing everything\n"
+        )
+        return None
+    affected = go_packages.affected_packages(index, changed)
+    if affected is None:
+        sys.stdout.write(f"module files changed since {base_ref}, testing everything\n")
+        return None
+
+    sys.stdout.write(
+        f"{len(changed)} files changed since {base_ref} affect "
+        f"{len(affected)} packages\n"
+    )
+    return sorted(affected)
+
+
+def assign_shards(
+    packages: List[str],
+    shard_count: int,
+    durations: Optional[Dict[str, float]] = None,
+) -> List[List[str]]:
+    """
+    Split the packages into `shard_count` shards. With the packages' past durations
+    the longest go first, each to the shard with the least work so far, so the
+    shards finish close together. Without them the packages are dealt round robin.
+    """
+    shards: List[List[str]] = [list() for _ in range(shard_count)]
+    if not durations:
+        for position, package in enumerate(sorted(packages)):
+            shards[position % shard_count].append(package)
+        return shards
+
+    # Packages we have never timed are assumed to take as long as a typical one.
+    typical = sorted(durations.values())[len(durations) // 2]
+    loads = [0.0] * shard_count
+    for package in sorted(packages, key=lambda p: (-durations.get(p, typical), p)):
+        lightest = loads.index(min(loads))
+        shards[lightest].append(package)
+        loads[lightest] += durations.get(package, typical)
+    return shards
+
+
+def load_durations() -> Dict[str, float]:
+    try:
+        with contextlib.closing(go_test_history.connect()) as connection:
+            return go_test_history.package_durations(connection)
+    except (sqlite3.Error, OSError) as error:
+        sys.stderr.write(f"could not read the test history: {error}\n")
+        return dict()
+
+
+def record_history(config: ConfigParser) -> None:
+    """Store this run's durations and report the slowest tests and regressions."""
+    slowest_count = config.getint("testing", "slowest_tests", fallback=10)
+    threshold = config.getfloat("testing", "regression_threshold", fallback=0.5)
+    try:
+        with contextlib.closing(go_test_history.connect()) as connection:
+            run_id = go_test_history.record_run(
+                connection, go_test_report.load_index(TEST_INDEX)
+            )
+            slowest = go_test_history.slowest_tests(connection, run_id, slowest_count)
+            regressions = go_test_history.find_regressions(
+                connection, run_id, threshold
+            )
+    except (sqlite3.Error, OSError, ValueError, TypeError) as error:
+        # The history is only advisory, never fail a run over it, not even over a
+        # truncated or foreign test index.
+        sys.stderr.write(f"could not record the test history: {error}\n")
+        return
+
+    if slowest:
+        sys.stdout.write("slowest tests:\n")
+        for package, test, elapsed in slowest:
+            sys.stdout.write(f"  {elapsed:8.2f}s  {package} {test}\n")
+    if regressions:
+        sys.stdout.write(
+            f"tests more than {threshold:.0%} slower than their recent runs:\n"
+        )
+        for regression in regressions:
+            sys.stdout.write(f"  {regression.describe()}\n")
+
+
+def shard_profile(index: int, shard_count: int) -> pathlib.Path:
+    return SHARD_DIR / f"coverage.{index}-of-{shard_count}.out"
+
+
+def write_empty_profile(profile_path: pathlib.Path) -> None:
+    profile_path.write_text(f"{go_cover.MODE_PREFIX}{go_cover.ATOMIC_MODE}\n")
+
+
+def merge_shard_profiles() -> go_cover.Profile:
+    """Merge every shard profile into the single profile the coverage gate reads."""
+    profile_paths = sorted(SHARD_DIR.glob("coverage.*-of-*.out"))
+    if not profile_paths:
+        sys.stderr.write(f"no shard coverage profiles found in {SHARD_DIR}\n")
+        sys.exit(1)
+
+    # A missing shard would quietly lower the total, so insist on all of them.
+    shard_count = int(profile_paths[0].suffixes[0].split("-of-")[1])
+    expected = {shard_profile(i, shard_count) for i in range(1, shard_count + 1)}
+    if set(profile_paths) != expected:
+        found = ", ".join(p.name for p in profile_paths)
+        sys.stderr.write(
+            f"expected coverage profiles of {shard_count} shards, found {found}\n"
+        )
+        sys.exit(1)
+
+    with script_trace.span("merge_profiles", profiles=len(profile_paths)):
+        profile = go_cover.merge_profiles(profile_paths)
+        with COVERAGE_LOG.open("w") as coverage_file:
+            go_cover.write_profile(profile, coverage_file)
+    sys.stdout.write(
+        f"merged {len(profile_paths)} shard profiles into {COVERAGE_LOG}\n"
+    )
+    return profile
+
+
+def report_coverage(profile: go_cover.Profile) -> float:
+    """Write per package coverage and the total, and return the total percentage."""
+    report = "".join(
+        f"{package}\t{coverage.format()}\n"
+        for package, coverage in profile.by_package().items()
+    )
+    total = profile.total()
+    report += f"total:\t\t\t\t(statements)\t{total.format()}\n"
+
+    sys.stdout.write(report)
+    with STD_OUT_LOG.open("a") as f:
+        f.write(report)
+
+    # Compare at the one decimal place we report, as go tool cover's output was.
+    return float(f"{total.percent():.1f}")
+
+
+def write_coverage_report(
+    profile: go_cover.Profile, package_index: go_packages.PackageIndex
+) -> None:
+    try:
+        with script_trace.span("coverage_report"):
+            written, unchanged = go_cover_report.write_coverage_report(
+                profile, package_index, COVERAGE_REPORT
+            )
+    except OSError as error:
+        # The report is a convenience, the coverage gate still has to run.
+        sys.stderr.write(f"could not write the coverage report: {error}\n")
+        return
+    sys.stdout.write(
+        f"coverage report in {COVERAGE_REPORT}, {written} file pages written, "
+        f"{unchanged} unchanged\n"
+    )
+
+
+def check_coverage(coverage: float, coverage_required: float) -> None:
+    if coverage < coverage_required:
+        sys.stderr.write(
+            f"Coverage {coverage} is less than required {coverage_required}\n"
+        )
+        sys.exit(1)
+    else:
+        sys.stderr.write(
+            f"Coverage {coverage}% passes requirement of {coverage_required}%\n"
+        )
+
+
+def show_output(name: str) -> None:
+    """Copy the output of the tests, or packages, called `name` out of the log."""
+    found = False
+    for record in go_test_report.load_index(TEST_INDEX):
+        if name not in (record.test, record.package if not record.test else None):
+            continue
+        found = True
+        sys.stdout.write(f"=== {record.package} {record.test} ({record.status})\n")
+        sys.stdout.flush()
+        go_test_report.copy_output(STD_OUT_LOG, record.segments, sys.stdout.buffer)
+        sys.stdout.buffer.flush()
+    if not found:
+        sys.stderr.write(f"no test or package called {name} in {TEST_INDEX}\n")
+        sys.exit(1)
+
+
+def run_test() -> None:
+    for arg in sys.argv[1:]:
+        if arg.startswith(SHOW_FLAG):
+            show_output(arg[len(SHOW_FLAG) :])
+            return
+
+    config = load_cfg()
+    coverage_required = config.getfloat("testing", "coverage_required") * 100
+
+    if MERGE_FLAG in sys.argv:
+        profile = merge_shard_profiles()
+        package_index = go_packages.load_index()
+        # Shards which had no package to cover profiled the tested packages instead.
+        profile = covered_profile(profile, select_cover_packages(config, package_index))
+        if not profile.files:
+            sys.stdout.write("no covered package was tested, no coverage gate\n")
+            return
+        coverage = report_coverage(profile)
+        write_coverage_report(profile, package_index)
+        check_coverage(coverage, coverage_required)
+        return
+
     race_detection = config.getboolean("testing", "race_detection", fallback=True)
     multi_process = config.getboolean("testing", "multi_process", fallback=True)
     timeout = config.getint("testing", "timeout", fallback=60)
+    shard_count = max(config.getint("testing", "shards", fallback=1), 1)
+    ci_shard = load_shard()
+    affected_base = load_affected_base(config)
 
-    # Get the list of packages we want to cover
-    list_process = subprocess.Popen(
-        ["go", "list", test_package], stdout=subprocess.PIPE, universal_newlines=True
+    # Get the list of packages we want to cover, leaving out the excluded ones.
+    package_index = go_packages.load_index()
+    packages = select_cover_packages(config, package_index)
+    sys.stdout.write(
+        f"covering {len(packages)} of {len(package_index.packages)} packages\n"
     )
 
-    grep_command = ["grep", "-v"]
-    for this_exclude in exclude_list:
-        grep_command += ["-e", this_exclude]
-
-    sys.stdout.write(f"grep: {' '.join(grep_command)}\n")
-    grep_process = subprocess.Popen(
-        grep_command,
-        stdin=list_process.stdout,
-        stdout=subprocess.PIPE,
-        stderr=subprocess.PIPE,
-        universal_newlines=True,
-    )
+    test_packages: Optional[List[str]] = None
+    if affected_base is not None:
+        test_packages = select_affected(package_index, affected_base)
+        if test_packages is not None and not test_packages:
+            sys.stdout.write("no packages are affected, nothing to test\n")
+            return
+        if test_packages is not None:
+            # Gate on the coverage of the code that changed, not the whole module.
+            packages = [p for p in packages if p in test_packages]
 
-    assert list_process.stdout is not None
-    list_process.stdout.close()
-    packages_str, _ = grep_process.communicate()
-    packages = packages_str.split("\n")
-    if not packages:
-        packages = ["./..."]
+    # Name whole subtrees of the module as prefix/... rather than package by package.
+    coverpkg = go_packages.compress_patterns(package_index, packages)
 
     sys.stdout.write(f"COVERAGE REQUIRED: {coverage_required}\n")
 
@@ -67,7 +459,7 @@ def run_test() -> None:
     command = [
         "go",
         "test",
-        "-v",
+        "-json",
         "-failfast",
         f"-timeout={timeout}s",
     ]
@@ -79,73 +471,85 @@ def run_test() -> None:
     # Add th flag to restrict the number of simultaneous tests to 1.
     if not multi_process:
         command.extend(("-p", "1"))
+    elif shard_count > 1 and ci_shard is None:
+        # Local shards split the machine between them rather than each taking all of
+        # it.
+        command.extend(("-p", str(max((os.cpu_count() or 1) // shard_count, 1))))
 
-    # Finish building the command.
-    command.extend(
-        [
-            "-covermode=atomic",
-            f"-coverprofile={COVERAGE_LOG}",
-            f"-coverpkg={','.join(packages)}",
-        ]
-    )
-
-    command = command + ["./..."]
-
-    sys.stdout.write(f"command: {' '.join(command)}\n")
+    # Finish building the command. Without packages to cover go covers the tested
+    # ones, which the gate leaves out below.
+    command.append("-covermode=atomic")
+    if coverpkg:
+        command.append(f"-coverpkg={','.join(coverpkg)}")
 
-    proc = subprocess.Popen(
-        command, stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True
-    )
-    stdout, stderr = proc.communicate()
-
-    sys.stdout.write(stdout)
-    sys.stderr.write(stderr)
-
-    STD_OUT_LOG.write_text(stdout)
-    STD_ERR_LOG.write_text(stderr)
-    FULL_LOG.write_text(stdout + stderr)
-
-    if proc.returncode != 0:
-        sys.exit(proc.returncode)
-
-    # Use the cov command to generate the total coverage
-    command = [
-        "go",
-        "tool",
-        "cover",
-        "--func",
-        str(COVERAGE_LOG),
-    ]
+    if ci_shard is None and shard_count == 1:
+        commands = [
+            command + [f"-coverprofile={COVERAGE_LOG}", *(test_packages or ["./..."])]
+        ]
+    else:
+        # Split the test packages into shards, each writing a profile of its own.
+        SHARD_DIR.mkdir(parents=True, exist_ok=True)
+        if ci_shard is not None:
+            shard_indexes = [ci_shard[0]]
+            shard_count = ci_shard[1]
+        else:
+            shard_indexes = list(range(1, shard_count + 1))
+            for stale_profile in SHARD_DIR.glob("coverage.*-of-*.out"):
+                stale_profile.unlink()
 
-    proc = subprocess.Popen(
-        command, stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True
-    )
-    stdout, stderr = proc.communicate()
+        if test_packages is None:
+            test_packages = sorted(package_index.packages)
+        # Every CI node has to come up with the same split, which it could not
+        # from histories that differ between nodes.
+        durations = load_durations() if ci_shard is None else None
+        shards = assign_shards(test_packages, shard_count, durations)
+        commands = list()
+        for index in shard_indexes:
+            if not shards[index - 1]:
+                write_empty_profile(shard_profile(index, shard_count))
+                continue
+            commands.append(
+                command
+                + [
+                    f"-coverprofile={shard_profile(index, shard_count)}",
+                    *shards[index - 1],
+                ]
+            )
 
-    sys.stdout.write(stdout)
-    sys.stderr.write(stderr)
+    for this_command in commands:
+        sys.stdout.write(f"command: {' '.join(this_command)}\n")
 
-    with STD_OUT_LOG.open("a") as f:
-        f.write(stdout)
-    with STD_ERR_LOG.open("a") as f:
-        f.write(stderr)
+    returncode = run_streamed(commands) if commands else 0
+    if commands:
+        record_history(config)
+    if returncode != 0:
+        sys.exit(returncode)
 
-    if proc.returncode != 0:
-        sys.exit(proc.returncode)
+    if ci_shard is not None:
+        # A single shard covers only part of the code, the gate runs once the
+        # profiles of every shard have been gathered and merged with --merge.
+        sys.stdout.write(
+            f"shard {ci_shard[0]}/{ci_shard[1]} done, run with {MERGE_FLAG} once "
+            f"every shard's profile is in {SHARD_DIR}\n"
+        )
+        return
 
-    # Get the last coverage tally in the result
-    coverage_str = [x for x in COVERAGE_REGEX.finditer(stdout)][-1].group(1)
-    coverage = float(coverage_str)
+    if not packages:
+        # Only an affected run gets here, when every package it tested is excluded.
+        sys.stdout.write("none of the tested packages is covered, no coverage gate\n")
+        return
 
-    if coverage < coverage_required:
-        sys.stderr.write(
-            f"Coverage {coverage} is less than required {coverage_required}\n"
-        )
-        sys.exit(1)
+    # Tally the coverage from the profile ourselves rather than through a second pass
+    # by go tool cover.
+    if shard_count > 1:
+        profile = merge_shard_profiles()
     else:
-        sys.stderr.write(
-            f"Coverage {coverage}% passes requirement of {coverage_required}%\n"
-        )
+        with script_trace.span("coverage"):
+            profile = go_cover.parse_profile(COVERAGE_LOG)
+    coverage = report_coverage(profile)
+    # Written before the gate, so a run short of the requirement still shows why.
+    write_coverage_report(profile, package_index)
+    check_coverage(coverage, coverage_required)
 
 
 if __name__ == "__main__":
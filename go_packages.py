@@ -0,0 +1,309 @@
+import os
+import re
+import sys
+import json
+import hashlib
+import pathlib
+import subprocess
+import dataclasses
+from typing import Dict, Iterator, List, Optional, Pattern, Set
+
+import script_trace
+
+"""
+an index of the packages in the main module and their imports, from a single cached
+call to `go list`, used to pick the packages to test and cover: by package pattern and
+exclude regexes, by what a set of changed files affects, and as compact patterns
+"""
+
+CACHE_PATH = pathlib.Path("./zdevelop/.cache/go_packages.json")
+FULL_RUN_FILES = ("go.mod", "go.sum", "setup.cfg")
+"""Files whose change can affect every package, so everything is tested."""
+SKIPPED_DIRS = (".git", "vendor", "node_modules", "zdevelop", "zdocs")
+"""Directories left out of the signature, none of them hold the module's packages."""
+
+
+@dataclasses.dataclass
+class GoPackage:
+    """Dataclass used to hold what we need to know about one package of the module."""
+
+    import_path: str
+    """The package's import path."""
+    dir: str
+    """Directory of the package relative to the module root, in posix form."""
+    imports: List[str]
+    """Every package it imports, its tests' imports included."""
+
+
+def signature() -> str:
+    """
+    Hash the path, size and mtime of every go file along with go.mod and go.sum, so a
+    cached graph is only used while no package could have changed.
+    """
+    digest = hashlib.sha256()
+    for name in ("go.mod", "go.sum"):
+        if os.path.exists(name):
+            digest.update(name.encode())
+            digest.update(pathlib.Path(name).read_bytes())
+
+    for directory, dir_names, file_names in os.walk("."):
+        dir_names[:] = sorted(
+            d for d in dir_names if d not in SKIPPED_DIRS and not d.startswith(".")
+        )
+        for file_name in sorted(file_names):
+            if file_name.endswith(".go"):
+                path = os.path.join(directory, file_name)
+                stat = os.stat(path)
+                digest.update(f"{path}:{stat.st_size}:{stat.st_mtime_ns}\n".encode())
+    return digest.hexdigest()
+
+
+def decode_stream(text: str) -> Iterator[Dict]:
+    """Decode the concatenated json objects `go list -json` writes."""
+    decoder = json.JSONDecoder()
+    position = 0
+    while True:
+        while position < len(text) and text[position].isspace():
+            position += 1
+        if position >= len(text):
+            return
+        value, position = decoder.raw_decode(text, position)
+        yield value
+
+
+@dataclasses.dataclass
+class PackageIndex:
+    """Dataclass used to hold the packages of the main module and what they build."""
+
+    module: str
+    """Path of the main module."""
+    packages: Dict[str, GoPackage]
+    """The module's packages by import path."""
+    external: List[str]
+    """Non-standard packages of other modules the module's packages build with."""
+
+
+def list_packages() -> PackageIndex:
+    """Run `go list` over the module once and index the module's own packages."""
+    proc = script_trace.Popen(
+        ["go", "list", "-e", "-deps", "-json", "./..."],
+        stdout=subprocess.PIPE,
+        universal_newlines=True,
+    )
+    stdout, _ = proc.communicate()
+    if proc.returncode != 0:
+        sys.exit(proc.returncode)
+
+    root = os.getcwd()
+    index = PackageIndex(module="", packages=dict(), external=list())
+    for entry in decode_stream(stdout):
+        module = entry.get("Module") or dict()
+        if entry.get("Standard"):
+            continue
+        import_path = entry["ImportPath"]
+        if not module.get("Main"):
+            index.external.append(import_path)
+            continue
+
+        index.module = module.get("Path", "")
+        imports = dict.fromkeys(
+            entry.get("Imports", [])
+            + entry.get("TestImports", [])
+            + entry.get("XTestImports", [])
+        )
+        index.packages[import_path] = GoPackage(
+            import_path=import_path,
+            dir=pathlib.Path(os.path.relpath(entry["Dir"], root)).as_posix(),
+            imports=list(imports),
+        )
+    return index
+
+
+@script_trace.traced("load_packages")
+def load_index() -> PackageIndex:
+    """Return the module's package index, from the cache while it is still current."""
+    current = signature()
+    try:
+        data = json.loads(CACHE_PATH.read_text())
+        if data["signature"] == current:
+            return PackageIndex(
+                module=data["module"],
+                packages={p["import_path"]: GoPackage(**p) for p in data["packages"]},
+                external=data["external"],
+            )
+    except (OSError, ValueError, KeyError, TypeError):
+        pass
+
+    index = list_packages()
+    CACHE_PATH.parent.mkdir(parents=True, exist_ok=True)
+    temp_path = CACHE_PATH.with_name(CACHE_PATH.name + ".tmp")
+    temp_path.write_text(
+        json.dumps(
+            {
+                "signature": current,
+                "module": index.module,
+                "packages": [dataclasses.asdict(p) for p in index.packages.values()],
+                "external": index.external,
+            }
+        )
+    )
+    os.replace(str(temp_path), str(CACHE_PATH))
+    return index
+
+
+def pattern_regex(pattern: str) -> Pattern[str]:
+    """Compile a go package pattern, where `...` matches anything, like go does."""
+    regex = re.escape(pattern).replace(r"\.\.\.", ".*")
+    # "x/..." also matches x itself.
+    if regex.endswith("/.*"):
+        regex = regex[: -len("/.*")] + "(/.*)?"
+    return re.compile(f"^{regex}$")
+
+
+def match_pattern(pattern: Pattern[str], relative: bool, package: GoPackage) -> bool:
+    if relative:
+        return (
+            pattern.match(f"./{package.dir}" if package.dir != "." else ".") is not None
+        )
+    return pattern.match(package.import_path) is not None
+
+
+def select_packages(
+    index: PackageIndex, package_pattern: str, excludes: List[str]
+) -> List[str]:
+    """
+    Return the module's packages matching `package_pattern`, a go package pattern
+    such as ./..., leaving out those any of the `excludes` regexes is found in, the
+    way `grep -v -e` would.
+    """
+    relative = package_pattern.startswith(".")
+    pattern = pattern_regex(package_pattern)
+    exclude_regexes = list()
+    for exclude in excludes:
+        try:
+            exclude_regexes.append(re.compile(exclude))
+        except re.error as error:
+            # These used to go to grep as basic regexes, which python reads differently.
+            sys.stderr.write(f"bad exclude pattern {exclude!r}: {error}\n")
+            sys.exit(1)
+    return [
+        import_path
+        for import_path, package in sorted(index.packages.items())
+        if match_pattern(pattern, relative, package)
+        and not any(r.search(import_path) for r in exclude_regexes)
+    ]
+
+
+def is_below(import_path: str, prefix: str) -> bool:
+    return import_path == prefix or import_path.startswith(f"{prefix}/")
+
+
+def ancestors(import_path: str) -> List[str]:
+    """Return `import_path` and every path above it, widest first."""
+    parts = import_path.split("/")
+    return ["/".join(parts[:depth]) for depth in range(1, len(parts) + 1)]
+
+
+def compress_patterns(index: PackageIndex, selected: List[str]) -> List[str]:
+    """
+    Replace runs of selected packages with `prefix/...` wherever that matches exactly
+    the same packages of the build: every package of the module below the prefix is
+    selected, and no package of another module lives below it.
+    """
+    chosen = set(selected)
+    total: Dict[str, int] = dict()
+    picked: Dict[str, int] = dict()
+    for import_path in index.packages:
+        for prefix in ancestors(import_path):
+            total[prefix] = total.get(prefix, 0) + 1
+            if import_path in chosen:
+                picked[prefix] = picked.get(prefix, 0) + 1
+
+    blocked: Set[str] = set()
+    for import_path in index.external:
+        blocked.update(ancestors(import_path))
+    for package in index.packages.values():
+        for imported in package.imports:
+            if imported not in index.packages:
+                blocked.update(ancestors(imported))
+
+    def covers(prefix: str) -> bool:
+        return (
+            bool(index.module)
+            and is_below(prefix, index.module)
+            and total.get(prefix, 0) > 1
+            and picked.get(prefix, 0) == total[prefix]
+            and prefix not in blocked
+        )
+
+    patterns: List[str] = list()
+    for import_path in sorted(chosen):
+        pattern = import_path
+        for prefix in ancestors(import_path):
+            if covers(prefix):
+                pattern = f"{prefix}/..."
+                break
+        patterns.append(pattern)
+    return list(dict.fromkeys(patterns))
+
+
+def run_git(arguments: List[str]) -> List[str]:
+    proc = script_trace.Popen(
+        ["git", *arguments],
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE,
+        universal_newlines=True,
+    )
+    stdout, stderr = proc.communicate()
+    if proc.returncode != 0:
+        reason = stderr.strip().split("\n")[0] if stderr.strip() else "failed"
+        raise RuntimeError(f"git {' '.join(arguments)}: {reason}")
+    return [line for line in stdout.split("\n") if line]
+
+
+def changed_files(base_ref: str) -> List[str]:
+    """
+    Return the files, relative to the working directory, which differ between the
+    merge base of `base_ref` and the working tree, untracked files included.
+    """
+    changed = run_git(["diff", "--name-only", "--relative", f"{base_ref}...HEAD"])
+    changed += run_git(["diff", "--name-only", "--relative", "HEAD"])
+    changed += run_git(["ls-files", "--others", "--exclude-standard"])
+    return list(dict.fromkeys(changed))
+
+
+def affected_packages(index: PackageIndex, changed: List[str]) -> Optional[Set[str]]:
+    """
+    Return the packages containing a changed file and every package which imports
+    one of them, directly or not, or `None` when everything has to be tested.
+    """
+    if any(path in FULL_RUN_FILES for path in changed):
+        return None
+
+    packages = index.packages
+    by_dir = {package.dir: package.import_path for package in packages.values()}
+    affected: Set[str] = set()
+    for path in changed:
+        # Files in a package's subdirectories, like testdata, belong to the package.
+        directory = pathlib.PurePosixPath(path).parent
+        while True:
+            import_path = by_dir.get(directory.as_posix())
+            if import_path is not None:
+                affected.add(import_path)
+                break
+            if directory == directory.parent:
+                break
+            directory = directory.parent
+
+    importers: Dict[str, List[str]] = dict()
+    for package in packages.values():
+        for imported in package.imports:
+            importers.setdefault(imported, list()).append(package.import_path)
+
+    pending = list(affected)
+    while pending:
+        for importer in importers.get(pending.pop(), []):
+            if importer not in affected:
+                affected.add(importer)
+                pending.append(importer)
+    return affected
@@ -0,0 +1,163 @@
+import time
+import pathlib
+import sqlite3
+import statistics
+import dataclasses
+from typing import Dict, Iterable, List, Tuple
+
+import go_test_report
+
+"""
+keeps the durations of every test and package across runs in a small sqlite store, to
+report the slowest tests and the ones that got slower, and to balance test shards
+"""
+
+HISTORY_PATH = pathlib.Path("./zdevelop/.cache/test_history.sqlite3")
+KEEP_RUNS = 50
+"""How many runs to keep, older ones are dropped."""
+BASELINE_RUNS = 5
+"""How many earlier passing runs a test's duration is compared against."""
+NOISE_SECONDS = 0.05
+"""Slowdowns smaller than this are never reported, however large in proportion."""
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS runs (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    started REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS durations (
+    run_id INTEGER NOT NULL REFERENCES runs(id) ON DELETE CASCADE,
+    package TEXT NOT NULL,
+    test TEXT NOT NULL,
+    status TEXT NOT NULL,
+    elapsed REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS durations_by_test ON durations (package, test, run_id);
+CREATE INDEX IF NOT EXISTS durations_by_run ON durations (run_id);
+"""
+
+
+@dataclasses.dataclass
+class Regression:
+    """Dataclass used to hold a test which took longer than it used to."""
+
+    package: str
+    """Import path of the test's package."""
+    test: str
+    """Name of the test."""
+    elapsed: float
+    """Seconds the test took in this run."""
+    baseline: float
+    """Median seconds it took over its last passing runs."""
+
+    def describe(self) -> str:
+        description = (
+            f"{self.package} {self.test}: {self.elapsed:.2f}s, was {self.baseline:.2f}s"
+        )
+        if self.baseline > 0:
+            description += f" (+{self.elapsed / self.baseline - 1:.0%})"
+        return description
+
+
+def connect(history_path: pathlib.Path = HISTORY_PATH) -> sqlite3.Connection:
+    history_path.parent.mkdir(parents=True, exist_ok=True)
+    connection = sqlite3.connect(str(history_path))
+    connection.execute("PRAGMA foreign_keys = ON")
+    connection.executescript(SCHEMA)
+    return connection
+
+
+def record_run(
+    connection: sqlite3.Connection, records: Iterable[go_test_report.TestRecord]
+) -> int:
+    """Store the durations of a run, dropping the oldest runs, and return its id."""
+    with connection:
+        cursor = connection.execute(
+            "INSERT INTO runs (started) VALUES (?)", (time.time(),)
+        )
+        run_id = cursor.lastrowid
+        assert run_id is not None
+        connection.executemany(
+            "INSERT INTO durations (run_id, package, test, status, elapsed) "
+            "VALUES (?, ?, ?, ?, ?)",
+            (
+                (run_id, r.package, r.test, r.status, r.elapsed)
+                for r in records
+                if r.status != go_test_report.INCOMPLETE
+            ),
+        )
+        connection.execute(
+            "DELETE FROM runs WHERE id NOT IN "
+            "(SELECT id FROM runs ORDER BY id DESC LIMIT ?)",
+            (KEEP_RUNS,),
+        )
+    return run_id
+
+
+def slowest_tests(
+    connection: sqlite3.Connection, run_id: int, limit: int
+) -> List[Tuple[str, str, float]]:
+    """Return the (package, test, seconds) of the slowest top level tests of a run."""
+    rows = connection.execute(
+        "SELECT package, test, elapsed FROM durations "
+        "WHERE run_id = ? AND test != '' AND instr(test, '/') = 0 "
+        "ORDER BY elapsed DESC LIMIT ?",
+        (run_id, limit),
+    )
+    return [(package, test, elapsed) for package, test, elapsed in rows]
+
+
+def baselines(
+    connection: sqlite3.Connection, before_run_id: int, package_rows: bool
+) -> Dict[Tuple[str, str], float]:
+    """
+    Return the median duration of every test, or package, over its last passing
+    runs before `before_run_id`.
+    """
+    test_filter = "test = ''" if package_rows else "test != ''"
+    rows = connection.execute(
+        "SELECT package, test, elapsed FROM ("
+        "  SELECT package, test, elapsed, ROW_NUMBER() OVER ("
+        "    PARTITION BY package, test ORDER BY run_id DESC"
+        "  ) AS age FROM durations"
+        f"  WHERE run_id < ? AND status = 'pass' AND {test_filter}"
+        ") WHERE age <= ?",
+        (before_run_id, BASELINE_RUNS),
+    )
+    history: Dict[Tuple[str, str], List[float]] = dict()
+    for package, test, elapsed in rows:
+        history.setdefault((package, test), list()).append(elapsed)
+    return {key: statistics.median(values) for key, values in history.items()}
+
+
+def find_regressions(
+    connection: sqlite3.Connection, run_id: int, threshold: float
+) -> List[Regression]:
+    """
+    Return the passing top level tests of a run which took longer than their
+    baseline by more than the fraction `threshold`, the biggest slowdowns first.
+    """
+    baseline = baselines(connection, run_id, package_rows=False)
+    regressions = list()
+    rows = connection.execute(
+        "SELECT package, test, elapsed FROM durations WHERE run_id = ? "
+        "AND status = 'pass' AND test != '' AND instr(test, '/') = 0",
+        (run_id,),
+    )
+    for package, test, elapsed in rows:
+        previous = baseline.get((package, test))
+        if (
+            previous is not None
+            and elapsed - previous > NOISE_SECONDS
+            and elapsed > previous * (1 + threshold)
+        ):
+            regressions.append(Regression(package, test, elapsed, previous))
+    return sorted(regressions, key=lambda r: r.elapsed - r.baseline, reverse=True)
+
+
+def package_durations(connection: sqlite3.Connection) -> Dict[str, float]:
+    """Return the typical duration of every package that has passed before."""
+    latest = connection.execute("SELECT COALESCE(MAX(id), 0) + 1 FROM runs")
+    (next_run_id,) = latest.fetchone()
+    durations = baselines(connection, next_run_id, package_rows=True)
+    return {package: elapsed for (package, _), elapsed in durations.items()}
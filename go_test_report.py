@@ -0,0 +1,256 @@
+import json
+import html
+import shutil
+import pathlib
+import dataclasses
+from typing import IO, Any, Dict, List, Optional, Tuple
+
+"""
+turns the event stream of `go test -json` into per-test records, an index of where
+each test's output lives in the plain text log, read back from the log on demand, and
+an html report written as tests finish which links the output of failed tests
+"""
+
+PASS = "pass"
+FAIL = "fail"
+SKIP = "skip"
+INCOMPLETE = "incomplete"
+"""Status of a test that never reported a result, e.g. after a panic or timeout."""
+FINISH_ACTIONS = (PASS, FAIL, SKIP)
+LINKED_STATUSES = (FAIL, INCOMPLETE)
+"""Statuses whose output is copied to a file of its own the report links to."""
+BUILD_OUTPUT = "build-output"
+BUILD_FAIL = "build-fail"
+COPY_CHUNK_BYTES = 1024 * 1024
+SHOW_OUTPUT_HINT = (
+    "Print the output of any test from the log with: go_make_test.py --show=TEST, "
+    "or --show=PACKAGE for a whole package."
+)
+
+REPORT_HEAD = """<!DOCTYPE html>
+<html>
+<head>
+<meta charset="utf-8">
+<title>Test Results</title>
+<style>
+body { font-family: sans-serif; }
+table { border-collapse: collapse; }
+td, th { padding: 2px 8px; text-align: left; }
+tr.pass td.status { color: #2a7d2a; }
+tr.fail td.status { color: #c62828; font-weight: bold; }
+tr.skip td.status, tr.incomplete td.status { color: #b26a00; }
+tr.package td { border-top: 1px solid #ccc; font-weight: bold; }
+</style>
+</head>
+<body>
+<h1>Test Results</h1>
+<table>
+<tr><th>status</th><th>package</th><th>test</th><th>seconds</th><th>output</th></tr>
+"""
+
+
+@dataclasses.dataclass
+class TestRecord:
+    """Dataclass used to hold the result of one test, or of a whole package."""
+
+    package: str
+    """Import path of the package the test belongs to."""
+    test: str
+    """Name of the test, empty for the record of the package itself."""
+    status: str = INCOMPLETE
+    """One of pass, fail, skip or incomplete."""
+    elapsed: float = 0.0
+    """Seconds the test took, as reported by go test."""
+    segments: List[List[int]] = dataclasses.field(default_factory=list)
+    """[offset, length] byte ranges of the test's output in the stdout log."""
+    output_path: str = ""
+    """Where the output of a failed test was copied, relative to the report."""
+
+    def add_output(self, offset: int, length: int) -> None:
+        if self.segments and sum(self.segments[-1]) == offset:
+            self.segments[-1][1] += length
+        else:
+            self.segments.append([offset, length])
+
+    def output_bytes(self) -> int:
+        return sum(length for _, length in self.segments)
+
+    def to_json(self) -> Dict[str, Any]:
+        return dataclasses.asdict(self)
+
+
+def copy_output(
+    log_path: pathlib.Path, segments: List[List[int]], destination: IO[bytes]
+) -> None:
+    """Copy the output a record indexes out of the stdout log to `destination`."""
+    with log_path.open("rb") as log:
+        for offset, length in segments:
+            log.seek(offset)
+            while length > 0:
+                chunk = log.read(min(length, COPY_CHUNK_BYTES))
+                if not chunk:
+                    break
+                destination.write(chunk)
+                length -= len(chunk)
+
+
+def load_index(index_path: pathlib.Path) -> List[TestRecord]:
+    """Load every record from a test index."""
+    records = list()
+    with index_path.open() as index:
+        for line in index:
+            if line.strip():
+                records.append(TestRecord(**json.loads(line)))
+    return records
+
+
+class TestEventSink:
+    """
+    Consumes `go test -json` output a line at a time. The output of every event is
+    echoed to `streams` and appended to the stdout log, and each test's record keeps
+    the byte ranges of its output there, to be read back with `copy_output`. When a
+    test finishes its record is appended to the index and a row to the report, so
+    only tests still running are held in memory. Only the output of tests which fail
+    or never finish is copied to a file of its own for the report to link to, the
+    rest stays in the log.
+
+    Compiler errors come as build-output events keyed by the import path being
+    built, and are kept with the record of that package.
+
+    Lines may come in pieces of bounded length. go test splits long output over
+    several events, so a line too long to arrive whole is no event and goes to the
+    log as it is.
+    """
+
+    def __init__(
+        self,
+        log_path: pathlib.Path,
+        index_path: pathlib.Path,
+        report_path: pathlib.Path,
+        streams: List[IO[str]],
+    ) -> None:
+        self.log_path = log_path
+        self.report_path = report_path
+        self.streams = streams
+        self.running: Dict[Tuple[str, str], TestRecord] = dict()
+        self.counts: Dict[str, int] = {PASS: 0, FAIL: 0, SKIP: 0, INCOMPLETE: 0}
+        self.partial = False
+        """Whether the last piece handed over ended mid line."""
+        self.output_dir = report_path.with_name(report_path.stem + "_output")
+        self.linked = 0
+
+        if self.output_dir.exists():
+            shutil.rmtree(str(self.output_dir))
+        self.output_dir.mkdir(parents=True)
+        self.log = log_path.open("wb")
+        self.offset = 0
+        self.index = index_path.open("w")
+        self.report = report_path.open("w")
+        self.report.write(REPORT_HEAD)
+        self.report.flush()
+
+    def handle_line(self, line: str) -> None:
+        if self.partial or not line.endswith("\n"):
+            self.partial = not line.endswith("\n")
+            self.write_output(line, None)
+            return
+
+        try:
+            event = json.loads(line)
+        except ValueError:
+            # go test writes some build output as plain text, keep it in the log.
+            self.write_output(line, None)
+            return
+        if not isinstance(event, dict):
+            self.write_output(line, None)
+            return
+        self.handle_event(event)
+
+    def handle_event(self, event: Dict[str, Any]) -> None:
+        action = event.get("Action", "")
+        package = event.get("Package") or ""
+        if not package and action in (BUILD_OUTPUT, BUILD_FAIL):
+            # The import path of a test build reads "pkg [pkg.test]".
+            package = (event.get("ImportPath") or "").split(" ", 1)[0]
+        key = (package, event.get("Test") or "")
+
+        record = self.running.get(key)
+        if record is None and package and action not in ("pause", "cont"):
+            record = TestRecord(package=key[0], test=key[1])
+            self.running[key] = record
+
+        if action in ("output", BUILD_OUTPUT):
+            self.write_output(event.get("Output") or "", record)
+        elif action == BUILD_FAIL and record is not None:
+            # The package's own fail event, if it comes, finishes the record.
+            record.status = FAIL
+        elif action in FINISH_ACTIONS and record is not None:
+            record.status = action
+            record.elapsed = float(event.get("Elapsed") or 0.0)
+            self.finish(self.running.pop(key))
+
+    def write_output(self, text: str, record: Optional[TestRecord]) -> None:
+        for stream in self.streams:
+            stream.write(text)
+            stream.flush()
+
+        data = text.encode("utf-8")
+        self.log.write(data)
+        if record is not None:
+            record.add_output(self.offset, len(data))
+        self.offset += len(data)
+
+    def finish(self, record: TestRecord) -> None:
+        self.counts[record.status] = self.counts.get(record.status, 0) + 1
+
+        if record.segments and record.status in LINKED_STATUSES:
+            self.linked += 1
+            self.log.flush()
+            output_file = self.output_dir / f"{self.linked:06d}.txt"
+            with output_file.open("wb") as output:
+                copy_output(self.log_path, record.segments, output)
+            record.output_path = (
+                pathlib.Path(self.output_dir.name) / output_file.name
+            ).as_posix()
+
+        self.index.write(json.dumps(record.to_json()) + "\n")
+        self.index.flush()
+        self.report.write(report_row(record))
+        self.report.flush()
+
+    def close(self) -> None:
+        """Record tests that never finished and complete the report."""
+        # Tests come before the package whose failure cut them short.
+        for key in sorted(self.running, key=lambda k: (k[0], k[1] == "", k[1])):
+            self.finish(self.running[key])
+        self.running.clear()
+
+        summary = ", ".join(
+            f"{count} {status}" for status, count in self.counts.items()
+        )
+        self.report.write(
+            f"</table>\n<p>{html.escape(summary)}</p>\n"
+            f"<p>{html.escape(SHOW_OUTPUT_HINT)}</p>\n</body>\n</html>\n"
+        )
+        for stream in (self.report, self.index, self.log):
+            stream.close()
+
+    def __enter__(self) -> "TestEventSink":
+        return self
+
+    def __exit__(self, *exc_info: Any) -> None:
+        self.close()
+
+
+def report_row(record: TestRecord) -> str:
+    row_class = record.status if record.test else f"{record.status} package"
+    output = ""
+    if record.output_path:
+        output = f'<a href="{html.escape(record.output_path)}">output</a>'
+    elif record.segments:
+        output = f"{record.output_bytes()} bytes"
+    return (
+        f'<tr class="{row_class}"><td class="status">{record.status}</td>'
+        f"<td>{html.escape(record.package)}</td><td>{html.escape(record.test)}</td>"
+        f"<td>{record.elapsed:.2f}</td><td>{output}</td></tr>\n"
+    )
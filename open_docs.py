@@ -1,7 +1,8 @@
 import platform
-import subprocess
 import sys
 
+import script_trace
+
 PLATFORM = platform.system()
 
 if __name__ == "__main__":
@@ -20,4 +21,4 @@ if __name__ == "__main__":
 
     command1 = [command_base, doc_index]
 
-    subprocess.Popen(command1, stdout=sys.stdout, stderr=sys.stderr).communicate()
+    script_trace.Popen(command1, stdout=sys.stdout, stderr=sys.stderr).communicate()
@@ -0,0 +1,450 @@
+import os
+import sys
+import json
+import time
+import shutil
+import pathlib
+import platform
+import resource
+import tempfile
+import dataclasses
+import multiprocessing
+from typing import Any, Callable, Dict, List, Tuple
+
+import proto_run
+import proto_manifest
+import go_gen_proto
+import py_gen_proto
+
+"""
+benchmarks the phases of the proto generation pipeline over synthetic proto trees and
+generated file corpora, with stub protoc and protoc-go-inject-tag executables so it
+runs offline. usage:
+
+    python proto_bench.py [size ...] [--repeat=N] [--output=path.json]
+"""
+
+DEFAULT_SIZES: List[int] = [10, 100, 1000, 10000]
+FILES_PER_PACKAGE = 10
+MESSAGES_PER_FILE = 5
+FIELDS_PER_MESSAGE = 6
+EXCLUDED_SHARE = 10
+"""One in this many synthetic protos lands in a directory discovery must prune."""
+GO_MODULE = "example.com/bench"
+ORIGINAL_IMPORT = "proto."
+NEW_IMPORT = "bench."
+SERIALIZED_DESCRIPTOR_BYTES = 4096
+"""Size of the fake serialized descriptor embedded in every _pb2.py file."""
+RESULT_VERSION = 1
+
+STUB_PROTOC = """
+import os
+import sys
+
+args = sys.argv[1:]
+if "--version" in args:
+    print("libprotoc 0.0.0-bench")
+    sys.exit(0)
+
+outputs = {}
+for arg in args:
+    if arg.startswith("--go_out="):
+        outputs[".pb.go"] = arg.split(":", 1)[-1]
+    elif arg.startswith("--python_out="):
+        outputs["_pb2.py"] = arg.split("=", 1)[1]
+    elif arg.startswith("--mypy_out="):
+        outputs["_pb2.pyi"] = arg.split("=", 1)[1]
+    elif arg.startswith("--python_grpc_out="):
+        outputs["_grpc.py"] = arg.split("=", 1)[1]
+    elif arg.startswith("--descriptor_set_out="):
+        open(arg.split("=", 1)[1], "wb").close()
+
+for proto in (a for a in args if a.endswith(".proto")):
+    for suffix, directory in outputs.items():
+        path = os.path.join(directory, proto[: -len(".proto")] + suffix)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, "w") as f:
+            f.write(CONTENTS[suffix])
+"""
+
+STUB_INJECT_TAG = """
+import sys
+
+path = next(a.split("=", 1)[1] for a in sys.argv[1:] if a.startswith("-input="))
+with open(path, "rb") as f:
+    f.read()
+"""
+
+
+@dataclasses.dataclass
+class Workspace:
+    """Dataclass used to hold a synthetic tree the phases run against."""
+
+    size: int
+    """Number of protos discovery should find."""
+    proto_files: List[str]
+    """The protos discovery should find."""
+    bin_dir: pathlib.Path
+    """Directory holding the stub executables."""
+
+
+@dataclasses.dataclass
+class PhaseResult:
+    """Dataclass used to hold the measurements of one phase at one size."""
+
+    phase: str
+    """Name of the measured phase."""
+    size: int
+    """Number of protos in the synthetic tree."""
+    seconds: List[float]
+    """Wall time of every repetition."""
+    best_seconds: float
+    """Fastest repetition."""
+    peak_rss_kb: int
+    """Highest peak resident set size of the benchmark process across repetitions."""
+    baseline_rss_kb: int
+    """Peak resident set size the process had before the phase started."""
+    children_peak_rss_kb: int
+    """Highest peak resident set size of any subprocess the phase started."""
+
+
+def message_names(package: int, index: int) -> List[str]:
+    return [f"P{package}F{index}M{m}" for m in range(MESSAGES_PER_FILE)]
+
+
+def proto_source(package: int, index: int) -> str:
+    lines = ['syntax = "proto3";', "", f"package bench.pkg{package};", ""]
+    if index > 0:
+        lines.append(f'import "proto/bench/pkg{package}/f{index - 1}.proto";')
+    elif package > 0:
+        lines.append(f'import "proto/bench/pkg{package - 1}/f0.proto";')
+    lines.append("")
+
+    for name in message_names(package, index):
+        lines.append(f"message {name} {{")
+        for field in range(FIELDS_PER_MESSAGE):
+            lines.append(f'  // @inject_tag: bson:"field_{field}"')
+            lines.append(f"  string field_{field} = {field + 1};")
+        lines.append("}")
+        lines.append("")
+
+    return "\n".join(lines)
+
+
+def go_source() -> str:
+    lines = ["package bench", ""]
+    for name in message_names(0, 0):
+        lines.append(f"type {name} struct {{")
+        lines.append("\tstate         protoimpl.MessageState")
+        lines.append('\tXXX_unrecognized []byte `json:"-"`')
+        lines.append("")
+        for field in range(FIELDS_PER_MESSAGE):
+            lines.append(f'\t// @inject_tag: bson:"field_{field}"')
+            lines.append(
+                f"\tField{field} string "
+                f'`protobuf:"bytes,{field + 1},opt,name=field_{field},proto3" '
+                f'json:"field_{field},omitempty"`'
+            )
+        lines.append("}")
+        lines.append("")
+    return "\n".join(lines)
+
+
+def python_source(pyi: bool) -> str:
+    lines = [
+        "from google.protobuf import descriptor as _descriptor",
+        f"from {ORIGINAL_IMPORT}bench.pkg0 import f0_pb2 as _f0_pb2",
+        f"import {ORIGINAL_IMPORT}bench.pkg1.f1_pb2",
+        "",
+    ]
+    if pyi:
+        lines.append(f"field: typing.List[{ORIGINAL_IMPORT}bench.pkg0.f0_pb2.M]")
+    else:
+        descriptor = "x" * SERIALIZED_DESCRIPTOR_BYTES
+        lines.append(f"DESCRIPTOR = _descriptor.FileDescriptor(b'{descriptor}')")
+        lines.append(f"dependencies = [{ORIGINAL_IMPORT}bench.pkg0.f0_pb2]")
+    return "\n".join(lines) + "\n"
+
+
+def write_stub(bin_dir: pathlib.Path, name: str, source: str) -> None:
+    path = bin_dir / name
+    path.write_text(f"#!{sys.executable}\n{source}")
+    path.chmod(0o755)
+
+
+def make_workspace(size: int) -> Workspace:
+    """
+    Synthesize a tree of `size` protos, plus protos in excluded directories, in the
+    working directory, along with stub executables.
+    """
+    proto_files: List[str] = list()
+    for number in range(size):
+        package, index = divmod(number, FILES_PER_PACKAGE)
+        path = pathlib.Path("proto", "bench", f"pkg{package}", f"f{index}.proto")
+        path.parent.mkdir(parents=True, exist_ok=True)
+        path.write_text(proto_source(package, index))
+        proto_files.append(path.as_posix())
+
+    for number in range(max(size // EXCLUDED_SHARE, 1)):
+        for excluded in ("vendor", "google"):
+            path = pathlib.Path("proto", excluded, f"pkg{number}", "x.proto")
+            path.parent.mkdir(parents=True, exist_ok=True)
+            path.write_text(proto_source(0, 0))
+
+    bin_dir = pathlib.Path("bin").absolute()
+    bin_dir.mkdir()
+    contents = {
+        ".pb.go": go_source(),
+        "_pb2.py": python_source(pyi=False),
+        "_pb2.pyi": python_source(pyi=True),
+        "_grpc.py": python_source(pyi=False),
+    }
+    write_stub(bin_dir, "protoc", f"CONTENTS = {contents!r}\n{STUB_PROTOC}")
+    write_stub(bin_dir, "protoc-gen-go", "")
+    write_stub(bin_dir, go_gen_proto.EXTERNAL_TAG_ENGINE, STUB_INJECT_TAG)
+
+    return Workspace(size=size, proto_files=sorted(proto_files), bin_dir=bin_dir)
+
+
+def write_go_corpus(workspace: Workspace) -> List[pathlib.Path]:
+    source = go_source()
+    paths = [
+        pathlib.Path(f[: -len(".proto")] + ".pb.go") for f in workspace.proto_files
+    ]
+    for path in paths:
+        path.write_text(source)
+    return paths
+
+
+def write_python_corpus(workspace: Workspace) -> List[pathlib.Path]:
+    paths: List[pathlib.Path] = list()
+    for proto_file in workspace.proto_files:
+        stem = proto_file[: -len(".proto")]
+        for suffix in py_gen_proto.GENERATED_SUFFIXES:
+            path = pathlib.Path(stem + suffix)
+            path.write_text(python_source(pyi=suffix.endswith(".pyi")))
+            paths.append(path)
+    return paths
+
+
+def go_options(
+    tag_engine: str = go_gen_proto.NATIVE_TAG_ENGINE,
+) -> go_gen_proto.Options:
+    return go_gen_proto.Options(
+        proto_root_dir=pathlib.Path("proto"),
+        go_module_root=pathlib.Path(GO_MODULE),
+        jobs=os.cpu_count() or 1,
+        descriptor_cache=False,
+        exclude=go_gen_proto.DEFAULT_EXCLUDES,
+        tag_engine=tag_engine,
+    )
+
+
+def py_options() -> py_gen_proto.Options:
+    return py_gen_proto.Options(
+        proto_root_dir=pathlib.Path("proto"),
+        output_dir=pathlib.Path("."),
+        original_import=ORIGINAL_IMPORT,
+        new_import=NEW_IMPORT,
+        jobs=os.cpu_count() or 1,
+        exclude=py_gen_proto.DEFAULT_EXCLUDES,
+        protoc_mode=py_gen_proto.SUBPROCESS_PROTOC_MODE,
+    )
+
+
+def plan(workspace: Workspace) -> proto_manifest.BuildPlan:
+    return proto_manifest.plan_build(
+        go_gen_proto.MANIFEST_PATH,
+        workspace.proto_files,
+        "bench",
+        go_gen_proto.PROTO_INCLUDE_ROOTS,
+    )
+
+
+def setup_nothing(workspace: Workspace) -> Any:
+    return None
+
+
+def setup_cold_cache(workspace: Workspace) -> Any:
+    shutil.rmtree(str(proto_manifest.CACHE_DIR), ignore_errors=True)
+
+
+def setup_warm_cache(workspace: Workspace) -> Any:
+    proto_manifest.commit_build(plan(workspace))
+
+
+def setup_protoc(workspace: Workspace) -> Any:
+    graph = plan(workspace).graph
+    stage_dir = pathlib.Path("stage")
+    shutil.rmtree(str(stage_dir), ignore_errors=True)
+    stage_dir.mkdir()
+    return graph, stage_dir
+
+
+def run_protoc_go(workspace: Workspace, context: Any) -> None:
+    graph, stage_dir = context
+    go_gen_proto.run_protoc_command(
+        workspace.proto_files, graph, go_options(), None, stage_dir
+    )
+
+
+def run_protoc_py(workspace: Workspace, context: Any) -> None:
+    # py_gen_proto runs the protoc bundled with grpc_tools, so pass the arguments it
+    # builds to the stub in its subprocess mode instead.
+    graph, stage_dir = context
+    options = py_options()
+    shards = proto_run.shard_files(workspace.proto_files, graph, options.jobs)
+    commands = [
+        ["protoc", *py_gen_proto.build_protoc_arguments(s, options, stage_dir)]
+        for s in shards
+    ]
+    if proto_run.run_commands(commands, options.jobs) != 0:
+        sys.exit(1)
+
+
+def run_fix_import_paths(workspace: Workspace, paths: Any) -> None:
+    options = py_options()
+    for path in paths:
+        py_gen_proto.fix_import_paths(path, pyi=path.suffix == ".pyi", options=options)
+
+
+PHASES: Dict[
+    str, Tuple[Callable[[Workspace], Any], Callable[[Workspace, Any], Any]]
+] = {
+    "find_proto_files": (
+        setup_nothing,
+        lambda w, _: go_gen_proto.find_proto_files(go_options()),
+    ),
+    "plan_build_cold": (setup_cold_cache, lambda w, _: plan(w)),
+    "plan_build_warm": (setup_warm_cache, lambda w, _: plan(w)),
+    "protoc_go": (setup_protoc, run_protoc_go),
+    "protoc_py": (setup_protoc, run_protoc_py),
+    "add_bson_tags_native": (
+        write_go_corpus,
+        lambda w, paths: go_gen_proto.add_bson_tags(paths, go_options()),
+    ),
+    "add_bson_tags_external": (
+        write_go_corpus,
+        lambda w, paths: go_gen_proto.add_bson_tags(
+            paths, go_options(go_gen_proto.EXTERNAL_TAG_ENGINE)
+        ),
+    ),
+    "fix_import_paths": (write_python_corpus, run_fix_import_paths),
+    "fix_generated_files": (
+        write_python_corpus,
+        lambda w, paths: py_gen_proto.fix_generated_files(paths, py_options()),
+    ),
+}
+"""Setup, which is not timed, and the timed run of every phase, by name."""
+
+
+def measure_phase(workspace: Workspace, phase: str, connection: Any) -> None:
+    """
+    Set up and time one phase, sending the measurements down `connection`. Runs in a
+    fresh forked process so the in-memory caches and peak memory of one phase never
+    leak into the next.
+    """
+    devnull = os.open(os.devnull, os.O_WRONLY)
+    os.dup2(devnull, 1)
+
+    setup, run = PHASES[phase]
+    context = setup(workspace)
+    baseline = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+    started = time.perf_counter()
+    run(workspace, context)
+    seconds = time.perf_counter() - started
+
+    connection.send(
+        {
+            "seconds": seconds,
+            "peak_rss_kb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+            "baseline_rss_kb": baseline,
+            "children_peak_rss_kb": resource.getrusage(
+                resource.RUSAGE_CHILDREN
+            ).ru_maxrss,
+        }
+    )
+    connection.close()
+
+
+def run_phase(workspace: Workspace, phase: str, repeat: int) -> PhaseResult:
+    context = multiprocessing.get_context("fork")
+    samples: List[Dict[str, Any]] = list()
+    for _ in range(repeat):
+        receiver, sender = context.Pipe(duplex=False)
+        process = context.Process(target=measure_phase, args=(workspace, phase, sender))
+        process.start()
+        sender.close()
+        try:
+            samples.append(receiver.recv())
+        except EOFError:
+            process.join()
+            raise RuntimeError(f"{phase} failed with exit code {process.exitcode}")
+        process.join()
+
+    seconds = [sample["seconds"] for sample in samples]
+    return PhaseResult(
+        phase=phase,
+        size=workspace.size,
+        seconds=[round(s, 6) for s in seconds],
+        best_seconds=round(min(seconds), 6),
+        peak_rss_kb=max(sample["peak_rss_kb"] for sample in samples),
+        baseline_rss_kb=min(sample["baseline_rss_kb"] for sample in samples),
+        children_peak_rss_kb=max(s["children_peak_rss_kb"] for s in samples),
+    )
+
+
+def run_benchmarks(sizes: List[int], repeat: int) -> Dict[str, Any]:
+    """Run every phase at every size, each size in a temporary directory."""
+    results: List[PhaseResult] = list()
+    original_dir = os.getcwd()
+    original_path = os.environ.get("PATH", "")
+
+    for size in sizes:
+        temp_dir = tempfile.mkdtemp(prefix=f"proto_bench_{size}_")
+        try:
+            os.chdir(temp_dir)
+            workspace = make_workspace(size)
+            os.environ["PATH"] = f"{workspace.bin_dir}{os.pathsep}{original_path}"
+            for phase in PHASES:
+                result = run_phase(workspace, phase, repeat)
+                sys.stderr.write(
+                    f"{size:>6} {phase:<24} {result.best_seconds:>10.4f}s "
+                    f"{result.peak_rss_kb:>9}kb\n"
+                )
+                results.append(result)
+        finally:
+            os.environ["PATH"] = original_path
+            os.chdir(original_dir)
+            shutil.rmtree(temp_dir, ignore_errors=True)
+
+    return {
+        "version": RESULT_VERSION,
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpu_count": os.cpu_count(),
+        "repeat": repeat,
+        "results": [dataclasses.asdict(result) for result in results],
+    }
+
+
+def main() -> None:
+    sizes = [int(arg) for arg in sys.argv[1:] if arg.isdigit()] or DEFAULT_SIZES
+    repeat = 1
+    output = None
+    for arg in sys.argv[1:]:
+        if arg.startswith("--repeat="):
+            repeat = max(int(arg.split("=", 1)[1]), 1)
+        elif arg.startswith("--output="):
+            output = pathlib.Path(arg.split("=", 1)[1]).absolute()
+
+    report = json.dumps(run_benchmarks(sizes, repeat), indent=2)
+    if output is None:
+        sys.stdout.write(report + "\n")
+    else:
+        output.write_text(report + "\n")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,204 @@
+import os
+import sys
+import json
+import shutil
+import hashlib
+import pathlib
+from typing import Dict, Iterable, List, Optional, Set
+
+import proto_run
+import proto_graph
+import py_gen_proto
+import script_trace
+import proto_manifest
+
+"""
+parses a proto tree once into a FileDescriptorSet cached on disk so the go, python and
+docs generators can all generate from it instead of each parsing the tree again
+"""
+
+DESCRIPTOR_DIR: pathlib.Path = proto_manifest.CACHE_DIR / "descriptors"
+MAX_CACHED_SETS = 8
+"""Number of descriptor sets kept on disk before the oldest are removed."""
+PARSED_PATH: pathlib.Path = proto_manifest.CACHE_DIR / "descriptor_files.json"
+"""The contents every proto had when it was last parsed into a set."""
+
+
+def last_used(index_path: pathlib.Path) -> float:
+    """Return when a cached set was last used, 0 if another run just removed it."""
+    try:
+        return index_path.stat().st_mtime
+    except FileNotFoundError:
+        return 0.0
+
+
+def cached_indexes() -> List[pathlib.Path]:
+    """Return the index of every cached set, the most recently used first."""
+    if not DESCRIPTOR_DIR.exists():
+        return list()
+    return sorted(DESCRIPTOR_DIR.glob("*.json"), key=last_used, reverse=True)
+
+
+def parser_version() -> str:
+    """Return the version of the protoc `run_descriptor_command` parses with."""
+    if shutil.which("protoc") is not None:
+        return proto_manifest.tool_version(["protoc", "--version"])
+    return py_gen_proto.grpc_tools_version()
+
+
+def find_cached_set(
+    file_hashes: Dict[str, str], include_roots: List[str], parser: str
+) -> Optional[pathlib.Path]:
+    """
+    Return a cached descriptor set parsed by `parser` from exactly these contents of
+    at least the files in `file_hashes`, if there is one. A set built for a superset
+    of the files, like one built for the docs, serves a generator's narrower set too.
+    """
+    for index_path in cached_indexes():
+        set_path = index_path.with_suffix(".pb")
+        try:
+            index = json.loads(index_path.read_text())
+            cached_roots, cached_hashes = index["roots"], index["files"]
+            cached_parser = index["protoc"]
+        except (OSError, ValueError, KeyError, TypeError):
+            continue
+        if (cached_roots, cached_parser) != (include_roots, parser):
+            continue
+        if not set_path.exists():
+            continue
+        if all(cached_hashes.get(p) == h for p, h in file_hashes.items()):
+            try:
+                os.utime(str(index_path))
+            except FileNotFoundError:
+                continue
+            return set_path
+
+    return None
+
+
+def load_parsed_hashes(include_roots: List[str], parser: str) -> Dict[str, str]:
+    """Return the contents of every proto as `parser` last parsed it into a set."""
+    try:
+        data = json.loads(PARSED_PATH.read_text())
+        if (data["roots"], data["protoc"]) == (include_roots, parser):
+            return dict(data["files"])
+    except (OSError, ValueError, KeyError, TypeError):
+        pass
+    return dict()
+
+
+def record_parsed_hashes(
+    file_hashes: Dict[str, str], include_roots: List[str], parser: str
+) -> None:
+    parsed = load_parsed_hashes(include_roots, parser)
+    parsed.update(file_hashes)
+    data = {"roots": include_roots, "protoc": parser, "files": parsed}
+    temp_path = PARSED_PATH.with_name(f"{PARSED_PATH.name}.{os.getpid()}.tmp")
+    temp_path.write_text(json.dumps(data))
+    os.replace(str(temp_path), str(PARSED_PATH))
+
+
+def changed_since_parsed(
+    file_hashes: Dict[str, str], graph: proto_graph.ProtoGraph
+) -> Set[str]:
+    """
+    Return the protos whose contents changed since they were last parsed into a set,
+    along with every proto which imports one of them or a proto since removed.
+    """
+    parsed = load_parsed_hashes(graph.include_roots, parser_version())
+    changed = [p for p, h in file_hashes.items() if parsed.get(p) != h]
+    removed = set(parsed) - set(file_hashes)
+    return graph.rebuild_set(changed, removed)
+
+
+def descriptor_names(
+    proto_files: List[str], graph: proto_graph.ProtoGraph
+) -> List[str]:
+    """Return the names `proto_files` are stored under in a descriptor set."""
+    return [graph.import_name(proto_graph.normalize_path(f)) for f in proto_files]
+
+
+def build_descriptor_arguments(
+    proto_files: List[str], graph: proto_graph.ProtoGraph, set_path: pathlib.Path
+) -> List[str]:
+    """Build the protoc arguments which parse `proto_files` into a descriptor set."""
+    arguments = [
+        *(f"-I{root}" for root in graph.include_roots),
+        "--experimental_allow_proto3_optional",
+        "--include_imports",
+        "--include_source_info",
+        f"--descriptor_set_out={set_path}",
+    ]
+    arguments.extend(proto_files)
+    return arguments
+
+
+def run_descriptor_command(arguments: List[str]) -> int:
+    """
+    Run protoc with `arguments`, preferring the protoc on PATH and falling back to
+    the one bundled with grpc_tools for python projects which have no other.
+    """
+    if shutil.which("protoc") is not None:
+        with proto_run.argument_file(["protoc", *arguments]) as command:
+            proc = script_trace.Popen(command)
+            _, _ = proc.communicate()
+        return proc.returncode
+
+    from grpc_tools import protoc
+
+    proto_include = os.path.join(os.path.dirname(protoc.__file__), "_proto")
+    return protoc.main(["grpc_tools.protoc", *arguments, f"-I{proto_include}"])
+
+
+def prune_cached_sets() -> None:
+    """Remove all but the most recently used descriptor sets."""
+    for index_path in cached_indexes()[MAX_CACHED_SETS:]:
+        # Targets running at the same time may be pruning the same sets.
+        for path in (index_path.with_suffix(".pb"), index_path):
+            try:
+                path.unlink()
+            except FileNotFoundError:
+                pass
+
+
+@script_trace.traced("descriptor_set")
+def ensure_descriptor_set(
+    file_hashes: Dict[str, str],
+    graph: proto_graph.ProtoGraph,
+    proto_files: Optional[Iterable[str]] = None,
+) -> pathlib.Path:
+    """
+    Return a descriptor set, with imports and source info, of the protos in
+    `file_hashes`, which maps normalized paths to content hashes. Given
+    `proto_files`, the set only holds those and the protos they import. The set is
+    only parsed when no cached set covers the same contents parsed by the same
+    protoc, and is stored under a key derived from them.
+    """
+    if proto_files is not None:
+        closure = graph.import_closure(proto_files)
+        file_hashes = {p: h for p, h in file_hashes.items() if p in closure}
+
+    parser = parser_version()
+    cached = find_cached_set(file_hashes, graph.include_roots, parser)
+    if cached is not None:
+        return cached
+
+    index = {"roots": graph.include_roots, "protoc": parser, "files": file_hashes}
+    key = hashlib.sha256(json.dumps(index, sort_keys=True).encode()).hexdigest()
+    set_path = DESCRIPTOR_DIR / f"{key}.pb"
+    temp_path = DESCRIPTOR_DIR / f"{key}.{os.getpid()}.pb.tmp"
+    DESCRIPTOR_DIR.mkdir(parents=True, exist_ok=True)
+
+    names = descriptor_names(list(file_hashes), graph)
+    returncode = run_descriptor_command(
+        build_descriptor_arguments(names, graph, temp_path)
+    )
+    if returncode != 0:
+        sys.exit(returncode)
+
+    os.replace(str(temp_path), str(set_path))
+    set_path.with_suffix(".json").write_text(json.dumps(index, sort_keys=True))
+    record_parsed_hashes(file_hashes, graph.include_roots, parser)
+    prune_cached_sets()
+
+    return set_path
@@ -1,12 +1,53 @@
+import os
 import sys
+import html
+import json
 import pathlib
-import subprocess
-import os
+import dataclasses
 from configparser import ConfigParser
-from typing import List
+from typing import Dict, List, Optional, Tuple
+
+import proto_run
+import proto_walk
+import proto_graph
+import proto_stage
+import script_trace
+import proto_manifest
+import proto_descriptor
 
 ROOT_DIR = pathlib.Path(__file__).parent.parent.parent
 CONFIG_PATH: pathlib.Path = ROOT_DIR / "setup.cfg"
+PROTO_INCLUDE_ROOTS: List[str] = ["."]
+GRAPH_CACHE_PATH: pathlib.Path = proto_manifest.CACHE_DIR / "proto_docs.graph.json"
+PAGES_PATH: pathlib.Path = proto_manifest.CACHE_DIR / "proto_docs.json"
+STATIC_DIR = "zdocs/source/_static"
+INDEX_PAGE = "proto.html"
+PACKAGE_PAGE_DIR = "proto"
+DEFAULT_PACKAGE = "default"
+
+
+@dataclasses.dataclass
+class Options:
+    """Dataclass used to hold the relevant options from our config file."""
+
+    split_packages: bool
+    """Whether to write one page per proto package plus an index page."""
+    descriptor_cache: bool
+    """Whether to document from the shared cached descriptor set."""
+    jobs: int = dataclasses.field(metadata={"fingerprint": False})
+    """Number of protoc processes to run at once when writing package pages."""
+
+
+@dataclasses.dataclass
+class Page:
+    """Dataclass used to hold one html page and the protos it documents."""
+
+    name: str
+    """Path of the page relative to the static docs folder."""
+    proto_files: List[str]
+    """Protos documented on the page."""
+    file_hashes: Dict[str, str]
+    """Content hash of every proto the page was generated from, imports included."""
 
 
 def load_cfg() -> ConfigParser:
@@ -19,47 +60,216 @@ def load_cfg() -> ConfigParser:
     return config
 
 
-def expand_directories(config_paths: List[str]) -> List[str]:
-    working_dir_str = os.getcwd()
-
+def expand_directories(
+    config_paths: List[str], excludes: List[str], walked: Optional[List[str]] = None
+) -> List[str]:
     proto_paths: List[str] = list()
     for this_path_str in config_paths:
         this_path = pathlib.Path(this_path_str).absolute()
         if not this_path.exists():
             raise FileExistsError(f"{this_path_str} does not exist")
 
-        if this_path.is_dir():
-            for this_proto_path in this_path.rglob("./**/*.proto"):
-                this_proto_str = str(this_proto_path)
-                this_proto_str = this_proto_str.replace(working_dir_str, ".")
-                proto_paths.append(this_proto_str)
+        if this_path.is_dir() and walked is not None:
+            proto_paths.extend(proto_walk.select_files(walked, this_path, excludes))
+        elif this_path.is_dir():
+            proto_paths.extend(proto_walk.walk_files([this_path], ".proto", excludes))
         else:
             proto_paths.append(this_path_str)
 
     return proto_paths
 
 
+def load_paths(config: ConfigParser) -> List[str]:
+    proto_files_string = config.get("docs.proto", "paths")
+    return [f for f in proto_files_string.split("\n") if f]
+
+
+def load_excludes(config: ConfigParser) -> List[str]:
+    return proto_walk.load_excludes(config, "docs.proto", proto_walk.DEFAULT_EXCLUDES)
+
+
+def find_proto_files(
+    config: ConfigParser, walked: Optional[List[str]] = None
+) -> List[str]:
+    return expand_directories(load_paths(config), load_excludes(config), walked)
+
+
+def load_options(config: ConfigParser) -> Options:
+    return Options(
+        split_packages=config.getboolean(
+            "docs.proto", "split_packages", fallback=False
+        ),
+        descriptor_cache=config.getboolean("proto", "descriptor_cache", fallback=True),
+        jobs=proto_run.load_jobs(config),
+    )
+
+
 def make_proto_html() -> None:
     config = load_cfg()
-    proto_files_string = config.get("docs.proto", "paths")
-    config_paths = [f for f in proto_files_string.split("\n") if f]
+    proto_files = find_proto_files(config)
+    sys.exit(generate_proto_html(config, proto_files, force="--force" in sys.argv))
+
+
+@script_trace.traced("generate")
+def generate_proto_html(
+    config: ConfigParser, proto_files: List[str], force: bool = False
+) -> int:
+    options = load_options(config)
+    tool_versions = [
+        proto_manifest.tool_version(["protoc", "--version"]),
+        proto_manifest.executable_stamp("protoc-gen-doc"),
+    ]
+    fingerprint = proto_manifest.make_fingerprint(options, tool_versions, __file__)
+
+    file_hashes = proto_manifest.hash_files(proto_files)
+    graph = proto_graph.load_graph(file_hashes, PROTO_INCLUDE_ROOTS, GRAPH_CACHE_PATH)
+    if options.split_packages:
+        pages = package_pages(proto_files, file_hashes, graph)
+    else:
+        pages = [Page(INDEX_PAGE, list(proto_files), dict(file_hashes))]
+
+    recorded = load_pages()
+    previous = None
+    if not force and recorded is not None and recorded[0] == fingerprint:
+        previous = recorded[1]
+    stale_pages = [page for page in pages if not page_is_current(page, previous)]
+    removed_pages = set(recorded[1] if recorded else ()) - {p.name for p in pages}
+    index_missing = (
+        options.split_packages and not (ROOT_DIR / STATIC_DIR / INDEX_PAGE).exists()
+    )
+    if not stale_pages and not removed_pages and not index_missing:
+        sys.stdout.write("proto docs are up to date\n")
+        return 0
+
+    # Document from the descriptor set shared with the code generators rather than
+    # parsing the whole tree a third time.
+    descriptor_set = None
+    if options.descriptor_cache:
+        descriptor_set = proto_descriptor.ensure_descriptor_set(
+            file_hashes, graph, [f for page in stale_pages for f in page.proto_files]
+        )
+
+    # Write the pages into a staging directory and only move the ones whose contents
+    # changed into place, so sphinx does not copy the static files again.
+    stage_dir = proto_stage.make_stage("docs").absolute()
+    for page in stale_pages:
+        (stage_dir / page.name).parent.mkdir(parents=True, exist_ok=True)
+    commands = [
+        build_doc_command(p, graph, descriptor_set, stage_dir) for p in stale_pages
+    ]
+    with script_trace.span("protoc", pages=len(commands)):
+        returncode = proto_run.run_commands(commands, options.jobs, cwd=str(ROOT_DIR))
+    if returncode != 0:
+        return returncode
+
+    if options.split_packages:
+        write_index_page(pages, stage_dir)
+    result = proto_stage.sync_stage(stage_dir, ROOT_DIR / STATIC_DIR, removed_pages)
+    sys.stdout.write(f"proto docs: {result.summary()}\n")
+
+    save_pages(fingerprint, pages)
+    return 0
+
+
+def package_pages(
+    proto_files: List[str], file_hashes: Dict[str, str], graph: proto_graph.ProtoGraph
+) -> List[Page]:
+    """
+    Group the protos into one page per proto package. A page is regenerated when
+    any of its protos or anything they import changes.
+    """
+    pages: Dict[str, Page] = dict()
+    for proto_file in proto_files:
+        key = proto_graph.normalize_path(proto_file)
+        package = graph.nodes[key].package or DEFAULT_PACKAGE
+        name = f"{PACKAGE_PAGE_DIR}/{package}.html"
+        page = pages.setdefault(name, Page(name, list(), dict()))
+        page.proto_files.append(proto_file)
+
+        pending = [key]
+        while pending:
+            path = pending.pop()
+            if path not in page.file_hashes:
+                page.file_hashes[path] = file_hashes[path]
+                pending.extend(graph.dependencies[path])
+
+    return [pages[name] for name in sorted(pages)]
 
-    proto_files = expand_directories(config_paths)
 
+def page_is_current(page: Page, previous: Optional[Dict[str, Dict[str, str]]]) -> bool:
+    if previous is None or previous.get(page.name) != page.file_hashes:
+        return False
+    return (ROOT_DIR / STATIC_DIR / page.name).exists()
+
+
+def build_doc_command(
+    page: Page,
+    graph: proto_graph.ProtoGraph,
+    descriptor_set: Optional[pathlib.Path],
+    output_dir: pathlib.Path,
+) -> List[str]:
+    page_path = pathlib.PurePosixPath(page.name)
     command = [
         "protoc",
-        "--doc_out=./zdocs/source/_static",
-        "--doc_opt=html,proto.html",
+        f"--doc_out={output_dir / page_path.parent}",
+        f"--doc_opt=html,{page_path.name}",
     ]
+
+    proto_files = page.proto_files
+    if descriptor_set is not None:
+        # protoc runs from the project root, so the set needs an absolute path.
+        command.append(f"--descriptor_set_in={descriptor_set.absolute()}")
+        proto_files = proto_descriptor.descriptor_names(proto_files, graph)
+
     command.extend(proto_files)
+    return command
+
+
+def write_index_page(pages: List[Page], output_dir: pathlib.Path) -> None:
+    """Write the page linking every package page, in place of the single page."""
+    items = list()
+    for page in pages:
+        package = pathlib.PurePosixPath(page.name).stem
+        files = ", ".join(html.escape(f) for f in page.proto_files)
+        items.append(
+            f'<li><a href="{html.escape(page.name)}">{html.escape(package)}</a>'
+            f" <small>{files}</small></li>"
+        )
 
-    proc = subprocess.Popen(
-        command,
-        cwd=str(ROOT_DIR),
+    (output_dir / INDEX_PAGE).write_text(
+        '<!DOCTYPE html>\n<html>\n<head><meta charset="utf-8">'
+        "<title>Protocol Documentation</title></head>\n<body>\n"
+        "<h1>Protocol Documentation</h1>\n<ul>\n"
+        + "\n".join(items)
+        + "\n</ul>\n</body>\n</html>\n"
     )
 
-    _, _ = proc.communicate()
-    sys.exit(proc.returncode)
+
+def load_pages() -> Optional[Tuple[str, Dict[str, Dict[str, str]]]]:
+    """
+    Load the fingerprint of the last run along with the file hashes each page was
+    generated from, or `None` when there is no usable record.
+    """
+    try:
+        data = json.loads(PAGES_PATH.read_text())
+        return data["fingerprint"], dict(data["pages"])
+    except (OSError, ValueError, KeyError, TypeError):
+        return None
+
+
+def save_pages(fingerprint: str, pages: List[Page]) -> None:
+    PAGES_PATH.parent.mkdir(parents=True, exist_ok=True)
+    temp_path = PAGES_PATH.with_name(PAGES_PATH.name + ".tmp")
+    temp_path.write_text(
+        json.dumps(
+            {
+                "fingerprint": fingerprint,
+                "pages": {page.name: page.file_hashes for page in pages},
+            },
+            indent=2,
+        )
+    )
+    os.replace(str(temp_path), str(PAGES_PATH))
 
 
 if __name__ == "__main__":
@@ -0,0 +1,192 @@
+import re
+import os
+import json
+import pathlib
+import dataclasses
+from typing import Dict, Iterable, List, Optional, Set
+
+import script_trace
+
+"""
+import dependency graph of a proto tree, cached between runs so only protos whose
+contents changed have to be parsed again
+"""
+
+IMPORT_REGEX = re.compile(
+    r'^\s*import\s+(?:public\s+|weak\s+)?"([^"]+)"\s*;', flags=re.MULTILINE
+)
+PACKAGE_REGEX = re.compile(r"^\s*package\s+([\w.]+)\s*;", flags=re.MULTILINE)
+GO_PACKAGE_REGEX = re.compile(
+    r'^\s*option\s+go_package\s*=\s*"([^"]*)"\s*;', flags=re.MULTILINE
+)
+COMMENT_REGEX = re.compile(r"//[^\n]*|/\*.*?\*/", flags=re.DOTALL)
+
+NODE_CACHE: Dict[str, Dict[str, "ProtoNode"]] = dict()
+"""Nodes this process last loaded or saved, keyed by cache path."""
+
+
+@dataclasses.dataclass
+class ProtoNode:
+    """Dataclass used to hold what we parse out of a single proto file."""
+
+    file_hash: str
+    """Content hash the rest of the fields were parsed from."""
+    package: str
+    """The proto package declared by the file."""
+    go_package: str
+    """The `go_package` option of the file, empty if it does not set one."""
+    imports: List[str]
+    """Import paths exactly as written in the file's import statements."""
+
+
+@dataclasses.dataclass
+class ProtoGraph:
+    """Dataclass used to hold the import relationships of a set of proto files."""
+
+    include_roots: List[str]
+    """The `-I` roots imports are resolved against, in protoc's search order."""
+    nodes: Dict[str, ProtoNode]
+    """Parsed proto files keyed by normalized path."""
+    dependencies: Dict[str, List[str]] = dataclasses.field(default_factory=dict)
+    """Files each proto imports which are part of the graph."""
+    dependents: Dict[str, Set[str]] = dataclasses.field(default_factory=dict)
+    """Files which directly import each proto."""
+
+    def __post_init__(self) -> None:
+        for path, node in self.nodes.items():
+            resolved = [self.resolve(name) for name in node.imports]
+            self.dependencies[path] = [r for r in resolved if r is not None]
+            for dependency in self.dependencies[path]:
+                self.dependents.setdefault(dependency, set()).add(path)
+
+    def candidates(self, import_name: str) -> List[str]:
+        """Return the paths an import could refer to, in search order."""
+        return [
+            normalize_path(os.path.join(root, import_name))
+            for root in self.include_roots
+        ]
+
+    def resolve(self, import_name: str) -> Optional[str]:
+        """
+        Return the graph file an import refers to, or `None` when it lives outside the
+        graph, like the google well-known types.
+        """
+        for candidate in self.candidates(import_name):
+            if candidate in self.nodes:
+                return candidate
+        return None
+
+    def import_name(self, path: str) -> str:
+        """Return the name protoc knows a file by, relative to its `-I` root."""
+        for root in self.include_roots:
+            relative = os.path.relpath(path, root)
+            if not relative.startswith(".."):
+                return pathlib.Path(relative).as_posix()
+        return normalize_path(path)
+
+    def rebuild_set(
+        self, changed: Iterable[str], removed: Iterable[str] = ()
+    ) -> Set[str]:
+        """
+        Return the protos which must be recompiled when `changed` were edited and
+        `removed` were deleted: the changed files themselves plus every file that
+        imports one of them, directly or transitively.
+        """
+        rebuild = {normalize_path(path) for path in changed} & set(self.nodes)
+        pending = list(rebuild)
+
+        removed_set = {normalize_path(path) for path in removed}
+        if removed_set:
+            for path, node in self.nodes.items():
+                for name in node.imports:
+                    if removed_set.intersection(self.candidates(name)):
+                        pending.append(path)
+                        rebuild.add(path)
+
+        while pending:
+            for dependent in self.dependents.get(pending.pop(), ()):
+                if dependent not in rebuild:
+                    rebuild.add(dependent)
+                    pending.append(dependent)
+
+        return rebuild
+
+    def import_closure(self, paths: Iterable[str]) -> Set[str]:
+        """Return `paths` and every proto of the graph they import, transitively."""
+        closure = {normalize_path(path) for path in paths} & set(self.nodes)
+        pending = list(closure)
+        while pending:
+            for dependency in self.dependencies.get(pending.pop(), ()):
+                if dependency not in closure:
+                    closure.add(dependency)
+                    pending.append(dependency)
+
+        return closure
+
+
+def normalize_path(path_str: str) -> str:
+    """Normalize a proto path so the same file always has the same key."""
+    return pathlib.Path(os.path.normpath(path_str)).as_posix()
+
+
+def parse_proto(proto_text: str, file_hash: str) -> ProtoNode:
+    """Pull the package, go_package and imports out of the text of a proto file."""
+    proto_text = COMMENT_REGEX.sub("", proto_text)
+
+    package_match = PACKAGE_REGEX.search(proto_text)
+    go_package_match = GO_PACKAGE_REGEX.search(proto_text)
+
+    return ProtoNode(
+        file_hash=file_hash,
+        package=package_match.group(1) if package_match else "",
+        go_package=go_package_match.group(1) if go_package_match else "",
+        imports=IMPORT_REGEX.findall(proto_text),
+    )
+
+
+def load_cached_nodes(cache_path: pathlib.Path) -> Dict[str, ProtoNode]:
+    """Load the nodes parsed by the last run, or nothing if there is no usable cache."""
+    try:
+        data = json.loads(cache_path.read_text())
+        return {path: ProtoNode(**node) for path, node in data.items()}
+    except (OSError, ValueError, TypeError, AttributeError):
+        return dict()
+
+
+def save_cached_nodes(cache_path: pathlib.Path, nodes: Dict[str, ProtoNode]) -> None:
+    """Write the parsed nodes atomically so an interrupted run leaves the old cache."""
+    cache_path.parent.mkdir(parents=True, exist_ok=True)
+    temp_path = cache_path.with_name(cache_path.name + ".tmp")
+    temp_path.write_text(
+        json.dumps({path: dataclasses.asdict(n) for path, n in nodes.items()})
+    )
+    os.replace(str(temp_path), str(cache_path))
+
+
+@script_trace.traced("load_graph")
+def load_graph(
+    file_hashes: Dict[str, str],
+    include_roots: List[str],
+    cache_path: pathlib.Path,
+) -> ProtoGraph:
+    """
+    Build the import graph of the protos in `file_hashes`, which maps normalized paths
+    to content hashes. Files whose hash matches the cache are not parsed again, and a
+    long running process keeps the cache in memory between calls.
+    """
+    cached = NODE_CACHE.get(str(cache_path))
+    if cached is None:
+        cached = load_cached_nodes(cache_path)
+
+    nodes: Dict[str, ProtoNode] = dict()
+    for path, file_hash in file_hashes.items():
+        node = cached.get(path)
+        if node is None or node.file_hash != file_hash:
+            node = parse_proto(pathlib.Path(path).read_text(), file_hash)
+        nodes[path] = node
+
+    if nodes != cached:
+        save_cached_nodes(cache_path, nodes)
+    NODE_CACHE[str(cache_path)] = nodes
+
+    return ProtoGraph(include_roots=list(include_roots), nodes=nodes)
@@ -0,0 +1,240 @@
+import os
+import json
+import time
+import shutil
+import hashlib
+import pathlib
+import subprocess
+import dataclasses
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+
+import proto_graph
+import script_trace
+
+"""
+content-hash manifest shared by the proto generation scripts so a run only recompiles
+the protos that changed since the last successful generation
+"""
+
+CACHE_DIR: pathlib.Path = pathlib.Path("./zdevelop/.cache")
+RACY_NANOSECONDS = 2_000_000_000
+"""Files modified this recently are always hashed again, see `hash_file`."""
+
+HASH_CACHE: Dict[str, Tuple[int, int, str]] = dict()
+"""Size, mtime and hash of the files this process hashed, keyed by path."""
+TOOL_VERSIONS: Dict[Tuple[str, ...], str] = dict()
+"""What each version command reported to this process, keyed by the command."""
+
+
+@dataclasses.dataclass
+class Manifest:
+    """Dataclass used to hold the inputs of the last successful generation run."""
+
+    fingerprint: str
+    """Hash of the tool versions and options the outputs were generated with."""
+    file_hashes: Dict[str, str]
+    """Content hash of each input proto, keyed by normalized path."""
+    outputs: Dict[str, List[str]] = dataclasses.field(default_factory=dict)
+    """Files generated from each input proto, keyed by normalized path."""
+
+
+@dataclasses.dataclass
+class BuildPlan:
+    """Dataclass used to hold the protos a generation run has to recompile."""
+
+    manifest_path: pathlib.Path
+    """Path the manifest is written to once the run succeeds."""
+    manifest: Manifest
+    """Manifest describing the current inputs."""
+    rebuild_files: List[str]
+    """Protos which must be recompiled, in the order they were discovered."""
+    graph: proto_graph.ProtoGraph
+    """Import graph of every current proto."""
+    previous: Optional[Manifest] = None
+    """Manifest of the last successful run, even when it is not being trusted."""
+
+
+def hash_file(path: pathlib.Path) -> str:
+    """
+    Return the sha256 hex digest of a file's contents. A long running process, like a
+    watch, only reads a file again once its size or mtime changes. Files modified
+    within `RACY_NANOSECONDS` are never remembered, since another write in the same
+    timestamp tick would leave both untouched.
+    """
+    stat = path.stat()
+    cached = HASH_CACHE.get(str(path))
+    if cached is not None and cached[:2] == (stat.st_size, stat.st_mtime_ns):
+        return cached[2]
+
+    digest = hashlib.sha256(path.read_bytes()).hexdigest()
+    if time.time_ns() - stat.st_mtime_ns > RACY_NANOSECONDS:
+        HASH_CACHE[str(path)] = (stat.st_size, stat.st_mtime_ns, digest)
+    return digest
+
+
+@script_trace.traced("hash_files")
+def hash_files(proto_files: Iterable[str]) -> Dict[str, str]:
+    """Hash every proto file, keyed by normalized path."""
+    return {
+        proto_graph.normalize_path(proto_file): hash_file(pathlib.Path(proto_file))
+        for proto_file in proto_files
+    }
+
+
+def executable_stamp(name: str) -> str:
+    """Identify an executable on PATH by its location, size and modification time."""
+    executable = shutil.which(name)
+    if executable is None:
+        return f"{name}: missing"
+
+    stat = os.stat(executable)
+    return f"{executable}:{stat.st_size}:{stat.st_mtime_ns}"
+
+
+def tool_version(command: List[str]) -> str:
+    """
+    Return the version a tool reports through `command`, falling back to
+    `executable_stamp` when the tool does not report one. Each tool is only asked
+    once per process, so a resident watch does not start them on every rebuild.
+    """
+    key = tuple(command)
+    if key not in TOOL_VERSIONS:
+        TOOL_VERSIONS[key] = ask_tool_version(command)
+    return TOOL_VERSIONS[key]
+
+
+def ask_tool_version(command: List[str]) -> str:
+    if shutil.which(command[0]) is None:
+        return f"{command[0]}: missing"
+
+    try:
+        proc = script_trace.Popen(
+            command,
+            stdin=subprocess.DEVNULL,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE,
+            universal_newlines=True,
+        )
+    except OSError:
+        return executable_stamp(command[0])
+
+    try:
+        stdout, _ = proc.communicate(timeout=30)
+    except subprocess.TimeoutExpired:
+        proc.kill()
+        proc.communicate()
+        return executable_stamp(command[0])
+
+    if proc.returncode == 0 and stdout.strip():
+        return stdout.strip()
+
+    return executable_stamp(command[0])
+
+
+def make_fingerprint(options: Any, tool_versions: List[str], script: str) -> str:
+    """
+    Hash everything besides the protos themselves that the generated output depends
+    on: the `Options` dataclass, the versions of protoc and its plugins and the
+    source of the generating script. Option fields with `fingerprint` set to False in
+    their metadata do not affect the output and are left out.
+    """
+    options_dict = {
+        field.name: str(getattr(options, field.name))
+        for field in dataclasses.fields(options)
+        if field.metadata.get("fingerprint", True)
+    }
+    payload = json.dumps(
+        {
+            "options": options_dict,
+            "tools": tool_versions,
+            "script": hash_file(pathlib.Path(script)),
+        },
+        sort_keys=True,
+    )
+    return hashlib.sha256(payload.encode()).hexdigest()
+
+
+def load_manifest(manifest_path: pathlib.Path) -> Optional[Manifest]:
+    """Load the manifest of the last run, or `None` if there is no usable one."""
+    try:
+        data = json.loads(manifest_path.read_text())
+        return Manifest(
+            fingerprint=data["fingerprint"],
+            file_hashes=data["file_hashes"],
+            outputs=data.get("outputs", dict()),
+        )
+    except (OSError, ValueError, KeyError, TypeError):
+        return None
+
+
+def save_manifest(manifest_path: pathlib.Path, manifest: Manifest) -> None:
+    """Write the manifest atomically so an interrupted run leaves the old one."""
+    manifest_path.parent.mkdir(parents=True, exist_ok=True)
+    temp_path = manifest_path.with_name(manifest_path.name + ".tmp")
+    temp_path.write_text(json.dumps(dataclasses.asdict(manifest), indent=2))
+    os.replace(str(temp_path), str(manifest_path))
+
+
+def plan_build(
+    manifest_path: pathlib.Path,
+    proto_files: List[str],
+    fingerprint: str,
+    include_roots: List[str],
+    force: bool = False,
+) -> BuildPlan:
+    """
+    Compare the current protos against the manifest of the last run and work out
+    which of them must be recompiled. `include_roots` are the `-I` roots protoc
+    resolves imports against.
+    """
+    manifest = Manifest(fingerprint=fingerprint, file_hashes=hash_files(proto_files))
+    graph = proto_graph.load_graph(
+        manifest.file_hashes,
+        include_roots,
+        manifest_path.with_suffix(".graph.json"),
+    )
+    recorded = load_manifest(manifest_path)
+    previous = None if force else recorded
+
+    # If anything other than the protos changed, everything has to be regenerated.
+    if previous is None or previous.fingerprint != fingerprint:
+        return BuildPlan(manifest_path, manifest, list(proto_files), graph, recorded)
+
+    changed = {
+        path
+        for path, file_hash in manifest.file_hashes.items()
+        if previous.file_hashes.get(path) != file_hash
+    }
+    removed = set(previous.file_hashes) - set(manifest.file_hashes)
+
+    targets = graph.rebuild_set(changed, removed)
+    rebuild_files = [f for f in proto_files if proto_graph.normalize_path(f) in targets]
+
+    # Outputs of the protos we skip are still current.
+    manifest.outputs = {
+        path: outputs
+        for path, outputs in previous.outputs.items()
+        if path in manifest.file_hashes and path not in targets
+    }
+    return BuildPlan(manifest_path, manifest, rebuild_files, graph, recorded)
+
+
+def record_outputs(plan: BuildPlan, outputs: Dict[str, List[str]]) -> None:
+    """Record the files generated from each rebuilt proto, keyed by normalized path."""
+    plan.manifest.outputs.update(outputs)
+
+
+def stale_outputs(plan: BuildPlan) -> List[str]:
+    """Return the outputs of the last run which are no longer generated."""
+    if plan.previous is None:
+        return list()
+
+    current = {o for paths in plan.manifest.outputs.values() for o in paths}
+    previous = {o for paths in plan.previous.outputs.values() for o in paths}
+    return sorted(previous - current)
+
+
+@script_trace.traced("commit_build")
+def commit_build(plan: BuildPlan) -> None:
+    """Record a successful run so the next one can skip its unchanged inputs."""
+    save_manifest(plan.manifest_path, plan.manifest)
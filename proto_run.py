@@ -0,0 +1,193 @@
+import os
+import sys
+import pathlib
+import tempfile
+import contextlib
+import subprocess
+import dataclasses
+import configparser
+from concurrent import futures
+from typing import Callable, Dict, Iterator, List, Optional, TypeVar
+
+import proto_graph
+import script_trace
+import proto_manifest
+
+"""
+runs protoc over independent shards of a proto tree in a bounded pool of processes
+"""
+
+ArgumentsType = TypeVar("ArgumentsType")
+
+ARGUMENT_FILE_DIR: pathlib.Path = proto_manifest.CACHE_DIR / "argfiles"
+MAX_COMMAND_CHARS = 30_000
+"""
+Longest command line passed to protoc directly. Longer ones go through a response
+file; this stays under both ARG_MAX on unix and the 32k limit of windows.
+"""
+PROTOC_PROGRAMS = ("protoc", "grpc_tools.protoc")
+"""Command elements after which everything is an argument protoc itself parses."""
+
+
+@dataclasses.dataclass
+class CommandResult:
+    """Dataclass used to hold the outcome of one protoc invocation."""
+
+    command: List[str]
+    """The command that was run."""
+    returncode: int
+    """Exit status of the command."""
+    stdout: str
+    """Everything the command wrote to stdout."""
+    stderr: str
+    """Everything the command wrote to stderr."""
+
+
+def load_jobs(config: configparser.ConfigParser) -> int:
+    """Read the number of protoc processes to run at once, defaulting to the CPUs."""
+    jobs = config.getint("proto", "protoc_jobs", fallback=os.cpu_count() or 1)
+    return max(jobs, 1)
+
+
+def shard_files(
+    proto_files: List[str], graph: proto_graph.ProtoGraph, shard_count: int
+) -> List[List[str]]:
+    """
+    Split `proto_files` into at most `shard_count` shards that can be compiled
+    independently. Files connected through imports or sharing a proto package always
+    land in the same shard so each shard parses as little of the tree as possible.
+    """
+    if shard_count <= 1 or len(proto_files) <= 1:
+        return [list(proto_files)]
+
+    keys = [proto_graph.normalize_path(f) for f in proto_files]
+    parents: Dict[str, str] = {key: key for key in keys}
+
+    def find(key: str) -> str:
+        while parents[key] != key:
+            parents[key] = parents[parents[key]]
+            key = parents[key]
+        return key
+
+    def union(first: str, second: str) -> None:
+        parents[find(first)] = find(second)
+
+    package_members: Dict[str, str] = dict()
+    for key in keys:
+        node = graph.nodes[key]
+        for dependency in graph.dependencies[key]:
+            if dependency in parents:
+                union(key, dependency)
+        if node.package in package_members:
+            union(key, package_members[node.package])
+        else:
+            package_members[node.package] = key
+
+    components: Dict[str, List[str]] = dict()
+    for key, proto_file in zip(keys, proto_files):
+        components.setdefault(find(key), list()).append(proto_file)
+
+    # Hand the biggest components out first, always to the emptiest shard.
+    shards: List[List[str]] = [list() for _ in range(shard_count)]
+    for component in sorted(components.values(), key=len, reverse=True):
+        min(shards, key=len).extend(component)
+
+    return [shard for shard in shards if shard]
+
+
+def protoc_arguments_start(command: List[str]) -> Optional[int]:
+    """Return the index of the first argument protoc parses, if `command` is protoc."""
+    for index, element in enumerate(command):
+        if os.path.basename(element) in PROTOC_PROGRAMS:
+            return index + 1
+    return None
+
+
+@contextlib.contextmanager
+def argument_file(command: List[str]) -> Iterator[List[str]]:
+    """
+    Yield `command`, or when its command line would be too long, an equivalent
+    command which has protoc read its arguments from an `@file`, one per line. The
+    file is removed once the block exits.
+    """
+    start = protoc_arguments_start(command)
+    arguments = command[start:] if start is not None else []
+    if (
+        start is None
+        or sum(len(c) + 1 for c in command) <= MAX_COMMAND_CHARS
+        or any("\n" in a for a in arguments)
+    ):
+        yield command
+        return
+
+    ARGUMENT_FILE_DIR.mkdir(parents=True, exist_ok=True)
+    fd, path = tempfile.mkstemp(suffix=".args", dir=str(ARGUMENT_FILE_DIR))
+    try:
+        with os.fdopen(fd, "w") as argument_stream:
+            argument_stream.write("".join(f"{a}\n" for a in arguments))
+        # Absolute, as the command may run from another directory.
+        yield [*command[:start], f"@{os.path.abspath(path)}"]
+    finally:
+        os.remove(path)
+
+
+def run_command(command: List[str], cwd: Optional[str] = None) -> CommandResult:
+    """Run a command to completion, capturing its output."""
+    with argument_file(command) as shortened:
+        proc = script_trace.Popen(
+            shortened,
+            cwd=cwd,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE,
+            universal_newlines=True,
+        )
+        stdout, stderr = proc.communicate()
+    return CommandResult(command, proc.returncode, stdout, stderr)
+
+
+def run_commands(
+    commands: List[List[str]], jobs: int, cwd: Optional[str] = None
+) -> int:
+    """
+    Run `commands` with at most `jobs` running at once and return the exit status of
+    the first one that failed, or 0. Output of each command is written out in order
+    once all of them have finished, so shards never interleave their diagnostics.
+    """
+    if len(commands) == 1:
+        with argument_file(commands[0]) as shortened:
+            proc = script_trace.Popen(shortened, cwd=cwd)
+            _, _ = proc.communicate()
+        return proc.returncode
+
+    with futures.ThreadPoolExecutor(max_workers=max(jobs, 1)) as executor:
+        results = list(executor.map(lambda c: run_command(c, cwd), commands))
+
+    returncode = 0
+    for result in results:
+        sys.stdout.write(result.stdout)
+        sys.stderr.write(result.stderr)
+        if result.returncode != 0 and returncode == 0:
+            returncode = result.returncode
+
+    return returncode
+
+
+def run_in_process_pool(
+    function: Callable[[ArgumentsType], int],
+    arguments: List[ArgumentsType],
+    jobs: int,
+) -> int:
+    """
+    Call `function` once per item of `arguments` in a pool of at most `jobs` worker
+    processes, for tools we can run in-process, and return the first non-zero status.
+    Each worker pays the interpreter startup once however many shards it runs. A
+    single call runs straight in this process.
+    """
+    if len(arguments) == 1:
+        return function(arguments[0])
+
+    workers = max(min(jobs, len(arguments)), 1)
+    with futures.ProcessPoolExecutor(max_workers=workers) as executor:
+        returncodes = list(executor.map(function, arguments))
+
+    return next((code for code in returncodes if code != 0), 0)
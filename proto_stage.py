@@ -0,0 +1,105 @@
+import os
+import shutil
+import filecmp
+import pathlib
+import dataclasses
+from typing import Iterable, List
+
+import proto_walk
+import script_trace
+import proto_manifest
+
+"""
+stages generated files outside the source tree and only moves the ones whose contents
+changed into place, so a regeneration that changes nothing leaves every output, and
+every build cache keyed on their mtimes, untouched
+"""
+
+STAGING_DIR: pathlib.Path = proto_manifest.CACHE_DIR / "staging"
+
+
+@dataclasses.dataclass
+class SyncResult:
+    """Dataclass used to hold what syncing a staging directory did to the outputs."""
+
+    written: List[str]
+    """Outputs which were created or whose contents changed."""
+    unchanged: List[str]
+    """Outputs left alone because the staged copy was identical."""
+    removed: List[str]
+    """Stale outputs which were deleted."""
+
+    def summary(self) -> str:
+        return (
+            f"{len(self.written)} written, {len(self.unchanged)} unchanged, "
+            f"{len(self.removed)} removed"
+        )
+
+
+def make_stage(name: str) -> pathlib.Path:
+    """Return an empty staging directory for one generator."""
+    stage_dir = STAGING_DIR / name
+    if stage_dir.exists():
+        shutil.rmtree(str(stage_dir))
+    stage_dir.mkdir(parents=True)
+    return stage_dir
+
+
+def staged_files(stage_dir: pathlib.Path, suffix: str = "") -> List[str]:
+    """Return the files in a staging directory as sorted relative posix paths."""
+    found: List[str] = list()
+    for directory, dir_names, file_names in os.walk(str(stage_dir)):
+        dir_names.sort()
+        relative_dir = pathlib.Path(directory).relative_to(stage_dir).as_posix()
+        for file_name in sorted(file_names):
+            if file_name.endswith(suffix):
+                found.append(proto_walk.posix_join(relative_dir, file_name))
+    return found
+
+
+def install_file(staged_path: pathlib.Path, output_path: pathlib.Path) -> bool:
+    """
+    Move a staged file over its output unless the output already has the same bytes.
+    Returns whether the output was written.
+    """
+    if output_path.is_file() and filecmp.cmp(
+        str(staged_path), str(output_path), shallow=False
+    ):
+        return False
+
+    output_path.parent.mkdir(parents=True, exist_ok=True)
+    try:
+        os.replace(str(staged_path), str(output_path))
+    except OSError:
+        # The cache may live on another filesystem than the outputs.
+        shutil.move(str(staged_path), str(output_path))
+    return True
+
+
+@script_trace.traced("sync_outputs")
+def sync_stage(
+    stage_dir: pathlib.Path, output_dir: pathlib.Path, stale: Iterable[str] = ()
+) -> SyncResult:
+    """
+    Install every file staged under `stage_dir` at the same relative path under
+    `output_dir`, then delete the `stale` outputs, given relative to `output_dir`,
+    which were not staged again. The staging directory is removed afterwards.
+    """
+    result = SyncResult(written=list(), unchanged=list(), removed=list())
+
+    staged = staged_files(stage_dir)
+    for relative in staged:
+        if install_file(stage_dir / relative, output_dir / relative):
+            result.written.append(relative)
+        else:
+            result.unchanged.append(relative)
+
+    staged_set = set(staged)
+    for relative in stale:
+        output_path = output_dir / relative
+        if relative not in staged_set and output_path.is_file():
+            output_path.unlink()
+            result.removed.append(relative)
+
+    shutil.rmtree(str(stage_dir))
+    return result
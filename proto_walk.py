@@ -0,0 +1,100 @@
+import os
+import pathlib
+import fnmatch
+import configparser
+from typing import Iterable, List
+
+import script_trace
+
+"""
+filesystem walker shared by the proto scripts which prunes excluded directories before
+descending into them
+"""
+
+DEFAULT_EXCLUDES: List[str] = [".git", "node_modules", "vendor", "third_party"]
+"""Globs of the directories no proto discovery should ever descend into."""
+
+
+def load_excludes(
+    config: configparser.ConfigParser, section: str, fallback: List[str]
+) -> List[str]:
+    """
+    Read a newline separated list of exclude globs from `section` of the config. They
+    add to the `fallback` globs rather than replace them, so a project excluding its
+    own directories still never compiles the vendored google protos.
+    """
+    exclude_string = config.get(section, "exclude", fallback="")
+    configured = [e.strip() for e in exclude_string.split("\n") if e.strip()]
+    return list(dict.fromkeys([*fallback, *configured]))
+
+
+def is_excluded(relative_path: str, excludes: Iterable[str]) -> bool:
+    """Whether a path, or its final component, matches one of the exclude globs."""
+    name = relative_path.rsplit("/", 1)[-1]
+    return any(
+        fnmatch.fnmatchcase(name, e) or fnmatch.fnmatchcase(relative_path, e)
+        for e in excludes
+    )
+
+
+def relative_posix(path: str) -> str:
+    """Return `path` relative to the working directory, with forward slashes."""
+    return pathlib.Path(os.path.relpath(path)).as_posix()
+
+
+@script_trace.traced("walk_files")
+def walk_files(
+    roots: Iterable[pathlib.Path], suffix: str, excludes: Iterable[str]
+) -> List[str]:
+    """
+    Return every file ending in `suffix` below `roots` as a normalized path relative
+    to the working directory. Directories matching an exclude glob are pruned before
+    the walk descends into them, and the result is sorted so runs are reproducible.
+    """
+    excludes = list(excludes)
+    found: List[str] = list()
+
+    for root in roots:
+        for directory, dir_names, file_names in os.walk(str(root)):
+            relative_dir = relative_posix(directory)
+            dir_names[:] = sorted(
+                d
+                for d in dir_names
+                if not is_excluded(posix_join(relative_dir, d), excludes)
+            )
+            for file_name in sorted(file_names):
+                relative_file = posix_join(relative_dir, file_name)
+                if file_name.endswith(suffix) and not is_excluded(
+                    relative_file, excludes
+                ):
+                    found.append(relative_file)
+
+    return list(dict.fromkeys(found))
+
+
+def select_files(
+    walked: Iterable[str], root: pathlib.Path, excludes: Iterable[str]
+) -> List[str]:
+    """
+    Return the files of an earlier `walk_files` call which walking just `root` with
+    `excludes` would have found, so several callers can share one walk done with
+    fewer excludes.
+    """
+    excludes = list(excludes)
+    root_str = relative_posix(str(root))
+    prefix = "" if root_str == "." else f"{root_str}/"
+
+    selected: List[str] = list()
+    for path in walked:
+        if not path.startswith(prefix):
+            continue
+        parts = path[len(prefix) :].split("/")
+        below_root = [prefix + "/".join(parts[:i]) for i in range(1, len(parts) + 1)]
+        if not any(is_excluded(p, excludes) for p in below_root):
+            selected.append(path)
+
+    return selected
+
+
+def posix_join(directory: str, name: str) -> str:
+    return name if directory == "." else f"{directory}/{name}"
@@ -0,0 +1,257 @@
+import os
+import sys
+import time
+import errno
+import select
+import struct
+import ctypes
+import ctypes.util
+import pathlib
+from typing import Callable, Dict, List, Optional, Tuple, Union
+
+import proto_walk
+
+"""
+keeps a generator resident, watching the proto tree through inotify, or by polling
+where inotify is unavailable, and rebuilding once a burst of saves has settled
+"""
+
+DEBOUNCE_SECONDS = 0.3
+"""How long the tree has to be quiet after a change before we rebuild."""
+POLL_SECONDS = 1.0
+"""How often the polling watcher looks at the tree."""
+
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_ISDIR = 0x40000000
+IN_NONBLOCK = 0o00004000
+IN_CLOEXEC = 0o02000000
+
+WATCH_MASK = (
+    IN_CLOSE_WRITE
+    | IN_MOVED_FROM
+    | IN_MOVED_TO
+    | IN_CREATE
+    | IN_DELETE
+    | IN_DELETE_SELF
+    | IN_MOVE_SELF
+    | IN_ONLYDIR
+)
+EVENT_HEADER = struct.Struct("iIII")
+
+
+class InotifyWatcher:
+    """Watches every non-excluded directory below the roots through inotify."""
+
+    def __init__(
+        self, roots: List[pathlib.Path], suffix: str, excludes: List[str]
+    ) -> None:
+        self.suffix = suffix
+        self.excludes = excludes
+        self.directories: Dict[int, str] = dict()
+
+        libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6", use_errno=True)
+        self.add_watch = libc.inotify_add_watch
+        self.add_watch.argtypes = [ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32]
+
+        self.fd = libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self.fd < 0:
+            error = ctypes.get_errno()
+            raise OSError(error, os.strerror(error))
+
+        for root in roots:
+            self.watch_tree(str(root))
+
+    def watch_tree(self, top: str) -> None:
+        for directory, dir_names, _ in os.walk(top):
+            relative_dir = proto_walk.relative_posix(directory)
+            dir_names[:] = [
+                d
+                for d in dir_names
+                if not proto_walk.is_excluded(
+                    proto_walk.posix_join(relative_dir, d), self.excludes
+                )
+            ]
+            wd = self.add_watch(self.fd, os.fsencode(directory), WATCH_MASK)
+            if wd < 0:
+                error = ctypes.get_errno()
+                # The directory may be gone again by the time we get to it.
+                if error in (errno.ENOENT, errno.ENOTDIR):
+                    continue
+                raise OSError(error, os.strerror(error), directory)
+            self.directories[wd] = directory
+
+    def wait(self, timeout: Optional[float]) -> Optional[bool]:
+        """
+        Wait up to `timeout` seconds, forever if `None`, for a relevant change. Return
+        `None` if there was none, otherwise whether files were added, removed or
+        renamed so the tree has to be walked again.
+        """
+        ready, _, _ = select.select([self.fd], [], [], timeout)
+        if not ready:
+            return None
+
+        try:
+            buffer = os.read(self.fd, 64 * 1024)
+        except BlockingIOError:
+            return None
+
+        relevant = False
+        rescan = False
+        offset = 0
+        while offset < len(buffer):
+            wd, mask, _, length = EVENT_HEADER.unpack_from(buffer, offset)
+            name_bytes = buffer[
+                offset + EVENT_HEADER.size : offset + EVENT_HEADER.size + length
+            ]
+            offset += EVENT_HEADER.size + length
+            name = os.fsdecode(name_bytes.rstrip(b"\0"))
+
+            if mask & IN_Q_OVERFLOW:
+                relevant = rescan = True
+            elif mask & IN_IGNORED:
+                self.directories.pop(wd, None)
+            elif mask & (IN_DELETE_SELF | IN_MOVE_SELF):
+                relevant = rescan = True
+            elif mask & IN_ISDIR:
+                directory = os.path.join(self.directories.get(wd, "."), name)
+                if proto_walk.is_excluded(
+                    proto_walk.relative_posix(directory), self.excludes
+                ):
+                    continue
+                if mask & (IN_CREATE | IN_MOVED_TO):
+                    self.watch_tree(directory)
+                relevant = rescan = True
+            elif name.endswith(self.suffix):
+                relevant = True
+                if not mask & IN_CLOSE_WRITE:
+                    rescan = True
+
+        return rescan if relevant else None
+
+    def close(self) -> None:
+        os.close(self.fd)
+
+
+class PollingWatcher:
+    """Watches the tree by comparing the size and mtime of every file."""
+
+    def __init__(
+        self, roots: List[pathlib.Path], suffix: str, excludes: List[str]
+    ) -> None:
+        self.roots = roots
+        self.suffix = suffix
+        self.excludes = excludes
+        self.snapshot = self.take_snapshot()
+
+    def take_snapshot(self) -> Dict[str, Tuple[int, int]]:
+        snapshot: Dict[str, Tuple[int, int]] = dict()
+        for path in proto_walk.walk_files(self.roots, self.suffix, self.excludes):
+            try:
+                stat = os.stat(path)
+            except FileNotFoundError:
+                continue
+            snapshot[path] = (stat.st_size, stat.st_mtime_ns)
+        return snapshot
+
+    def wait(self, timeout: Optional[float]) -> Optional[bool]:
+        """Same contract as `InotifyWatcher.wait`."""
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            remaining = POLL_SECONDS
+            if deadline is not None:
+                remaining = min(remaining, max(deadline - time.monotonic(), 0))
+            time.sleep(remaining)
+
+            snapshot = self.take_snapshot()
+            previous, self.snapshot = self.snapshot, snapshot
+            if snapshot != previous:
+                return snapshot.keys() != previous.keys()
+            if deadline is not None and time.monotonic() >= deadline:
+                return None
+
+    def close(self) -> None:
+        pass
+
+
+def make_watcher(
+    roots: List[pathlib.Path], suffix: str, excludes: List[str]
+) -> Union[InotifyWatcher, PollingWatcher]:
+    """Watch through inotify where we can, falling back to polling."""
+    if sys.platform.startswith("linux"):
+        try:
+            return InotifyWatcher(roots, suffix, excludes)
+        except (OSError, AttributeError) as error:
+            sys.stderr.write(f"inotify unavailable ({error}), polling instead\n")
+    return PollingWatcher(roots, suffix, excludes)
+
+
+def run_rebuild(rebuild: Callable[[], None]) -> None:
+    """
+    Run a rebuild, reporting rather than exiting when it fails, whether it exits or
+    raises, e.g. because a file was deleted while it was being read.
+    """
+    try:
+        rebuild()
+    except SystemExit as error:
+        if error.code:
+            sys.stderr.write(f"generation failed ({error.code}), waiting for changes\n")
+    except Exception as error:
+        sys.stderr.write(
+            f"generation failed ({type(error).__name__}: {error}), "
+            "waiting for changes\n"
+        )
+    sys.stdout.flush()
+
+
+def watch_files(
+    roots: List[pathlib.Path],
+    suffix: str,
+    excludes: List[str],
+    files: List[str],
+    rebuild: Callable[[List[str]], None],
+) -> None:
+    """
+    Call `rebuild` with the current files every time the tree below `roots` changes
+    and has then been quiet for `DEBOUNCE_SECONDS`, until interrupted. `files` is the
+    result of the walk done for the first build; the tree is only walked again when
+    files are added, removed or renamed. A rebuild that exits or raises does not stop
+    the watch, see `run_rebuild`.
+    """
+    watcher = make_watcher(roots, suffix, excludes)
+    sys.stdout.write("watching for changes, press ctrl-c to stop\n")
+    try:
+        while True:
+            rescan = watcher.wait(None)
+            if rescan is None:
+                continue
+
+            # Keep absorbing events until a save burst has settled.
+            while True:
+                more = watcher.wait(DEBOUNCE_SECONDS)
+                if more is None:
+                    break
+                rescan = rescan or more
+
+            if rescan:
+                try:
+                    files = proto_walk.walk_files(roots, suffix, excludes)
+                except OSError as error:
+                    sys.stderr.write(
+                        f"walking the tree failed ({error}), waiting for changes\n"
+                    )
+                    continue
+
+            run_rebuild(lambda: rebuild(files))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        watcher.close()
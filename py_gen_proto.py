@@ -1,13 +1,36 @@
 import pathlib
 import sys
 import os
-import subprocess
+import re
+import json
+import time
+import mmap
+import shutil
+import functools
 import dataclasses
 import configparser
-from typing import List
+from concurrent import futures
+from typing import Dict, List, Optional, Pattern
 
+import proto_run
+import proto_walk
+import proto_watch
+import proto_graph
+import proto_stage
+import script_trace
+import proto_manifest
 
 CONFIG_PATH: pathlib.Path = pathlib.Path("./setup.cfg").absolute()
+PROTO_INCLUDE_ROOTS: List[str] = ["."]
+"""The `-I` roots protoc resolves imports against."""
+DEFAULT_EXCLUDES: List[str] = proto_walk.DEFAULT_EXCLUDES + ["*google*"]
+"""Exclude globs used when setup.cfg has none, leaving out vendored google protos."""
+MANIFEST_PATH: pathlib.Path = proto_manifest.CACHE_DIR / "py_gen_proto.json"
+FIX_SUMMARY_PATH: pathlib.Path = proto_manifest.CACHE_DIR / "py_gen_proto.fix.json"
+GENERATED_SUFFIXES: List[str] = ["_pb2.py", "_pb2.pyi", "_grpc.py"]
+"""Suffixes of the files the python, mypy and grpclib plugins emit for a proto."""
+INPROCESS_PROTOC_MODE = "inprocess"
+SUBPROCESS_PROTOC_MODE = "subprocess"
 
 
 @dataclasses.dataclass
@@ -22,21 +45,51 @@ class Options:
     """The original import path prefix in the generated python files."""
     new_import: str
     """The new import path prefix for the generated python files."""
+    jobs: int = dataclasses.field(metadata={"fingerprint": False})
+    """Number of protoc processes to run at once."""
+    exclude: List[str] = dataclasses.field(metadata={"fingerprint": False})
+    """Globs of the files and directories to leave out of proto discovery."""
+    protoc_mode: str = dataclasses.field(metadata={"fingerprint": False})
+    """Either 'inprocess' or 'subprocess', how grpc_tools.protoc is invoked."""
 
 
-def load_cfg() -> Options:
+@dataclasses.dataclass
+class FixResult:
+    """Dataclass used to hold the outcome of fixing the imports of one file."""
+
+    path: pathlib.Path
+    """The generated file that was fixed."""
+    bytes_scanned: int
+    """Size of the file."""
+    replacements: int
+    """Number of import prefixes that were replaced."""
+    skipped: bool
+    """Whether the file was left unwritten because nothing needed replacing."""
+    seconds: float
+    """Wall time the fix took."""
+
+
+@script_trace.traced("load_cfg")
+def load_cfg(config: Optional[configparser.ConfigParser] = None) -> Options:
     """
     loads library config file
+    :param config: already loaded config to read the options from, if any
     :return: loaded `Options` object
     """
-    config = configparser.ConfigParser()
-    config.read(str(CONFIG_PATH))
+    if config is None:
+        config = configparser.ConfigParser()
+        config.read(str(CONFIG_PATH))
 
     options = Options(
         proto_root_dir=pathlib.Path(config["proto"]["root_source_path"]),
         output_dir=pathlib.Path(config["proto"]["python_output_path"]),
         original_import=config["proto"]["python_import_original"],
         new_import=config["proto"]["python_import_replacement"],
+        jobs=proto_run.load_jobs(config),
+        exclude=proto_walk.load_excludes(config, "proto", DEFAULT_EXCLUDES),
+        protoc_mode=config.get(
+            "proto", "python_protoc_mode", fallback=INPROCESS_PROTOC_MODE
+        ),
     )
 
     return options
@@ -44,82 +97,276 @@ def load_cfg() -> Options:
 
 def main() -> None:
     options = load_cfg()
-    generate_python_source(options)
-
-
-def generate_python_source(options: Options) -> None:
     proto_files = find_proto_files(options)
-    run_protoc_command(proto_files, options)
-    fix_generated_files(options)
-
-
-def find_proto_files(options: Options) -> List[str]:
-    proto_file_list: List[str] = list()
-
-    for proto_path in options.proto_root_dir.rglob("./**/*.proto"):
-        if "google" in str(proto_path):
-            continue
-
-        path_str = str(proto_path)
-        path_str = path_str.replace(str(os.getcwd()), ".")
-        proto_file_list.append(path_str)
+    force = "--force" in sys.argv
+    if "--watch" not in sys.argv:
+        generate(options, proto_files, force)
+        return
+
+    # Stay resident so the walk, the import graph and the file hashes are warm for
+    # every rebuild.
+    proto_watch.run_rebuild(lambda: generate(options, proto_files, force))
+    proto_watch.watch_files(
+        [options.proto_root_dir],
+        ".proto",
+        options.exclude,
+        proto_files,
+        lambda files: generate(options, files),
+    )
 
-    return proto_file_list
 
+@script_trace.traced("generate")
+def generate(options: Options, proto_files: List[str], force: bool = False) -> None:
+    plan = plan_generation(options, proto_files, force)
+    if not plan.rebuild_files and not proto_manifest.stale_outputs(plan):
+        sys.stdout.write("python protos are up to date\n")
+        return
+
+    # Generate and fix imports in a staging directory, then only move the files whose
+    # contents changed into place so pytest and mypy caches stay warm.
+    stage_dir = proto_stage.make_stage("py")
+    if plan.rebuild_files:
+        # Unlike the go and docs plugins, protoc's built-in python generator embeds
+        # every field's json_name when it reads a descriptor set, so python always
+        # parses the sources to keep its output the same.
+        outputs = generate_python_source(
+            plan.rebuild_files, plan.graph, options, stage_dir
+        )
+        proto_manifest.record_outputs(plan, outputs)
+
+    stale = proto_manifest.stale_outputs(plan)
+    result = proto_stage.sync_stage(stage_dir, options.output_dir, stale)
+    sys.stdout.write(f"python outputs: {result.summary()}\n")
+    proto_manifest.commit_build(plan)
+
+
+@script_trace.traced("plan")
+def plan_generation(
+    options: Options, proto_files: List[str], force: bool = False
+) -> proto_manifest.BuildPlan:
+    tool_versions = [
+        grpc_tools_version(),
+        proto_manifest.executable_stamp("protoc-gen-python_grpc"),
+        proto_manifest.executable_stamp("protoc-gen-mypy"),
+    ]
+    fingerprint = proto_manifest.make_fingerprint(options, tool_versions, __file__)
+    return proto_manifest.plan_build(
+        MANIFEST_PATH, proto_files, fingerprint, PROTO_INCLUDE_ROOTS, force
+    )
 
-def run_protoc_command(proto_files: List[str], options: Options) -> None:
-    command = build_protoc_command(proto_files, options)
 
-    proc = subprocess.Popen(command)
-    _, _ = proc.communicate()
-    if proc.returncode != 0:
-        sys.exit(proc.returncode)
+def grpc_tools_version() -> str:
+    try:
+        from importlib import metadata
+    except ImportError:
+        # importlib.metadata is new in python 3.8, older ones ask setuptools.
+        try:
+            import pkg_resources
+        except ImportError:
+            return "grpcio-tools: unknown"
+        try:
+            version = pkg_resources.get_distribution("grpcio-tools").version
+        except pkg_resources.DistributionNotFound:
+            return "grpcio-tools: missing"
+    else:
+        try:
+            version = metadata.version("grpcio-tools")
+        except metadata.PackageNotFoundError:
+            return "grpcio-tools: missing"
+    return f"grpcio-tools {version}"
+
+
+def generate_python_source(
+    proto_files: List[str],
+    graph: proto_graph.ProtoGraph,
+    options: Options,
+    output_dir: Optional[pathlib.Path] = None,
+) -> Dict[str, List[str]]:
+    output_dir = output_dir or options.output_dir
+    run_protoc_command(proto_files, graph, options, output_dir)
+
+    outputs = find_generated_files(proto_files, graph, output_dir)
+    fix_generated_files(
+        [output_dir / path for paths in outputs.values() for path in paths], options
+    )
+    return outputs
+
+
+def find_proto_files(options: Options, walked: Optional[List[str]] = None) -> List[str]:
+    if walked is not None:
+        return proto_walk.select_files(walked, options.proto_root_dir, options.exclude)
+    return proto_walk.walk_files([options.proto_root_dir], ".proto", options.exclude)
+
+
+@script_trace.traced("protoc")
+def run_protoc_command(
+    proto_files: List[str],
+    graph: proto_graph.ProtoGraph,
+    options: Options,
+    output_dir: Optional[pathlib.Path] = None,
+) -> None:
+    shards = proto_run.shard_files(proto_files, graph, options.jobs)
+
+    if options.protoc_mode == INPROCESS_PROTOC_MODE:
+        arguments = [build_protoc_arguments(s, options, output_dir) for s in shards]
+        returncode = proto_run.run_in_process_pool(
+            run_protoc_in_process, arguments, options.jobs
+        )
+    elif options.protoc_mode == SUBPROCESS_PROTOC_MODE:
+        commands = [build_protoc_command(s, options, output_dir) for s in shards]
+        returncode = proto_run.run_commands(commands, options.jobs)
+    else:
+        raise ValueError(f"unknown python_protoc_mode: {options.protoc_mode}")
+
+    if returncode != 0:
+        sys.exit(returncode)
+
+
+def run_protoc_in_process(arguments: List[str]) -> int:
+    from grpc_tools import protoc
+
+    # Mirror `python -m grpc_tools.protoc`, which adds the bundled well-known types
+    # to the include path after the caller's arguments.
+    proto_include = os.path.join(os.path.dirname(protoc.__file__), "_proto")
+    return protoc.main(["grpc_tools.protoc", *arguments, f"-I{proto_include}"])
+
+
+def build_protoc_command(
+    protoc_files: List[str],
+    options: Options,
+    output_dir: Optional[pathlib.Path] = None,
+) -> List[str]:
+    command = [sys.executable, "-m", "grpc_tools.protoc"]
+    command.extend(build_protoc_arguments(protoc_files, options, output_dir))
+    return command
 
 
-def build_protoc_command(protoc_files: List[str], options: Options) -> List[str]:
-    command = [
-        "python3",
-        "-m",
-        "grpc_tools.protoc",
-        "-I.",
+def build_protoc_arguments(
+    protoc_files: List[str],
+    options: Options,
+    output_dir: Optional[pathlib.Path] = None,
+) -> List[str]:
+    output_dir = output_dir or options.output_dir
+    arguments = [
+        *(f"-I{root}" for root in PROTO_INCLUDE_ROOTS),
         "--experimental_allow_proto3_optional",
-        f"--python_out={options.output_dir}",
-        f"--python_grpc_out={options.output_dir}",
-        f"--mypy_out={options.output_dir}",
+        f"--python_out={output_dir}",
+        f"--python_grpc_out={output_dir}",
+        f"--mypy_out={output_dir}",
     ]
-    command.extend(protoc_files)
-    return command
-
-
-def fix_import_paths(python_file: pathlib.Path, pyi: bool, options: Options) -> None:
-    file_text = python_file.read_text()
-    file_text = file_text.replace(
-        f"from {options.original_import}",
-        f"from {options.new_import}",
+    arguments.extend(protoc_files)
+    return arguments
+
+
+@functools.lru_cache()
+def import_fix_regex(original_import: str) -> Pattern[bytes]:
+    # One expression for all four spellings of the original import prefix: after
+    # `from `, after `import `, after `[` and after a space when followed by a dot.
+    # The first group is whatever precedes the prefix so it can be put back.
+    original = re.escape(original_import.encode())
+    return re.compile(rb"(from |import |\[| (?=" + original + rb"\.))" + original)
+
+
+def fix_import_paths(python_file: pathlib.Path, pyi: bool, options: Options) -> int:
+    # Scan the file through a memory map so large _pb2.py files with big serialized
+    # descriptors are never copied into memory, and stream the rewritten file out in
+    # slices between matches. Files without a match are left untouched.
+    regex = import_fix_regex(options.original_import)
+    new_import = options.new_import.encode()
+    temp_file = python_file.with_name(python_file.name + ".tmp")
+
+    replacements = 0
+    with python_file.open("rb") as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            return 0
+
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+            first_match = regex.search(mapped)
+            if first_match is None:
+                return 0
+
+            with memoryview(mapped) as view, temp_file.open("wb") as out_file:
+                position = 0
+                for match in regex.finditer(mapped, first_match.start()):
+                    out_file.write(view[position : match.start()])
+                    out_file.write(match.group(1))
+                    out_file.write(new_import)
+                    position = match.end()
+                    replacements += 1
+
+                out_file.write(view[position:])
+
+    shutil.copymode(str(python_file), str(temp_file))
+    os.replace(str(temp_file), str(python_file))
+    return replacements
+
+
+def find_generated_files(
+    proto_files: List[str], graph: proto_graph.ProtoGraph, output_dir: pathlib.Path
+) -> Dict[str, List[str]]:
+    # protoc names its outputs after each proto's path relative to its -I root, so
+    # we can list exactly what this run emitted, keyed by the proto it came from,
+    # without walking the output tree and picking up hand-written modules that live
+    # alongside them.
+    generated: Dict[str, List[str]] = dict()
+    for proto_file in proto_files:
+        key = proto_graph.normalize_path(proto_file)
+        stem = graph.import_name(key)[: -len(".proto")]
+        generated[key] = [
+            f"{stem}{suffix}"
+            for suffix in GENERATED_SUFFIXES
+            if (output_dir / f"{stem}{suffix}").exists()
+        ]
+
+    return generated
+
+
+def fix_generated_file(python_file: pathlib.Path, options: Options) -> FixResult:
+    started = time.perf_counter()
+    # Sized before the rewrite, which changes the file's length.
+    bytes_scanned = python_file.stat().st_size
+    replacements = fix_import_paths(
+        python_file, pyi=python_file.suffix == ".pyi", options=options
     )
-    file_text = file_text.replace(
-        f"import {options.original_import}",
-        f"import {options.new_import}",
+    return FixResult(
+        path=python_file,
+        bytes_scanned=bytes_scanned,
+        replacements=replacements,
+        skipped=replacements == 0,
+        seconds=time.perf_counter() - started,
     )
 
-    file_text = file_text.replace(
-        f"[{options.original_import}",
-        f"[{options.new_import}",
-    )
 
-    file_text = file_text.replace(
-        f" {options.original_import}.",
-        f" {options.new_import}.",
-    )
-    python_file.write_text(file_text)
+@script_trace.traced("fix_generated_files")
+def fix_generated_files(python_files: List[pathlib.Path], options: Options) -> None:
+    with futures.ThreadPoolExecutor(max_workers=max(options.jobs, 1)) as executor:
+        results = list(
+            executor.map(lambda f: fix_generated_file(f, options), python_files)
+        )
 
+    write_fix_summary(results)
 
-def fix_generated_files(options: Options) -> None:
-    for python_file in pathlib.Path(options.output_dir).rglob("./**/*.py"):
-        fix_import_paths(python_file, pyi=False, options=options)
 
-    for python_file in pathlib.Path(options.output_dir).rglob("./**/*.pyi"):
-        fix_import_paths(python_file, pyi=True, options=options)
+def write_fix_summary(results: List[FixResult]) -> None:
+    summary = [
+        {
+            "path": result.path.as_posix(),
+            "bytes_scanned": result.bytes_scanned,
+            "replacements": result.replacements,
+            "skipped": result.skipped,
+            "seconds": round(result.seconds, 6),
+        }
+        for result in results
+    ]
+    FIX_SUMMARY_PATH.parent.mkdir(parents=True, exist_ok=True)
+    FIX_SUMMARY_PATH.write_text(json.dumps(summary, indent=2))
+
+    rewritten = sum(1 for result in results if not result.skipped)
+    scanned = sum(result.bytes_scanned for result in results)
+    sys.stdout.write(
+        f"fixed imports in {rewritten} of {len(results)} generated files "
+        f"({scanned} bytes scanned)\n"
+    )
 
 
 if __name__ == "__main__":
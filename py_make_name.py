@@ -9,6 +9,8 @@ from dataclasses import dataclass
 from configparser import ConfigParser
 from typing import Optional
 
+import script_trace
+
 """
 changes name of module in file path file path directory and all relevant config settings
 """
@@ -47,6 +49,7 @@ def load_cfg(config_path: pathlib.Path) -> ConfigParser:
     return config
 
 
+@script_trace.traced("load_target_name")
 def load_target_name(script_info: ScriptInfo) -> None:
     """
     loads target name from system arguments into script info, raises errors if value is
@@ -65,6 +68,7 @@ def load_target_name(script_info: ScriptInfo) -> None:
         raise ValueError("new name must be passed with name=[name] param")
 
 
+@script_trace.traced("make_new_directory")
 def make_new_directory(script_info: ScriptInfo) -> None:
 
     # load current and new paths
@@ -170,6 +174,7 @@ def rename_packages(old_name: str, target_name: str) -> None:
         raise FileNotFoundError("no packages found in library")
 
 
+@script_trace.traced("alter_new")
 def alter_new(script_info: ScriptInfo) -> None:
     """
     renames lib and writes 1 or 0 to stdout for whether .egg needs to be
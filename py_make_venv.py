@@ -5,6 +5,8 @@ import platform
 
 from configparser import ConfigParser
 
+import script_trace
+
 CONFIG_PATH = pathlib.Path(__file__).parent.parent.parent / "setup.cfg"
 PLATFORM = platform.system()
 
@@ -19,6 +21,7 @@ def load_cfg() -> ConfigParser:
     return config
 
 
+@script_trace.traced("create_venv")
 def create_venv(lib_name: str, py_version: str) -> pathlib.Path:
     """
     creates the new virtual environment
@@ -40,6 +43,7 @@ def create_venv(lib_name: str, py_version: str) -> pathlib.Path:
     return venv_path
 
 
+@script_trace.traced("register_venv")
 def register_venv(activate_path: pathlib.Path, lib_name: str, py_version: str) -> str:
     """
     registers the new environment with a .bashrc entry alias for easy venv entry
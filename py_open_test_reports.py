@@ -1,7 +1,8 @@
 import platform
-import subprocess
 import sys
 
+import script_trace
+
 PLATFORM = platform.system()
 
 if __name__ == "__main__":
@@ -22,5 +23,5 @@ if __name__ == "__main__":
     command1 = [command_base, report1]
     command2 = [command_base, report2]
 
-    subprocess.Popen(command1, stdout=sys.stdout, stderr=sys.stderr).communicate()
-    subprocess.Popen(command2, stdout=sys.stdout, stderr=sys.stderr).communicate()
+    script_trace.Popen(command1, stdout=sys.stdout, stderr=sys.stderr).communicate()
+    script_trace.Popen(command2, stdout=sys.stdout, stderr=sys.stderr).communicate()
@@ -0,0 +1,360 @@
+import os
+import sys
+import json
+import time
+import atexit
+import pathlib
+import threading
+import functools
+import contextlib
+import subprocess
+from typing import Any, Callable, ContextManager, Dict, Iterator, List, Optional
+from typing import TypeVar
+
+"""
+opt-in tracing shared by the make scripts. Set MAKE_SCRIPTS_TRACE=1, or pass --trace,
+to record a span for every phase and child process, written as a chrome trace-event
+file (open it in chrome://tracing or ui.perfetto.dev) with a one line summary on
+stderr. MAKE_SCRIPTS_TRACE may also name the trace file, or a directory to put it in.
+"""
+
+TRACE_ENV = "MAKE_SCRIPTS_TRACE"
+TRACE_FLAG = "--trace"
+TRACE_DIR = pathlib.Path("./zdevelop/.cache/traces")
+"""Where traces go by default, resolved when the trace is written so scripts that
+change directory write it into the directory they end up in."""
+
+FunctionType = TypeVar("FunctionType", bound=Callable[..., Any])
+
+
+def trace_path() -> Optional[pathlib.Path]:
+    """Return where this run's trace goes, or `None` when tracing is off."""
+    value = os.environ.get(TRACE_ENV, "")
+    if value.lower() in ("", "0", "false", "no"):
+        if TRACE_FLAG not in sys.argv:
+            return None
+        value = "1"
+
+    script = pathlib.Path(sys.argv[0]).stem or "python"
+    file_name = f"{script}.{time.strftime('%Y%m%d-%H%M%S')}.{os.getpid()}.trace.json"
+    if value.lower() in ("1", "true", "yes"):
+        return TRACE_DIR / file_name
+    if value.endswith(os.sep) or os.path.isdir(value):
+        return pathlib.Path(value) / file_name
+    return pathlib.Path(value)
+
+
+TRACE_PATH = trace_path()
+ENABLED = TRACE_PATH is not None
+SCRIPT_NAME = pathlib.Path(sys.argv[0]).stem or "python"
+
+EVENTS: List[Dict[str, Any]] = list()
+EVENTS_LOCK = threading.Lock()
+STARTED_US = time.monotonic_ns() // 1000
+STARTED_CPU = time.process_time()
+
+
+def now_us() -> int:
+    """Timestamp in microseconds on the clock shared by every process of a run."""
+    return time.monotonic_ns() // 1000
+
+
+def children_usage() -> Optional[Any]:
+    """Return the usage of the reaped children, or `None` where there is no rusage."""
+    try:
+        import resource
+    except ImportError:
+        # Windows has no resource module, spans are recorded without it.
+        return None
+    return resource.getrusage(resource.RUSAGE_CHILDREN)
+
+
+def children_args(started: Optional[Any], ended: Optional[Any]) -> Dict[str, Any]:
+    """The children's cpu time between two usages, and their peak rss."""
+    if started is None or ended is None:
+        return dict()
+    children_cpu = (ended.ru_utime - started.ru_utime) + (
+        ended.ru_stime - started.ru_stime
+    )
+    return {
+        "children_cpu_seconds": round(children_cpu, 6),
+        "children_peak_rss_kb": ended.ru_maxrss,
+    }
+
+
+STARTED_CHILDREN = children_usage() if ENABLED else None
+
+
+def add_event(event: Dict[str, Any]) -> None:
+    with EVENTS_LOCK:
+        EVENTS.append(event)
+
+
+@contextlib.contextmanager
+def _span(name: str, category: str, args: Dict[str, Any]) -> Iterator[None]:
+    started = now_us()
+    started_cpu = time.process_time()
+    started_children = children_usage()
+    try:
+        yield
+    finally:
+        add_event(
+            {
+                "name": name,
+                "cat": category,
+                "ph": "X",
+                "ts": started,
+                "dur": now_us() - started,
+                "pid": os.getpid(),
+                "tid": threading.get_ident(),
+                "args": {
+                    **args,
+                    "cpu_seconds": round(time.process_time() - started_cpu, 6),
+                    **children_args(started_children, children_usage()),
+                },
+            }
+        )
+
+
+def span(name: str, category: str = "phase", **args: Any) -> ContextManager[None]:
+    """
+    Record the wall time, cpu time of this process and of the children it reaped,
+    and the children's peak rss over a block. Does nothing unless tracing is on.
+    """
+    if not ENABLED:
+        return contextlib.nullcontext()
+    return _span(name, category, args)
+
+
+def traced(name: str) -> Callable[[FunctionType], FunctionType]:
+    """Decorate a function so every call to it is recorded as a span."""
+
+    def decorator(function: FunctionType) -> FunctionType:
+        if not ENABLED:
+            return function
+
+        @functools.wraps(function)
+        def wrapper(*args: Any, **kwargs: Any) -> Any:
+            with span(name):
+                return function(*args, **kwargs)
+
+        return wrapper  # type: ignore
+
+    return decorator
+
+
+class TracedPopen(subprocess.Popen):  # type: ignore[type-arg]
+    """
+    `subprocess.Popen` which records its child as a span once it has been waited for
+    or polled. Where there is `wait4` the child is reaped with it, so the child's own
+    cpu time and peak rss are recorded too.
+    """
+
+    def __init__(self, args: Any, *popen_args: Any, **popen_kwargs: Any) -> None:
+        self.trace_started = now_us()
+        self.trace_recorded = False
+        self.reap_lock = threading.Lock()
+        super().__init__(args, *popen_args, **popen_kwargs)
+
+    def reap(self, wait_flags: int) -> bool:
+        """
+        Try to reap the child with `wait4`, recording its usage. Returns whether
+        there is nothing left to try, the child having exited or been reaped elsewhere.
+        """
+        with self.reap_lock:
+            if self.returncode is not None:
+                return True
+            try:
+                pid, status, usage = os.wait4(self.pid, wait_flags)
+            except ChildProcessError:
+                # Reaped elsewhere, Popen works out what is left of its status.
+                return True
+            if pid != self.pid:
+                return False
+            if os.WIFEXITED(status):
+                self.returncode = os.WEXITSTATUS(status)
+            else:
+                self.returncode = -os.WTERMSIG(status)
+            self.record(usage)
+            return True
+
+    def poll(self) -> Optional[int]:
+        if hasattr(os, "wait4"):
+            self.reap(os.WNOHANG)
+        returncode = super().poll()
+        if returncode is not None:
+            self.record(None)
+        return returncode
+
+    def wait(self, timeout: Optional[float] = None) -> int:
+        if hasattr(os, "wait4"):
+            if timeout is None:
+                self.reap(0)
+            else:
+                # Poll like Popen does, as wait4 itself cannot time out.
+                deadline = time.monotonic() + timeout
+                delay = 0.0005
+                while not self.reap(os.WNOHANG):
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        raise subprocess.TimeoutExpired(self.args, timeout)
+                    time.sleep(min(delay, remaining))
+                    delay = min(delay * 2, 0.05)
+        returncode = super().wait(timeout)
+        self.record(None)
+        return returncode
+
+    def record(self, usage: Optional[Any]) -> None:
+        """Record the child as a span, once, with its usage when there is one."""
+        if self.trace_recorded or self.returncode is None:
+            return
+        self.trace_recorded = True
+        command = self.args if isinstance(self.args, (list, tuple)) else [self.args]
+        name = os.path.basename(str(command[0]))
+        args = {
+            "command": " ".join(str(c) for c in command)[:2000],
+            "returncode": self.returncode,
+        }
+        if usage is not None:
+            args.update(
+                {
+                    "user_seconds": round(usage.ru_utime, 6),
+                    "system_seconds": round(usage.ru_stime, 6),
+                    "peak_rss_kb": usage.ru_maxrss,
+                }
+            )
+
+        add_event(
+            {
+                "name": name,
+                "cat": "process",
+                "ph": "X",
+                "ts": self.trace_started,
+                "dur": now_us() - self.trace_started,
+                "pid": os.getpid(),
+                "tid": self.pid,
+                "args": args,
+            }
+        )
+        add_event(
+            {
+                "name": "thread_name",
+                "ph": "M",
+                "pid": os.getpid(),
+                "tid": self.pid,
+                "args": {"name": f"{name} ({self.pid})"},
+            }
+        )
+
+
+Popen = TracedPopen if ENABLED else subprocess.Popen
+"""Drop in for `subprocess.Popen` which records child processes when tracing."""
+
+
+def part_path(pid: int) -> pathlib.Path:
+    assert TRACE_PATH is not None
+    return TRACE_PATH.with_name(f"{TRACE_PATH.name}.{pid}.part")
+
+
+def after_fork(name: str) -> None:
+    """
+    Forget the parent's events in a forked child, which records its own, and label
+    the child `name` in the trace.
+    """
+    with EVENTS_LOCK:
+        EVENTS.clear()
+    add_event(
+        {
+            "name": "process_name",
+            "ph": "M",
+            "pid": os.getpid(),
+            "args": {"name": f"{SCRIPT_NAME} {name}"},
+        }
+    )
+
+
+def flush_fork() -> None:
+    """
+    Hand a forked child's events to the parent, which merges them into its trace.
+    Call it before `os._exit`, which skips the exit handlers.
+    """
+    if not ENABLED:
+        return
+    path = part_path(os.getpid())
+    path.parent.mkdir(parents=True, exist_ok=True)
+    with EVENTS_LOCK:
+        path.write_text(json.dumps(EVENTS))
+
+
+def merge_fork_parts() -> None:
+    assert TRACE_PATH is not None
+    if not TRACE_PATH.parent.exists():
+        return
+    for path in TRACE_PATH.parent.glob(f"{TRACE_PATH.name}.*.part"):
+        try:
+            events = json.loads(path.read_text())
+        except (OSError, ValueError):
+            continue
+        with EVENTS_LOCK:
+            EVENTS.extend(events)
+        path.unlink()
+
+
+def write_trace() -> None:
+    """Write the trace file and print a one line summary of the run to stderr."""
+    assert TRACE_PATH is not None
+    merge_fork_parts()
+
+    ended = now_us()
+    cpu = time.process_time() - STARTED_CPU
+    add_event(
+        {
+            "name": SCRIPT_NAME,
+            "cat": "script",
+            "ph": "X",
+            "ts": STARTED_US,
+            "dur": ended - STARTED_US,
+            "pid": os.getpid(),
+            "tid": threading.main_thread().ident,
+            "args": {
+                "argv": sys.argv,
+                "cpu_seconds": round(cpu, 6),
+                **children_args(STARTED_CHILDREN, children_usage()),
+            },
+        }
+    )
+    add_event(
+        {
+            "name": "process_name",
+            "ph": "M",
+            "pid": os.getpid(),
+            "args": {"name": SCRIPT_NAME},
+        }
+    )
+
+    TRACE_PATH.parent.mkdir(parents=True, exist_ok=True)
+    with EVENTS_LOCK:
+        events = list(EVENTS)
+    TRACE_PATH.write_text(
+        json.dumps({"traceEvents": events, "displayTimeUnit": "ms"}, indent=1)
+    )
+
+    spans = [e for e in events if e["ph"] == "X" and e["cat"] != "script"]
+    processes = [e for e in spans if e["cat"] == "process"]
+    line = (
+        f"trace: {SCRIPT_NAME} {(ended - STARTED_US) / 1e6:.3f}s wall, "
+        f"{cpu:.3f}s cpu, {len(spans)} spans, {len(processes)} processes"
+    )
+    peak_rss = [
+        p["args"]["peak_rss_kb"] for p in processes if "peak_rss_kb" in p["args"]
+    ]
+    if peak_rss:
+        line += f" (peak rss {max(peak_rss)}kb)"
+    if spans:
+        slowest = max(spans, key=lambda e: e["dur"])
+        line += f", slowest {slowest['name']} {slowest['dur'] / 1e6:.3f}s"
+    sys.stderr.write(f"{line} -> {TRACE_PATH}\n")
+
+
+if ENABLED:
+    atexit.register(write_trace)
@@ -0,0 +1,8 @@
+import sys
+import pathlib
+
+"""
+puts the scripts, which import each other as top level modules, on the import path
+"""
+
+sys.path.insert(0, str(pathlib.Path(__file__).parent.parent))
@@ -0,0 +1,58 @@
+import shutil
+import pathlib
+from typing import List
+
+import pytest
+
+import go_gen_proto
+
+"""
+checks the native tag engine against generated files tagged by protoc-go-inject-tag,
+each input `NAME.pb.go` in testdata/inject_tag next to the `NAME.golden` the tool
+writes for it
+"""
+
+FIXTURE_DIR = pathlib.Path(__file__).parent / "testdata" / "inject_tag"
+
+
+def fixture_inputs() -> List[pathlib.Path]:
+    return sorted(FIXTURE_DIR.glob("*.pb.go"))
+
+
+def golden_path(input_path: pathlib.Path) -> pathlib.Path:
+    return input_path.with_name(input_path.name[: -len(".pb.go")] + ".golden")
+
+
+@pytest.mark.parametrize("input_path", fixture_inputs(), ids=lambda p: p.name)
+def test_native_engine_matches_golden(input_path: pathlib.Path) -> None:
+    injected = go_gen_proto.inject_tags_in_source(input_path.read_bytes())
+    assert injected == golden_path(input_path).read_bytes()
+
+
+@pytest.mark.skipif(
+    shutil.which(go_gen_proto.EXTERNAL_TAG_ENGINE) is None,
+    reason=f"{go_gen_proto.EXTERNAL_TAG_ENGINE} is not installed",
+)
+@pytest.mark.parametrize("input_path", fixture_inputs(), ids=lambda p: p.name)
+def test_external_engine_matches_golden(
+    input_path: pathlib.Path, tmp_path: pathlib.Path
+) -> None:
+    source_path = tmp_path / input_path.name
+    shutil.copy(str(input_path), str(source_path))
+    result = go_gen_proto.run_tag_command(source_path)
+    assert result.returncode == 0, result.output
+    assert source_path.read_bytes() == golden_path(input_path).read_bytes()
+
+
+def test_native_engine_leaves_untagged_files_alone(tmp_path: pathlib.Path) -> None:
+    source_path = tmp_path / "plain.pb.go"
+    source_path.write_bytes(
+        b"package plain\n\ntype Plain struct {\n"
+        b'\tId string `protobuf:"bytes,1,opt,name=id,proto3" json:"id,omitempty"`\n'
+        b"}\n"
+    )
+    modified = source_path.stat().st_mtime_ns
+
+    result = go_gen_proto.inject_tags_natively(source_path)
+    assert (result.returncode, result.output) == (0, "unchanged")
+    assert source_path.stat().st_mtime_ns == modified
@@ -0,0 +1,31 @@
+// Code generated by protoc-gen-go. DO NOT EDIT.
+// source: proto/user.proto
+
+package user
+
+type User struct {
+	state         protoimpl.MessageState
+	sizeCache     protoimpl.SizeCache
+	unknownFields protoimpl.UnknownFields
+
+	// @inject_tag: bson:"_id,omitempty"
+	Id string `protobuf:"bytes,1,opt,name=id,proto3" json:"id,omitempty"`
+	// The display name.
+	Name  string `protobuf:"bytes,2,opt,name=name,proto3" json:"name,omitempty"`
+	Email string `protobuf:"bytes,3,opt,name=email,proto3" json:"email,omitempty"` // @inject_tag: bson:"email" validate:"email"
+	// @gotags: json:"age"
+	Age int32 `protobuf:"varint,4,opt,name=age,proto3" json:"age,omitempty"`
+	// @inject_tag: bson:"not_doc"
+
+	Orphan bool `protobuf:"varint,5,opt,name=orphan,proto3" json:"orphan,omitempty"`
+	// @inject_tag:
+	Empty []string `protobuf:"bytes,6,rep,name=empty,proto3" json:"empty,omitempty"`
+}
+
+func (x *User) GetId() string {
+	// @inject_tag: bson:"ignored"
+	if x != nil {
+		return x.Id
+	}
+	return ""
+}
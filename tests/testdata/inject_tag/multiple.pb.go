@@ -0,0 +1,30 @@
+// Code generated by protoc-gen-go. DO NOT EDIT.
+// source: proto/order.proto
+
+package order
+
+type Order struct {
+	state         protoimpl.MessageState
+	sizeCache     protoimpl.SizeCache
+	unknownFields protoimpl.UnknownFields
+
+	// @inject_tag: bson:"_id"
+	Id string `protobuf:"bytes,1,opt,name=id,proto3" json:"id,omitempty"` // @inject_tag: db:"id"
+	// @inject_tag: bson:"total"
+	// @inject_tag: xml:"total,attr"
+	Total int64 `protobuf:"varint,2,opt,name=total,proto3" json:"total,omitempty"`
+	// @inject_tag: json:"n"
+	N int32 `protobuf:"varint,3,opt,name=n,proto3" json:"n,omitempty"` // @inject_tag: json:"number_of_items_in_the_order"
+	Note string `protobuf:"bytes,4,opt,name=note,proto3" json:"note,omitempty"`
+	// @inject_tag: db:"count"
+	Count int32 `json:"count,omitempty"` // seen `abcdefgh` @inject_tag: json:"count"
+}
+
+type Line struct {
+	state         protoimpl.MessageState
+	sizeCache     protoimpl.SizeCache
+	unknownFields protoimpl.UnknownFields
+
+	// @inject_tag: bson:"sku"
+	Sku string `protobuf:"bytes,1,opt,name=sku,proto3" json:"sku,omitempty"` // @inject_tag: bson:"sku_code"
+}
@@ -0,0 +1,17 @@
+// Code generated by protoc-gen-go. DO NOT EDIT.
+// source: proto/code.proto
+
+package code
+
+type Code struct {
+	state         protoimpl.MessageState
+	sizeCache     protoimpl.SizeCache
+	unknownFields protoimpl.UnknownFields
+
+	// @inject_tag: validate:"regexp=^[a-z]+$"
+	Slug string `protobuf:"bytes,1,opt,name=slug,proto3" json:"slug,omitempty"`
+	// @inject_tag: price:"$$5" total:"$1" whole:"${0}"
+	Price string `protobuf:"bytes,2,opt,name=price,proto3" json:"price,omitempty"`
+	// @inject_tag: note:"cost $ {x}"
+	Note string `protobuf:"bytes,3,opt,name=note,proto3" json:"note,omitempty"`
+}
@@ -0,0 +1,12 @@
+// Code generated by protoc-gen-go. DO NOT EDIT.
+// source: proto/legacy.proto
+
+package legacy
+
+type Legacy struct {
+	Value                string   `protobuf:"bytes,1,opt,name=value,proto3" json:"value,omitempty"`
+	XXX_NoUnkeyedLiteral struct{} `json:"-"`
+	XXX_unrecognized     []byte   `json:"-"`
+	// @inject_tag: bson:"size"
+	XXX_sizecache int32 `json:"-"`
+}